@@ -1,19 +1,47 @@
 # Import utils
-from utils import build_logger, get_config, AZ_CREDENTIAL, try_or_none, sanitize
+from utils import (
+    AZ_CREDENTIAL,
+    build_logger,
+    build_meter,
+    get_config,
+    LRUCache,
+    MicroBatcher,
+    run_in_loop,
+    sanitize,
+    try_or_none,
+)
 
 # Import misc
+from ai.toolcache import ToolCache
+from ai.worker import WorkerPool
+from array import array
 from datetime import datetime
 from langchain import PromptTemplate
 from langchain.agents import AgentType, initialize_agent, load_tools, Tool
 from langchain.cache import BaseCache
 from langchain.callbacks import get_openai_callback
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chains import LLMChain
 from langchain.chains.summarize import load_summarize_chain
 from langchain.chat_models import AzureChatOpenAI
 from langchain.embeddings import OpenAIEmbeddings
-from langchain.memory import ConversationBufferMemory, ReadOnlySharedMemory
+from langchain.memory import ReadOnlySharedMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
 from langchain.retrievers import AzureCognitiveSearchRetriever
-from langchain.schema import BaseChatMessageHistory, ChatGeneration, AgentAction
-from langchain.schema.messages import AIMessage, BaseMessage, HumanMessage
+from langchain.schema import (
+    AgentAction,
+    BaseChatMessageHistory,
+    BaseMemory,
+    ChatGeneration,
+    LLMResult,
+)
+from langchain.schema.messages import (
+    AIMessage,
+    BaseMessage,
+    get_buffer_string,
+    HumanMessage,
+    SystemMessage,
+)
 from langchain.tools import YouTubeSearchTool, PubmedQueryRun
 from langchain.tools.azure_cognitive_services import AzureCogsFormRecognizerTool
 from langchain.tools.base import Tool
@@ -24,20 +52,39 @@ from models.message import MessageRole
 from models.message import StoredMessageModel, MessageModel, StreamMessageModel
 from models.user import UserModel
 from openai.error import InvalidRequestError, APIError
+from persistence.codec import decode, encode
 from persistence.icache import ICache
 from persistence.isearch import ISearch
+from persistence.isemantic import ISemanticCache
 from persistence.istore import IStore
 from tenacity import (
     retry,
     stop_after_attempt,
     wait_random_exponential,
-    retry_if_exception_type,
+    retry_if_exception,
     retry_if_result,
 )
-from typing import Any, Callable, List, Optional, Sequence
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    ClassVar,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 from uuid import UUID
 import asyncio
+import functools
+import hashlib
+import json
+import re
 import textwrap
+import tiktoken
+import time
+import unicodedata
 
 
 ###
@@ -45,6 +92,7 @@ import textwrap
 ###
 
 _logger = build_logger(__name__)
+_meter = build_meter(__name__)
 
 CHAT_PREFIX = f"""
 Assistant is designed to be able to assist with a wide range of tasks, from answering simple questions to providing in-depth explanations and discussions on a wide range of topics. As a language model, Assistant is able to generate human-like text based on the input it receives, allowing it to engage in natural-sounding conversations and provide responses that are coherent and relevant to the topic at hand.
@@ -64,17 +112,49 @@ Only in its final answer, Assistant MUST:
 """
 
 
+@functools.lru_cache
+def _encoding(model_name: str) -> tiktoken.Encoding:
+    """
+    Tokenizer of a model, loaded once per process.
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        # Azure model names are not known by tiktoken (e.g. "gpt-35-turbo"), chat models share the same encoding
+        return tiktoken.get_encoding("cl100k_base")
+
+
 class OpenAI:
+    _embeddings_batcher: MicroBatcher[str, List[float]]
+    _embeddings_lru: LRUCache[str, array]
+    _embeddings_prefix: str
     _loop: asyncio.AbstractEventLoop
+    EMBEDDING_CACHE_TTL_SECS: int = 60 * 60 * 24 * 7  # 7 days
+    EMBEDDING_PREFIX: str = (
+        "embedding-f32"  # Raw float32, previous entries were base64 text
+    )
+    cache: ICache
     chat: AzureChatOpenAI
+    embeddings: OpenAIEmbeddings
     gpt_max_tokens: int
+    memory_max_tokens: int
+    memory_max_turns: int
     search: ISearch
+    semantic_cache: Optional[ISemanticCache]
+    semantic_cache_threshold: float
+    semantic_cache_ttl_secs: int
     store: IStore
+    tool_cache: ToolCache
     tools: Sequence[Tool]
+    worker: WorkerPool
 
-    def __init__(self, store: IStore):
+    def __init__(self, store: IStore, cache: ICache):
         self._loop = asyncio.get_running_loop()
+        self.cache = cache
+        self.semantic_cache = None
         self.store = store
+        self.tool_cache = ToolCache(cache)
+        self.worker = WorkerPool()
 
         # Init credentials
         oai_token = self._generate_token()
@@ -84,6 +164,18 @@ class OpenAI:
         self.gpt_max_tokens = get_config(
             ["ai", "openai"], "gpt_max_tokens", int, required=True
         )
+        self.memory_max_tokens = get_config(
+            ["ai", "openai"], "memory_max_tokens", int, default=2000
+        )
+        self.memory_max_turns = get_config(
+            ["ai", "openai"], "memory_max_turns", int, default=10
+        )
+        self.semantic_cache_threshold = get_config(
+            ["ai", "openai"], "semantic_cache_threshold", float, default=0.97
+        )
+        self.semantic_cache_ttl_secs = get_config(
+            ["ai", "openai"], "semantic_cache_ttl_secs", int, default=60 * 60 * 24
+        )
         openai_args = {
             "openai_api_base": get_config(
                 ["ai", "openai"], "api_base", str, required=True
@@ -153,16 +245,6 @@ class OpenAI:
                 )[: int(self.gpt_max_tokens)],
                 name=req_tool.name,
             ),
-            Tool(
-                description="Useful for when you need to generate ideas, write articles, search new point of views. If the result of this function is similar to the previous one, do not use it. The input should be a string, representing the idea. The output will be a text describing the idea.",
-                func=lambda q: self.chat.predict(q),
-                name="immagination",
-            ),
-            Tool(
-                description="Useful for when you need to summarize a text. The input should be a string, representing the text to summarize. The output will be a text describing the text.",
-                func=lambda q: load_summarize_chain().run(q),
-                name="summarize",
-            ),
         ]
         # Azure Cognitive Search
         for instance in get_config(
@@ -195,35 +277,125 @@ class OpenAI:
                 name=f"{displayed_name} (Azure Cognitive Search)",
             )
             self.tools.append(tool)
+        # Results of the external APIs are cached, creative tools are not, as the user expects a new answer
+        self.tools = [self.tool_cache.wrap(tool) for tool in self.tools]
+        self.tools += [
+            Tool(
+                description="Useful for when you need to generate ideas, write articles, search new point of views. If the result of this function is similar to the previous one, do not use it. The input should be a string, representing the idea. The output will be a text describing the idea.",
+                func=lambda q: self.chat.predict(q),
+                name="immagination",
+            ),
+            Tool(
+                description="Useful for when you need to summarize a text. The input should be a string, representing the text to summarize. The output will be a text describing the text.",
+                func=lambda q: load_summarize_chain().run(q),
+                name="summarize",
+            ),
+        ]
 
         # Init embeddings
+        ada_batch_size = get_config(["ai", "openai"], "ada_batch_size", int, default=16)
+        ada_batch_wait_ms = get_config(
+            ["ai", "openai"], "ada_batch_wait_ms", int, default=10
+        )
+        ada_cache_size = get_config(
+            ["ai", "openai"], "ada_cache_size", int, default=1000
+        )
+        ada_deploy_id = get_config(
+            ["ai", "openai"], "ada_deploy_id", str, required=True
+        )
+        ada_model = get_config(
+            ["ai", "openai"],
+            "ada_model",
+            str,
+            default="text-embedding-ada-002",
+            required=True,
+        )
         self.embeddings = OpenAIEmbeddings(
-            deployment=get_config(
-                ["ai", "openai"], "ada_deploy_id", str, required=True
-            ),
+            chunk_size=ada_batch_size,  # Max number of inputs per request
+            deployment=ada_deploy_id,
             model_kwargs={
-                "model_name": get_config(
-                    ["ai", "openai"],
-                    "ada_model",
-                    str,
-                    default="text-embedding-ada-002",
-                    required=True,
-                ),
+                "model_name": ada_model,
             },
             **openai_args,
         )
+        self._embeddings_batcher = MicroBatcher(
+            flush=self.vectors_from_texts,
+            max_size=ada_batch_size,
+            max_wait_secs=ada_batch_wait_ms / 1000,
+        )
+        self._embeddings_lru = LRUCache(max_size=ada_cache_size)
+        # Vectors are not compatible between deployments and models
+        self._embeddings_prefix = f"{self.EMBEDDING_PREFIX}:{ada_deploy_id}:{ada_model}"
+
+        # Metrics
+        self._embeddings_hits = _meter.create_counter(
+            description="Number of embeddings served from cache, by tier.",
+            name="embedding.cache.hit",
+        )
+        self._embeddings_misses = _meter.create_counter(
+            description="Number of embeddings computed by the model.",
+            name="embedding.cache.miss",
+        )
+        self._semantic_lookups = _meter.create_counter(
+            description="Number of semantic cache lookups, by result.",
+            name="semantic_cache.lookup",
+        )
+        self._history_reads = _meter.create_histogram(
+            description="Number of history reads from the store, by completion.",
+            name="completion.history.store_reads",
+        )
 
-    def vector_from_text(self, prompt: str) -> List[float]:
+    async def vector_from_text(self, prompt: str) -> List[float]:
+        """
+        Get the vector of a text.
+
+        Vectors are cached in memory, then in the shared cache, by normalized text and model. Text is embedded as is, normalization only lets the variants of a text share a vector. Concurrent calls not in cache are grouped in a single request.
+        """
         _logger.debug(f"Getting vector for text: {prompt}")
-        return self.embeddings.embed_query(prompt)
+        cache_key = self._embedding_key(self._normalize(prompt))
+
+        # In-process cache
+        vector = self._embeddings_lru.get(cache_key)
+        if vector:
+            self._embeddings_hits.add(1, {"tier": "memory"})
+            return vector.tolist()
+
+        # Shared cache
+        raw = await self.cache.get_bytes(cache_key)
+        if raw:
+            try:
+                vector = array("f", raw)
+                self._embeddings_lru.set(cache_key, vector)
+                self._embeddings_hits.add(1, {"tier": "cache"})
+                return vector.tolist()
+            except ValueError as e:
+                _logger.warn(f'Error parsing embedding from cache, "{e}"')
+
+        self._embeddings_misses.add(1)
+        res = await self._embeddings_batcher.submit(prompt)
+        # Stored as float32, the precision of the model, and returned as stored so a vector does not depend on the cache state
+        # Not encoded with the codec, raw floats are already compact and do not compress
+        vector = array("f", res)
+        self._embeddings_lru.set(cache_key, vector)
+        await self.cache.set_bytes(
+            cache_key,
+            vector.tobytes(),
+            self.EMBEDDING_CACHE_TTL_SECS,
+        )
+        return vector.tolist()
+
+    async def vectors_from_texts(self, prompts: List[str]) -> List[List[float]]:
+        _logger.debug(f"Getting vectors for {len(prompts)} texts")
+        return await self.embeddings.aembed_documents(prompts)
 
     async def completion(
         self,
         message: MessageModel,
         template: str,
         language: str,
-        message_callback: Callable[[str], None],
-        usage_callback: Callable[[int, str], None],
+        user_id: UUID,
+        message_callback: Callable[[str], Awaitable[None]],
+        usage_callback: Callable[[int, str], Awaitable[None]],
     ) -> None:
         builder = PromptTemplate(
             template=template, input_variables=["query", "language"]
@@ -231,29 +403,44 @@ class OpenAI:
         prompt = builder.format(query=message.content, language=language)
         _logger.debug(f"Asking completion with prompt: {prompt}")
 
+        # Secret messages are not shared with other users
+        semantic_cache = self.semantic_cache if not message.secret else None
+        if semantic_cache:
+            # The same query gets a different answer from another template or language
+            # Cryptographic digest, a crafted language must not collide with another scope
+            digest = hashlib.blake2b(digest_size=32)
+            digest.update(template.encode("utf-8"))
+            digest.update(b"\0")
+            digest.update(language.encode("utf-8"))
+            scope = digest.hexdigest()
+            vector = await self.vector_from_text(message.content)
+            res = await semantic_cache.lookup(
+                vector, scope, self.semantic_cache_threshold
+            )
+            self._semantic_lookups.add(1, {"result": "hit" if res else "miss"})
+            if res:
+                await message_callback(res)
+                return
+
         with get_openai_callback() as cb:
-            message_callback(self.chat.predict(prompt))
-            usage_callback(cb.total_tokens, self.chat.model_name)
-
-    @retry(
-        reraise=True,
-        retry=(
-            retry_if_result(
-                lambda res: res == "Agent stopped due to iteration limit or time limit."
+            # LLM is synchronous, run it in a worker to not block the event loop
+            res = await self.worker.run(user_id, self.chat.predict, prompt)
+            await message_callback(res)
+            await usage_callback(cb.total_tokens, self.chat.model_name)
+
+        if semantic_cache:
+            await semantic_cache.update(
+                vector, scope, res, self.semantic_cache_ttl_secs
             )
-            | retry_if_exception_type((InvalidRequestError, APIError))
-        ),
-        stop=stop_after_attempt(3),
-        wait=wait_random_exponential(multiplier=0.5, max=30),
-    )
+
     async def chain(
         self,
         message: MessageModel,
         conversation: StoredConversationModel,
         current_user: UserModel,
         language: str,
-        message_callback: Callable[[StreamMessageModel], None],
-        usage_callback: Callable[[int, str], None],
+        message_callback: Callable[[StreamMessageModel], Awaitable[None]],
+        usage_callback: Callable[[int, str], Awaitable[None]],
     ) -> None:
         message_history = CustomHistory(
             conversation_id=conversation.id,
@@ -261,12 +448,7 @@ class OpenAI:
             store=self.store,
             user_id=current_user.id,
         )
-        # Also can use ConversationSummaryBufferMemory, which can be used to summarize the conversation if it is too long
-        memory = ConversationBufferMemory(
-            chat_memory=message_history,
-            memory_key="chat_history",
-            return_messages=True,
-        )
+        memory = self._memory(message_history, conversation.summary)
         readonly_memory = ReadOnlySharedMemory(memory=memory)
         tools = [
             *self.tools,
@@ -274,8 +456,9 @@ class OpenAI:
                 func=lambda q: str(
                     [
                         f'{answer.data.role}, {sanitize(answer.data.content) or "No content"}'
-                        for answer in self.search.message_search(
-                            q, current_user.id, 5
+                        for answer in run_in_loop(
+                            self._loop,
+                            self.search.message_search(q, current_user.id, 5),
                         ).answers
                     ]
                 )[: int(self.gpt_max_tokens)],
@@ -319,14 +502,140 @@ class OpenAI:
 
         def on_agent_action(action: AgentAction, **kwargs):
             if action.tool != "_Exception":
-                message_callback(StreamMessageModel(action=action.tool))
+                run_in_loop(
+                    self._loop, message_callback(StreamMessageModel(action=action.tool))
+                )
+
+        def on_final_answer(content: str) -> None:
+            run_in_loop(
+                self._loop, message_callback(StreamMessageModel(content=content))
+            )
+
+        streaming = CustomStreamingHandler(on_final_answer)
+
+        # Not retried once the answer started streaming, the client would receive it twice
+        @retry(
+            reraise=True,
+            retry=(
+                retry_if_result(
+                    lambda res: not streaming.content
+                    and res == "Agent stopped due to iteration limit or time limit."
+                )
+                | retry_if_exception(
+                    lambda e: not streaming.content
+                    and isinstance(e, (InvalidRequestError, APIError))
+                )
+            ),
+            stop=stop_after_attempt(3),
+            wait=wait_random_exponential(multiplier=0.5, max=30),
+        )
+        async def run() -> str:
+            # Agent is synchronous, run it in a worker to not block the event loop
+            return await self.worker.run(
+                current_user.id,
+                agent.run,
+                callbacks=[streaming],
+                input=message.content,
+                language=language,
+            )
 
         with get_openai_callback() as cb:
             cb.on_agent_action = on_agent_action
-            res = agent.run(input=message.content, language=language)
+            res = await run()
             _logger.debug(f"Agent response: {res}")
-            message_callback(StreamMessageModel(content=res))
-            usage_callback(cb.total_tokens, self.chat.model_name)
+            # Send the part of the answer not streamed (cached LLM response, answer not formatted as JSON, ...)
+            if res.startswith(streaming.content):
+                remaining = res[len(streaming.content) :]
+                if remaining:
+                    await message_callback(StreamMessageModel(content=remaining))
+            else:
+                # Streamed answer was discarded by the agent (parsing error, ...), the response replaces it
+                _logger.warn("Streamed final answer differs from the agent response")
+                await message_callback(StreamMessageModel(content=res, reset=True))
+            await usage_callback(cb.total_tokens, self.chat.model_name)
+
+        _logger.debug(
+            f"Completion read the history {message_history.store_reads} times from the store"
+        )
+        self._history_reads.record(message_history.store_reads)
+
+    async def summary_update(
+        self,
+        conversation: StoredConversationModel,
+        usage_callback: Callable[[int, str], Awaitable[None]],
+    ) -> None:
+        """
+        Fold the messages which left the memory window into the conversation summary.
+
+        Summary is updated incrementally, from the previous summary and the messages not folded yet. Secret messages are never summarized, as the summary does not expire.
+        """
+        messages = await self.store.message_list(conversation.id) or []
+        memory = self._memory(
+            CustomHistory(
+                conversation_id=conversation.id,
+                secret=False,
+                store=self.store,
+                user_id=conversation.user_id,
+            ),
+            conversation.summary,
+        )
+        start = memory.window_start([CustomHistory.parse(m) for m in messages])
+        folded = [
+            m
+            for m in messages[:start]
+            if not conversation.summary_until
+            or m.created_at > conversation.summary_until
+        ]
+        if not folded:
+            return
+
+        summary = conversation.summary
+        new_lines = [CustomHistory.parse(m) for m in folded if not m.secret]
+        if new_lines:
+            _logger.debug(
+                f"Folding {len(new_lines)} messages in the summary of conversation {conversation.id}"
+            )
+            chain = LLMChain(llm=self.chat, prompt=SUMMARY_PROMPT)
+            with get_openai_callback() as cb:
+                # LLM is synchronous, run it in a worker to not block the event loop
+                summary = await self.worker.run(
+                    conversation.user_id,
+                    chain.predict,
+                    new_lines=get_buffer_string(new_lines),
+                    summary=summary or "",
+                )
+                await usage_callback(cb.total_tokens, self.chat.model_name)
+
+        summary_until = folded[-1].created_at
+        if (
+            summary == conversation.summary
+            and summary_until == conversation.summary_until
+        ):
+            return
+        await self.store.conversation_summary_set(
+            conversation.id, conversation.user_id, summary, summary_until
+        )
+
+    def _memory(
+        self, history: BaseChatMessageHistory, summary: Optional[str]
+    ) -> "CustomMemory":
+        return CustomMemory(
+            chat_memory=history,
+            max_tokens=self.memory_max_tokens,
+            max_turns=self.memory_max_turns,
+            memory_key="chat_history",
+            model_name=self.chat.model_name,
+            summary=summary,
+        )
+
+    def _normalize(self, prompt: str) -> str:
+        # Unicode compatibility forms, case and whitespaces are not significant
+        return " ".join(unicodedata.normalize("NFKC", prompt).casefold().split())
+
+    def _embedding_key(self, prompt: str) -> str:
+        # Cryptographic digest, a crafted text must not collide with the one of another user
+        digest = hashlib.blake2b(prompt.encode("utf-8"), digest_size=32)
+        return f"{self._embeddings_prefix}:{digest.hexdigest()}"
 
     async def _refresh_token_background(self):
         """
@@ -352,39 +661,74 @@ class OpenAI:
 
 
 class CustomCache(BaseCache):
+    """
+    LangChain calls the cache synchronously, from the threads the LLMs are executed in.
+
+    Keys are a digest of the prompt and the LLM parameters, so a lookup costs the same whatever the prompt size. Values are encoded with the codec, entries larger than the max size are not cached. Entries written before the codec are invalid, and treated as misses.
+    """
+
+    _loop: asyncio.AbstractEventLoop
     PREFIX = "prompt"
     cache: ICache
+    max_bytes: int
 
     def __init__(self, cache: ICache):
+        self._loop = asyncio.get_running_loop()
         self.cache = cache
+        self.max_bytes = get_config(
+            ["ai", "openai"], "llm_cache_max_bytes", int, default=16384
+        )
+
+        # Metrics
+        self._bytes = _meter.create_histogram(
+            description="Size of the LLM cache entries, encoded.",
+            name="llm.cache.size",
+            unit="By",
+        )
+        self._hits = _meter.create_counter(
+            description="Number of LLM calls served from cache.",
+            name="llm.cache.hit",
+        )
+        self._misses = _meter.create_counter(
+            description="Number of LLM calls not in cache.",
+            name="llm.cache.miss",
+        )
+        self._skips = _meter.create_counter(
+            description="Number of LLM responses not cached, as larger than the max size.",
+            name="llm.cache.skip",
+        )
 
     def lookup(self, prompt: str, llm_string: str) -> Optional[List[ChatGeneration]]:
-        raws = self.cache.hget(self._key(prompt, llm_string))
-        if not raws:
-            return None
         generations = []
-        for json, role_str in raws.items():
-            _logger.debug(f"Loading cached message: {json}")
-            try:
+        try:
+            # Entries written before the codec are not valid text, reading them raises
+            raw = run_in_loop(self._loop, self.cache.get(self._key(prompt, llm_string)))
+            messages = (
+                decode(raw, List[Tuple[MessageRole, Dict[str, Any]]]) if raw else []
+            )
+            for role_enum, data in messages:
                 message = None
-                role_enum = MessageRole(role_str)
                 if role_enum == MessageRole.ASSISTANT:
-                    message = AIMessage.parse_raw(json)
+                    message = AIMessage.parse_obj(data)
                 elif role_enum == MessageRole.USER:
-                    message = HumanMessage.parse_raw(json)
+                    message = HumanMessage.parse_obj(data)
                 else:
                     _logger.warn(f"Unsupported message role: {role_enum}")
                 if message:
                     generations.append(ChatGeneration(message=message))
-            except Exception:
-                _logger.warn("Error parsing cached messages", exc_info=True)
+        except Exception:
+            _logger.warn("Error reading cached messages", exc_info=True)
         _logger.debug(f"Loaded generations from cache: {generations}")
-        return generations if generations else None
+        if not generations:
+            self._misses.add(1)
+            return None
+        self._hits.add(1)
+        return generations
 
     def update(
         self, prompt: str, llm_string: str, return_val: List[ChatGeneration]
     ) -> None:
-        messages = {}
+        messages = []
         for generation in return_val:
             message = generation.message
             if not message:
@@ -398,49 +742,85 @@ class CustomCache(BaseCache):
             else:
                 _logger.warn(f"Unsupported message type: {type(message)}")
             if role_enum:
-                messages[message.json()] = role_enum.value
-        if messages:
-            _logger.debug(f"Updating cache with messages: {messages}")
-            self.cache.hset(
-                self._key(prompt, llm_string),
-                messages,
-            )
+                messages.append((role_enum.value, message.dict()))
+        if not messages:
+            return
+        _logger.debug(f"Updating cache with messages: {messages}")
+        raw = encode(messages)
+        size = len(raw) if isinstance(raw, bytes) else len(raw.encode("utf-8"))
+        self._bytes.record(size)
+        if size > self.max_bytes:
+            _logger.debug(f"LLM cache entry too large ({size} bytes), skipping")
+            self._skips.add(1)
+            return
+        run_in_loop(
+            self._loop,
+            self.cache.set(self._key(prompt, llm_string), raw),
+        )
 
     def clear(self, **kwargs: Any) -> None:
         # Clear not implemented, we don't want to clear storage layer
         pass
 
     def _key(self, prompt: str, llm_string: str) -> str:
-        return f"{self.PREFIX}:{prompt}:{llm_string}"
+        # Cryptographic digest, a crafted prompt must not collide with the one of another user
+        digest = hashlib.blake2b(digest_size=32)
+        digest.update(prompt.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(llm_string.encode("utf-8"))
+        return f"{self.PREFIX}:{digest.hexdigest()}"
 
 
 class CustomHistory(BaseChatMessageHistory):
+    """
+    LangChain reads the history synchronously, from the thread the agent is executed in.
+
+    History is read on each agent step. It is loaded once, then kept as a snapshot for the lifetime of the object, which is one run. Messages added by the run are appended to the snapshot.
+    """
+
+    _loop: asyncio.AbstractEventLoop
+    _snapshot: Optional[List[BaseMessage]]
     conversation_id: UUID
     secret: bool
     store: IStore
+    store_reads: int
     user_id: UUID
 
     def __init__(
         self, conversation_id: UUID, secret: bool, store: IStore, user_id: UUID
     ):
+        self._loop = asyncio.get_running_loop()
+        self._snapshot = None
         self.conversation_id = conversation_id
         self.secret = secret
         self.store = store
+        self.store_reads = 0
         self.user_id = user_id
 
     @property
     def messages(self) -> List[BaseMessage]:
-        res = []
-        for message in self.store.message_list(self.conversation_id) or []:
-            if message.role == MessageRole.ASSISTANT:
-                obj = AIMessage(content=message.content, **message.extra)
-            elif message.role == MessageRole.USER:
-                obj = HumanMessage(content=message.content, **message.extra)
-            else:
-                raise ValueError(f"Unsupported message role: {message.role}")
-            res.append(obj)
-        _logger.debug(f"Loaded messages: {res}")
-        return res
+        if self._snapshot is None:
+            self.store_reads += 1
+            self._snapshot = [
+                self.parse(message)
+                for message in (
+                    run_in_loop(
+                        self._loop, self.store.message_list(self.conversation_id)
+                    )
+                    or []
+                )
+            ]
+            _logger.debug(f"Loaded messages: {self._snapshot}")
+        # Copy, so the snapshot is not altered by the caller
+        return list(self._snapshot)
+
+    @staticmethod
+    def parse(message: MessageModel) -> BaseMessage:
+        if message.role == MessageRole.ASSISTANT:
+            return AIMessage(content=message.content, **message.extra)
+        elif message.role == MessageRole.USER:
+            return HumanMessage(content=message.content, **message.extra)
+        raise ValueError(f"Unsupported message role: {message.role}")
 
     def add_message(self, message: BaseMessage) -> None:
         if isinstance(message, AIMessage):
@@ -450,7 +830,7 @@ class CustomHistory(BaseChatMessageHistory):
         else:
             raise ValueError(f"Unsupported message type: {type(message)}")
 
-        self.store.message_set(
+        self._message_set(
             StoredMessageModel(
                 content=message.content,
                 conversation_id=self.conversation_id,
@@ -461,7 +841,7 @@ class CustomHistory(BaseChatMessageHistory):
         )
 
     def add_user_message(self, message: str) -> None:
-        self.store.message_set(
+        self._message_set(
             StoredMessageModel(
                 content=message,
                 role=MessageRole.USER,
@@ -471,7 +851,7 @@ class CustomHistory(BaseChatMessageHistory):
         )
 
     def add_ai_message(self, message: str) -> None:
-        self.store.message_set(
+        self._message_set(
             StoredMessageModel(
                 content=message,
                 role=MessageRole.ASSISTANT,
@@ -483,3 +863,202 @@ class CustomHistory(BaseChatMessageHistory):
     def clear(self) -> None:
         # Clear not implemented, we don't want to clear storage layer
         pass
+
+    def _message_set(self, message: StoredMessageModel) -> None:
+        run_in_loop(self._loop, self.store.message_set(message))
+        if self._snapshot is not None:
+            self._snapshot.append(self.parse(message))
+
+
+class CustomMemory(BaseMemory):
+    """
+    Keep the latest turns verbatim, within a token budget, preceded by the summary of the older ones.
+
+    LangChain reads the memory on each agent step, so the prompt size is bounded whatever the conversation length. The summary is updated after the completion, see "OpenAI.summary_update".
+    """
+
+    MESSAGE_OVERHEAD_TOKENS: ClassVar[int] = 4  # Role and separators
+    chat_memory: BaseChatMessageHistory
+    max_tokens: int
+    max_turns: int
+    memory_key: str
+    model_name: str
+    summary: Optional[str] = None
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        messages = self.chat_memory.messages
+        window = messages[self.window_start(messages) :]
+        if self.summary:
+            window = [
+                SystemMessage(
+                    content=f"Summary of the previous messages: {self.summary}"
+                ),
+                *window,
+            ]
+        return {self.memory_key: window}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        # Messages are persisted by the API, not by the agent
+        pass
+
+    def clear(self) -> None:
+        # Clear not implemented, we don't want to clear storage layer
+        pass
+
+    def window_start(self, messages: List[BaseMessage]) -> int:
+        """
+        Index of the oldest message kept verbatim.
+
+        Window always starts with a user message, so a turn is never split. Messages are read from the latest, until the max turns or the max tokens is reached. Latest turn is kept whatever its size.
+        """
+        encoding = _encoding(self.model_name)
+        start = len(messages)
+        tokens = 0
+        turns = 0
+        for i in range(len(messages) - 1, -1, -1):
+            message = messages[i]
+            tokens += (
+                len(encoding.encode(message.content, disallowed_special=()))
+                + self.MESSAGE_OVERHEAD_TOKENS
+            )
+            is_over_budget = tokens > self.max_tokens
+            # Latest turn is always kept, even if it is over the budget alone
+            if is_over_budget and start < len(messages):
+                break
+            if isinstance(message, HumanMessage):
+                turns += 1
+                if turns > self.max_turns and start < len(messages):
+                    break
+                start = i
+                if is_over_budget:
+                    break
+        return start
+
+
+class CustomStreamingHandler(BaseCallbackHandler):
+    """
+    Stream the agent final answer, token by token, as it is generated by the LLM.
+
+    The conversational agent answers with a JSON object. Tokens are emitted only once the "Final Answer" action is detected, and until the end of the "action_input" string. Tokens are grouped in batches, bounded in size and time, to limit the number of messages sent to the stream.
+    """
+
+    BATCH_MAX_CHARS: int = 50
+    BATCH_MAX_SECS: float = 0.1  # 100 ms
+    ESCAPES: Dict[str, str] = {
+        '"': '"',
+        "/": "/",
+        "\\": "\\",
+        "b": "\b",
+        "f": "\f",
+        "n": "\n",
+        "r": "\r",
+        "t": "\t",
+    }
+    FINAL_ANSWER_PATTERN = re.compile(
+        r'"action"\s*:\s*"Final Answer"\s*,\s*"action_input"\s*:\s*"'
+    )
+    content: str
+    _batch: str
+    _batch_start: float
+    _callback: Callable[[str], None]
+    _runs: Dict[UUID, Dict[str, Any]]
+
+    def __init__(self, callback: Callable[[str], None]):
+        self._batch = ""
+        self._batch_start = 0
+        self._callback = callback
+        self._runs = {}
+        self.content = ""
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.setdefault(
+            run_id, {"buffer": "", "done": False, "pending": None}
+        )
+        if run["done"]:
+            return
+
+        if run["pending"] is None:
+            # Wait for the final answer to start
+            run["buffer"] += token
+            match = self.FINAL_ANSWER_PATTERN.search(run["buffer"])
+            if not match:
+                return
+            _logger.debug("Final answer detected, starting streaming")
+            run["pending"] = run["buffer"][match.end() :]
+        else:
+            run["pending"] += token
+
+        content, run["pending"], run["done"] = self._decode(run["pending"])
+        self._add(content)
+        if run["done"]:
+            self._flush()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        self._runs.pop(run_id, None)
+        self._flush()
+
+    def on_llm_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._runs.pop(run_id, None)
+        self._flush()
+
+    def _add(self, content: str) -> None:
+        if not content:
+            return
+        if not self._batch:
+            self._batch_start = time.monotonic()
+        self._batch += content
+        if (
+            len(self._batch) >= self.BATCH_MAX_CHARS
+            or time.monotonic() - self._batch_start >= self.BATCH_MAX_SECS
+        ):
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, ""
+        self.content += batch
+        self._callback(batch)
+
+    def _decode(self, raw: str) -> Tuple[str, str, bool]:
+        """
+        Decode a partial JSON string, until its closing quote.
+
+        Returns the decoded content, the raw characters not decoded yet (incomplete escape sequence), and if the string is closed.
+        """
+        res = ""
+        i = 0
+        while i < len(raw):
+            char = raw[i]
+            if char == '"':
+                return res, "", True
+            if char != "\\":
+                res += char
+                i += 1
+                continue
+            if i + 1 >= len(raw):
+                break
+            escape = raw[i + 1]
+            if escape == "u":
+                # Surrogate pairs are encoded as two consecutive sequences
+                is_high_surrogate = raw[i + 2 : i + 4].lower() in (
+                    "d8",
+                    "d9",
+                    "da",
+                    "db",
+                )
+                length = 12 if is_high_surrogate else 6
+                if i + length > len(raw):
+                    break
+                res += try_or_none(json.loads, f'"{raw[i : i + length]}"') or ""
+                i += length
+                continue
+            res += self.ESCAPES.get(escape, escape)
+            i += 2
+        return res, raw[i:], False
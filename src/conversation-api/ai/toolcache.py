@@ -0,0 +1,157 @@
+# Import utils
+from utils import build_logger, build_meter, get_config, run_in_loop
+
+# Import misc
+from concurrent.futures import Future
+from langchain.tools.base import BaseTool, Tool
+from persistence.codec import decode, encode
+from persistence.icache import ICache
+from typing import Dict
+import asyncio
+import functools
+import hashlib
+import threading
+import time
+import unicodedata
+
+
+###
+# Init misc
+###
+
+_logger = build_logger(__name__)
+_meter = build_meter(__name__)
+
+###
+# Init config
+###
+
+TOOL_CACHE_DEFAULT_TTL_SECS = get_config(
+    ["tools", "cache"], "default_ttl_secs", int, default=60 * 60
+)
+TOOL_CACHE_MAX_BYTES = get_config(["tools", "cache"], "max_bytes", int, default=65536)
+# Lower than the agent execution time, a call in progress may hang
+TOOL_CACHE_WAIT_SECS = get_config(["tools", "cache"], "wait_secs", int, default=30)
+# Per tool TTL, by tool name, 0 disables the cache for the tool
+TOOL_CACHE_TTL_SECS = {
+    "News API": 15 * 60,  # News are published continuously
+    "OpenWeatherMap": 10 * 60,  # Forecasts are updated often
+    **get_config(["tools", "cache"], "ttl_secs", dict, default={}),
+}
+
+
+class ToolCache:
+    """
+    Cache the results of the agent tools, by tool name and normalized input, in the shared cache.
+
+    LangChain calls the tools synchronously, from the threads the agents are executed in. Concurrent calls with the same input share the upstream call of the first one, or call the tool themselves if it takes too long. Results are encoded with the codec. Errors and empty results are not cached, neither are results larger than the max size.
+    """
+
+    PREFIX = "tool"
+    _inflight: Dict[str, Future]
+    _lock: threading.Lock
+    _loop: asyncio.AbstractEventLoop
+    cache: ICache
+
+    def __init__(self, cache: ICache):
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._loop = asyncio.get_running_loop()
+        self.cache = cache
+
+        # Metrics
+        self._duration = _meter.create_histogram(
+            description="Time to get a tool result, by tool and result.",
+            name="tool.duration",
+            unit="ms",
+        )
+        self._lookups = _meter.create_counter(
+            description="Number of tool calls, by tool and result (hit, miss, shared, timeout).",
+            name="tool.cache.lookup",
+        )
+
+    def wrap(self, tool: BaseTool) -> BaseTool:
+        """
+        Return a tool with the same name and description, which results are cached. Tool is returned as is if its TTL is 0.
+        """
+        ttl_secs = TOOL_CACHE_TTL_SECS.get(tool.name, TOOL_CACHE_DEFAULT_TTL_SECS)
+        if not ttl_secs:
+            _logger.debug(f'Cache disabled for tool "{tool.name}"')
+            return tool
+        return Tool(
+            description=tool.description,
+            func=functools.partial(self._run, tool, ttl_secs),
+            name=tool.name,
+            return_direct=tool.return_direct,
+        )
+
+    def _run(self, tool: BaseTool, ttl_secs: int, query: str) -> str:
+        start = time.monotonic()
+        key = self._key(tool.name, query)
+        result = "miss"
+        try:
+            # Shared cache, entries written before the codec are invalid, and treated as misses
+            cached = None
+            try:
+                raw = run_in_loop(self._loop, self.cache.get(key))
+                if raw:
+                    cached = decode(raw, str)
+            except Exception:
+                _logger.warn("Error reading tool result from cache", exc_info=True)
+            if cached:
+                result = "hit"
+                return cached
+
+            # Single-flight, the first caller calls the tool, the others wait for its result
+            with self._lock:
+                future = self._inflight.get(key)
+                is_leader = future is None
+                if is_leader:
+                    future = Future()
+                    self._inflight[key] = future
+            if not is_leader:
+                try:
+                    res = future.result(timeout=TOOL_CACHE_WAIT_SECS)
+                    result = "shared"
+                    return res
+                except TimeoutError:
+                    _logger.warn(
+                        f'Call in progress of tool "{tool.name}" timed out, calling it directly'
+                    )
+                    result = "timeout"
+                    return tool.run(query)
+
+            try:
+                res = tool.run(query)
+                if isinstance(res, str) and res:
+                    self._set(key, res, ttl_secs)
+                future.set_result(res)
+                return res
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        finally:
+            attributes = {"result": result, "tool": tool.name}
+            self._duration.record((time.monotonic() - start) * 1000, attributes)
+            self._lookups.add(1, attributes)
+
+    def _set(self, key: str, value: str, ttl_secs: int) -> None:
+        raw = encode(value)
+        size = len(raw) if isinstance(raw, bytes) else len(raw.encode("utf-8"))
+        if size > TOOL_CACHE_MAX_BYTES:
+            _logger.debug(f"Tool result too large ({size} bytes), skipping")
+            return
+        try:
+            run_in_loop(self._loop, self.cache.set(key, raw, ttl_secs))
+        except Exception:
+            # Result is still returned to the agent
+            _logger.warn("Error caching tool result", exc_info=True)
+
+    def _key(self, name: str, query: str) -> str:
+        # Unicode compatibility forms and whitespaces are not significant, case is (URLs, IDs)
+        normalized = " ".join(unicodedata.normalize("NFKC", query).split())
+        digest = hashlib.blake2b(normalized.encode("utf-8"), digest_size=32)
+        return f"{self.PREFIX}:{name}:{digest.hexdigest()}"
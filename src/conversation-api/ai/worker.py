@@ -0,0 +1,109 @@
+# Import utils
+from utils import build_logger, build_meter, get_config
+
+# Import misc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+from uuid import UUID
+import asyncio
+import contextvars
+import functools
+import time
+
+
+###
+# Init misc
+###
+
+_logger = build_logger(__name__)
+_meter = build_meter(__name__)
+
+###
+# Init config
+###
+
+WORKER_MAX_PER_USER = get_config(["ai", "worker"], "max_per_user", int, default=2)
+WORKER_MAX_WORKERS = get_config(["ai", "worker"], "max_workers", int, default=32)
+
+
+class WorkerPool:
+    """
+    Run blocking functions (LangChain agents, LLM calls) in a dedicated thread pool, so the event loop keeps serving requests.
+
+    Calls are queued until both a slot for the user and a global slot are free. The user slot is acquired first, so a user with many pending calls does not hold global slots.
+    """
+
+    _executor: ThreadPoolExecutor
+    _global_limit: asyncio.Semaphore
+    _loop: asyncio.AbstractEventLoop
+    _max_per_user: int
+    _user_limits: Dict[UUID, asyncio.Semaphore]
+    _user_pending: Dict[UUID, int]
+
+    def __init__(
+        self,
+        max_workers: int = WORKER_MAX_WORKERS,
+        max_per_user: int = WORKER_MAX_PER_USER,
+    ):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="worker"
+        )
+        self._global_limit = asyncio.Semaphore(max_workers)
+        self._loop = asyncio.get_running_loop()
+        self._max_per_user = max_per_user
+        self._user_limits = {}
+        self._user_pending = {}
+
+        # Metrics
+        self._queue_depth = _meter.create_up_down_counter(
+            description="Number of calls waiting for a worker.",
+            name="worker.queue.depth",
+        )
+        self._queue_wait = _meter.create_histogram(
+            description="Time spent by a call waiting for a worker.",
+            name="worker.queue.wait",
+            unit="ms",
+        )
+        self._running = _meter.create_up_down_counter(
+            description="Number of calls running in a worker.",
+            name="worker.running",
+        )
+
+        _logger.info(
+            f"Worker pool initialized (max_workers={max_workers}, max_per_user={max_per_user})"
+        )
+
+    async def run(
+        self, user_id: UUID, func: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> Any:
+        # Context is copied, so context variables (like LangChain callbacks) are available in the thread
+        call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        user_limit = self._user_limits.setdefault(
+            user_id, asyncio.Semaphore(self._max_per_user)
+        )
+        self._user_pending[user_id] = self._user_pending.get(user_id, 0) + 1
+        is_queued = True
+        queued_at = time.monotonic()
+        self._queue_depth.add(1)
+
+        try:
+            async with user_limit, self._global_limit:
+                is_queued = False
+                self._queue_depth.add(-1)
+                wait = time.monotonic() - queued_at
+                self._queue_wait.record(wait * 1000)
+                _logger.debug(f"Worker acquired for user {user_id} after {wait:.3f}s")
+
+                self._running.add(1)
+                try:
+                    return await self._loop.run_in_executor(self._executor, call)
+                finally:
+                    self._running.add(-1)
+        finally:
+            if is_queued:  # Cancelled while waiting
+                self._queue_depth.add(-1)
+            self._user_pending[user_id] -= 1
+            if not self._user_pending[user_id]:
+                # No more calls for this user, free the memory
+                self._user_pending.pop(user_id)
+                self._user_limits.pop(user_id)
@@ -0,0 +1,80 @@
+# Import utils
+from utils import build_logger
+
+# Import misc
+from datetime import datetime, timedelta
+from models.message import MessageModel, MessageRole
+from persistence.codec import CodecFormat, decode, encode
+from typing import List
+import random
+import time
+
+
+###
+# Init misc
+###
+
+_logger = build_logger(__name__)
+
+ITERATIONS = 200
+SIZES = (10, 100, 1000)
+WORDS = "the quick brown fox jumps over a lazy dog while assistant explains python async redis cosmos".split()
+
+
+def _messages(count: int) -> List[MessageModel]:
+    """
+    Conversation with alternating user and assistant messages, of realistic lengths.
+    """
+    start = datetime.utcnow()
+    return [
+        MessageModel(
+            actions=["bing-search"] if i % 5 == 1 else None,
+            content=" ".join(
+                random.choices(WORDS, k=random.randint(10, 60) if i % 2 else 300)
+            ),
+            created_at=start + timedelta(seconds=i),
+            role=MessageRole.ASSISTANT if i % 2 else MessageRole.USER,
+            secret=False,
+        )
+        for i in range(count)
+    ]
+
+
+def main() -> None:
+    """
+    Compare encode and decode throughput, and payload size, of the codec formats on message lists.
+    """
+    random.seed(0)
+    variants = [
+        ("json", CodecFormat.JSON, None),
+        ("orjson", CodecFormat.ORJSON, None),
+        ("orjson+zstd", CodecFormat.ORJSON, 1),
+        ("msgpack", CodecFormat.MSGPACK, None),
+        ("msgpack+zstd", CodecFormat.MSGPACK, 1),
+    ]
+    print(
+        f"{'messages':>8} {'codec':<13} {'bytes':>9} {'encode/s':>10} {'decode/s':>10}"
+    )
+    for size in SIZES:
+        messages = _messages(size)
+        iterations = max(1, ITERATIONS * 10 // size)
+        for name, codec_format, zstd_min_bytes in variants:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                raw = encode(messages, codec_format, zstd_min_bytes)
+            encode_secs = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(iterations):
+                decoded = decode(raw, List[MessageModel])
+            decode_secs = time.perf_counter() - start
+
+            if decoded != messages:
+                _logger.error(f"Codec {name} does not round-trip")
+            print(
+                f"{size:>8} {name:<13} {len(raw):>9} {iterations / encode_secs:>10.1f} {iterations / decode_secs:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Import utils
+from utils import build_logger, get_config
+
+# Import misc
+from persistence.icache import CacheImplementation
+from persistence.isearch import SearchImplementation
+from persistence.istore import StoreImplementation
+import asyncio
+
+
+###
+# Init misc
+###
+
+_logger = build_logger(__name__)
+
+
+async def main() -> None:
+    """
+    Add the user ID to the messages indexed before it was stored in the index.
+
+    Can be run while the API is serving requests, and resumed if interrupted.
+    """
+    # Cache
+    cache_impl = get_config("persistence", "cache", CacheImplementation, required=True)
+    if cache_impl == CacheImplementation.REDIS:
+        from persistence.redis import RedisCache
+
+        cache = RedisCache()
+    else:
+        raise ValueError(f"Unknown cache implementation: {cache_impl}")
+
+    # Store
+    store_impl = get_config("persistence", "store", StoreImplementation, required=True)
+    if store_impl == StoreImplementation.COSMOS:
+        from persistence.cosmos import CosmosStore
+
+        store = CosmosStore(cache)
+    elif store_impl == StoreImplementation.CACHE:
+        from persistence.cache import CacheStore
+
+        store = CacheStore(cache)
+    else:
+        raise ValueError(f"Unknown store implementation: {store_impl}")
+
+    # Search
+    search_impl = get_config(
+        "persistence", "search", SearchImplementation, required=True
+    )
+    if search_impl == SearchImplementation.QDRANT:
+        from persistence.qdrant import backfill_user_id
+
+        total = await backfill_user_id(store, cache)
+    else:
+        raise ValueError(f"Unknown search implementation: {search_impl}")
+
+    _logger.info(f"Backfill done, {total} messages updated")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,6 +3,8 @@ from utils import (
     build_logger,
     get_config,
     hash_token,
+    JwksManager,
+    LRUCache,
     VerifyToken,
     VERSION,
 )
@@ -10,7 +12,8 @@ from utils import (
 # Import misc
 from ai.contentsafety import ContentSafety
 from ai.openai import OpenAI, CustomCache
-from fastapi import FastAPI, HTTPException, status, Request, Depends
+from datetime import date, datetime, timezone
+from fastapi import FastAPI, HTTPException, status, Request, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from models.conversation import (
@@ -27,20 +30,24 @@ from models.message import (
 from models.prompt import StoredPromptModel, ListPromptsModel
 from models.readiness import ReadinessModel, ReadinessCheckModel, ReadinessStatus
 from models.search import SearchModel
-from models.usage import UsageModel
+from models.usage import ListUsageRollupsModel, UsageModel
 from models.user import UserModel
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from persistence.icache import CacheImplementation
-from persistence.isearch import SearchImplementation
-from persistence.istore import StoreImplementation
-from persistence.istream import StreamImplementation
+from persistence.icache import CacheImplementation, ICache
+from persistence.isearch import ISearch, SearchImplementation
+from persistence.isemantic import ISemanticCache, SemanticCacheImplementation
+from persistence.istore import IStore, StoreImplementation
+from persistence.istream import IStream, StreamImplementation
+from persistence.usage import UsageBuffer
 from sse_starlette.sse import EventSourceResponse
-from typing import Annotated, Dict, List, Optional
+from typing import Annotated, Any, Dict, List, Optional, Tuple
 from uuid import UUID
 from uuid import uuid4
 import asyncio
 import csv
+import hashlib
 import langchain
+import time
 
 
 ###
@@ -48,86 +55,23 @@ import langchain
 ###
 
 _logger = build_logger(__name__)
-_loop = asyncio.get_running_loop()
 
 ###
-# Init persistence
+# Init persistence and Generative AI
 ###
 
-# Cache
-cache_impl = get_config("persistence", "cache", CacheImplementation, required=True)
-try:
-    if cache_impl == CacheImplementation.REDIS:
-        from persistence.redis import RedisCache
+# Built at startup, as they run background tasks in the event loop of the server
+cache: ICache
+content_safety: ContentSafety
+index: ISearch
+jwks: JwksManager
+openai: OpenAI
+semantic_cache: Optional[ISemanticCache]
+store: IStore
+stream: IStream
+usage_buffer: UsageBuffer
 
-        cache = RedisCache()
-    else:
-        raise ValueError(f"Unknown cache implementation: {cache_impl}")
-    _logger.info(f'Using "{type(cache).__name__}" as cache backend')
-except Exception as e:
-    _logger.error("Failed to initialize cache engine", exc_info=True)
-    exit(1)
-# Configure LangChain accordingly
-langchain.llm_cache = CustomCache(cache=cache)
-
-# Store
-store_impl = get_config("persistence", "store", StoreImplementation, required=True)
-try:
-    if store_impl == StoreImplementation.COSMOS:
-        from persistence.cosmos import CosmosStore
-
-        store = CosmosStore(cache)
-    elif store_impl == StoreImplementation.CACHE:
-        from persistence.cache import CacheStore
-
-        store = CacheStore(cache)
-    else:
-        raise ValueError(f"Unknown store implementation: {store_impl}")
-    _logger.info(f'Using "{type(store).__name__}" as store backend')
-except Exception as e:
-    _logger.error("Failed to initialize store engine", exc_info=True)
-    exit(1)
-
-###
-# Init Generative AI
-###
-
-openai = OpenAI(store)
-content_safety = ContentSafety()
-
-###
-# Init persistence
-###
-
-# Search
-search_impl = get_config("persistence", "search", SearchImplementation, required=True)
-try:
-    if search_impl == SearchImplementation.QDRANT:
-        from persistence.qdrant import QdrantSearch
-
-        index = QdrantSearch(store, cache, openai)
-    else:
-        raise ValueError(f"Unknown search implementation: {search_impl}")
-    _logger.info(f'Using "{type(index).__name__}" as search backend')
-except Exception as e:
-    _logger.error("Failed to initialize search engine", exc_info=True)
-    exit(1)
-# Configure OpenAI accordingly
-openai.search = index
-
-# Stream
-stream_impl = get_config("persistence", "stream", StreamImplementation, required=True)
-try:
-    if stream_impl == StreamImplementation.REDIS:
-        from persistence.redis import RedisStream
-
-        stream = RedisStream()
-    else:
-        raise ValueError(f"Unknown stream implementation: {stream_impl}")
-    _logger.info(f'Using "{type(stream).__name__}" as stream backend')
-except Exception as e:
-    _logger.error("Failed to initialize stream engine", exc_info=True)
-    exit(1)
+USAGE_MAX_DAYS = 366
 
 ###
 # Init FastAPI
@@ -151,6 +95,13 @@ api = FastAPI(
 )
 auth_scheme = HTTPBearer()
 
+# Verified tokens, with their claims and user, by token digest
+OIDC_ADMIN_ROLE = get_config("oidc", "admin_role", str, default="admin")
+OIDC_CACHE_SIZE = get_config("oidc", "cache_size", int, default=10000)
+_token_cache: LRUCache[bytes, Tuple[Dict[str, Any], UserModel]] = LRUCache(
+    max_size=OIDC_CACHE_SIZE
+)
+
 # Setup CORS
 api.add_middleware(
     CORSMiddleware,
@@ -159,6 +110,130 @@ api.add_middleware(
     allow_origins=["*"],
 )
 
+
+@api.on_event("startup")
+async def startup() -> None:
+    # Backends run background tasks, they are built in the event loop of the server, not at import
+    global cache, content_safety, index, jwks, openai, semantic_cache, store, stream, usage_buffer
+
+    # Cache
+    cache_impl = get_config("persistence", "cache", CacheImplementation, required=True)
+    try:
+        if cache_impl == CacheImplementation.REDIS:
+            from persistence.redis import RedisCache
+
+            cache = RedisCache()
+        else:
+            raise ValueError(f"Unknown cache implementation: {cache_impl}")
+        _logger.info(f'Using "{type(cache).__name__}" as cache backend')
+    except Exception as e:
+        _logger.error("Failed to initialize cache engine", exc_info=True)
+        exit(1)
+    # Configure LangChain accordingly
+    langchain.llm_cache = CustomCache(cache=cache)
+
+    # Store
+    store_impl = get_config("persistence", "store", StoreImplementation, required=True)
+    try:
+        if store_impl == StoreImplementation.COSMOS:
+            from persistence.cosmos import CosmosStore
+
+            store = CosmosStore(cache)
+        elif store_impl == StoreImplementation.CACHE:
+            from persistence.cache import CacheStore
+
+            store = CacheStore(cache)
+        else:
+            raise ValueError(f"Unknown store implementation: {store_impl}")
+        _logger.info(f'Using "{type(store).__name__}" as store backend')
+    except Exception as e:
+        _logger.error("Failed to initialize store engine", exc_info=True)
+        exit(1)
+
+    # Usage
+    usage_buffer = UsageBuffer(store, cache)
+
+    # Generative AI
+    openai = OpenAI(store, cache)
+    content_safety = ContentSafety()
+
+    # Search
+    search_impl = get_config(
+        "persistence", "search", SearchImplementation, required=True
+    )
+    try:
+        if search_impl == SearchImplementation.QDRANT:
+            from persistence.qdrant import QdrantSearch
+
+            index = QdrantSearch(store, cache, openai)
+        else:
+            raise ValueError(f"Unknown search implementation: {search_impl}")
+        _logger.info(f'Using "{type(index).__name__}" as search backend')
+    except Exception as e:
+        _logger.error("Failed to initialize search engine", exc_info=True)
+        exit(1)
+    # Configure OpenAI accordingly
+    openai.search = index
+
+    # Semantic cache, opt-in
+    # Read as text, an unset enum does not validate
+    semantic_cache_raw = get_config("persistence", "semantic_cache", str, default="")
+    try:
+        semantic_cache_impl = (
+            SemanticCacheImplementation(semantic_cache_raw)
+            if semantic_cache_raw
+            else None
+        )
+        if semantic_cache_impl == SemanticCacheImplementation.QDRANT:
+            from persistence.qdrant import QdrantSemanticCache
+
+            semantic_cache = QdrantSemanticCache()
+        elif semantic_cache_impl == SemanticCacheImplementation.NUMPY:
+            from persistence.numpy import NumpySemanticCache
+
+            semantic_cache = NumpySemanticCache()
+        elif semantic_cache_impl:
+            raise ValueError(
+                f"Unknown semantic cache implementation: {semantic_cache_impl}"
+            )
+        else:
+            semantic_cache = None
+        if semantic_cache:
+            _logger.info(
+                f'Using "{type(semantic_cache).__name__}" as semantic cache backend'
+            )
+    except Exception as e:
+        _logger.error("Failed to initialize semantic cache engine", exc_info=True)
+        exit(1)
+    # Configure OpenAI accordingly
+    openai.semantic_cache = semantic_cache
+
+    # Stream
+    stream_impl = get_config(
+        "persistence", "stream", StreamImplementation, required=True
+    )
+    try:
+        if stream_impl == StreamImplementation.REDIS:
+            from persistence.redis import RedisStream
+
+            stream = RedisStream()
+        else:
+            raise ValueError(f"Unknown stream implementation: {stream_impl}")
+        _logger.info(f'Using "{type(stream).__name__}" as stream backend')
+    except Exception as e:
+        _logger.error("Failed to initialize stream engine", exc_info=True)
+        exit(1)
+
+    # Auth
+    jwks = JwksManager()
+
+
+@api.on_event("shutdown")
+async def shutdown() -> None:
+    # Usage is buffered in memory, persist it before exiting
+    await usage_buffer.close()
+
+
 ###
 # Init Generative AI
 ###
@@ -259,14 +334,21 @@ async def health_readiness_get() -> ReadinessModel:
     return readiness
 
 
-async def get_current_user(
+async def get_current_session(
     token: Annotated[Optional[HTTPAuthorizationCredentials], Depends(auth_scheme)]
-) -> UserModel:
+) -> Tuple[Dict[str, Any], UserModel]:
     if not token:
         _logger.error("No token provided by Starlette framework")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    jwt = VerifyToken(token.credentials).verify()
+    # Same token was already verified, skip the signature check and the user lookup
+    # Cryptographic digest, a crafted token must not collide with a verified one
+    token_key = hashlib.sha256(token.credentials.encode("utf-8")).digest()
+    cached = _token_cache.get(token_key)
+    if cached:
+        return cached
+
+    jwt = await VerifyToken(token.credentials, jwks).verify()
     sub = jwt.get("sub")
 
     if not sub:
@@ -277,7 +359,7 @@ async def get_current_user(
     name = jwt.get("name")
     preferred_username = jwt.get("preferred_username")
 
-    user = store.user_get(sub)
+    user = await store.user_get(sub)
     if not user:
         user = UserModel(external_id=sub, id=uuid4())
     user_new = user.copy()
@@ -293,12 +375,36 @@ async def get_current_user(
 
     if user_new != user:
         _logger.debug(f"User {user.id} updated")
-        store.user_set(user_new)
+        await store.user_set(user_new)
         user = user_new
 
     _logger.info(f"User {user.id} ({user.preferred_username}) logged in")
     _logger.debug(f"JWT: {jwt}")
 
+    # Cache until the token expires, "exp" is required by the verification
+    ttl_secs = int(jwt["exp"]) - time.time()
+    if ttl_secs > 0:
+        _token_cache.set(token_key, (jwt, user), ttl_secs)
+
+    return jwt, user
+
+
+async def get_current_user(
+    session: Annotated[Tuple[Dict[str, Any], UserModel], Depends(get_current_session)]
+) -> UserModel:
+    return session[1]
+
+
+async def get_current_admin(
+    session: Annotated[Tuple[Dict[str, Any], UserModel], Depends(get_current_session)]
+) -> UserModel:
+    jwt, user = session
+    if OIDC_ADMIN_ROLE not in (jwt.get("roles") or []):
+        _logger.info(f"User {user.id} is not an admin")
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin role required",
+        )
     return user
 
 
@@ -307,36 +413,62 @@ async def prompt_list() -> ListPromptsModel:
     return ListPromptsModel(prompts=list(AI_PROMPTS.values()))
 
 
-@api.get("/conversation/{id}")
+@api.get(
+    "/conversation/{id}",
+    description="Only the latest messages are returned. Pass the messages_before of the response as before to get the older ones.",
+)
 async def conversation_get(
-    id: UUID, current_user: Annotated[UserModel, Depends(get_current_user)]
+    id: UUID,
+    current_user: Annotated[UserModel, Depends(get_current_user)],
+    before: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 50,
 ) -> GetConversationModel:
-    conversation = store.conversation_get(id, current_user.id)
+    conversation = await store.conversation_get(id, current_user.id)
     if not conversation:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Conversation not found",
         )
-    messages = store.message_list(conversation.id) or []
-    messages.sort(key=lambda x: x.created_at)  # Sort ASC
+    try:
+        cursor = _message_cursor_decode(before) if before else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid before",
+        )
+    messages, messages_before = await _message_page(conversation.id, limit, cursor)
     return GetConversationModel(
         **conversation.dict(),
         messages=messages,
+        messages_before=messages_before,
     )
 
 
-@api.get("/conversation")
+@api.get(
+    "/conversation",
+    description="Conversations are sorted from the most recent. Pass the continuation of the response to get the next page.",
+)
 async def conversation_list(
-    current_user: Annotated[UserModel, Depends(get_current_user)]
+    current_user: Annotated[UserModel, Depends(get_current_user)],
+    continuation: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 50,
 ) -> ListConversationsModel:
-    conversations = store.conversation_list(current_user.id) or []
-    conversations.sort(key=lambda x: x.created_at, reverse=True)  # Sort DESC
-    return ListConversationsModel(conversations=conversations)
+    try:
+        page = await store.conversation_list(current_user.id, limit, continuation)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid continuation",
+        )
+    return ListConversationsModel(
+        continuation=page.continuation,
+        conversations=page.conversations,
+    )
 
 
 @api.post(
     "/message",
-    description="Moderation check in place, as the content is persisted.",
+    description="Moderation check in place, as the content is persisted. Only the latest messages are returned, as for the conversation.",
 )
 async def message_post(
     content: str,
@@ -344,6 +476,7 @@ async def message_post(
     language: str,
     secret: bool = False,
     conversation_id: Optional[UUID] = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 50,
     prompt_id: Optional[UUID] = None,
 ) -> GetConversationModel:
     # TODO: Moderation fails to test messages longer than 1000 characters approx, that is a huge UX limitation
@@ -366,7 +499,7 @@ async def message_post(
         _logger.info(
             f"Adding message to conversation (conversation_id={conversation_id})"
         )
-        if not store.conversation_exists(conversation_id, current_user.id):
+        if not await store.conversation_exists(conversation_id, current_user.id):
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Conversation not found",
@@ -381,15 +514,15 @@ async def message_post(
         )
 
         # Update conversation
-        store.message_set(message)
-        conversation = store.conversation_get(conversation_id, current_user.id)
+        await store.message_set(message)
+        conversation = await store.conversation_get(conversation_id, current_user.id)
         if not conversation:
             _logger.warn("ACID error: conversation not found after testing existence")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Conversation not found",
             )
-        index.message_index(message)
+        index.message_index(message, current_user.id)
     else:
         # Test prompt ID if provided
         if prompt_id and prompt_id not in AI_PROMPTS:
@@ -403,7 +536,7 @@ async def message_post(
             prompt=AI_PROMPTS[prompt_id] if prompt_id else None,
             user_id=current_user.id,
         )
-        store.conversation_set(conversation)
+        await store.conversation_set(conversation)
 
         # Build message
         message = StoredMessageModel(
@@ -412,24 +545,25 @@ async def message_post(
             role=MessageRole.USER,
             secret=secret,
         )
-        store.message_set(message)
-        index.message_index(message)
+        await store.message_set(message)
+        index.message_index(message, current_user.id)
 
-    messages = store.message_list(conversation.id) or []
-    messages.sort(key=lambda x: x.created_at)  # Sort ASC
+    # Latest messages only, the new one included
+    messages, messages_before = await _message_page(conversation.id, limit)
 
     # Execute message completion in background
-    _loop.create_task(
+    asyncio.create_task(
         _generate_completion_background(conversation, messages, current_user, language)
     )
 
     if conversation.title is None:
         # Execute title completion in background
-        _loop.create_task(_guess_title_background(conversation, messages, language))
+        asyncio.create_task(_guess_title_background(conversation, messages, language))
 
     return GetConversationModel(
         **conversation.dict(),
         messages=messages,
+        messages_before=messages_before,
     )
 
 
@@ -471,11 +605,86 @@ async def _read_message_sse(req: Request, message_token: UUID):
 async def message_search(
     q: str, current_user: Annotated[UserModel, Depends(get_current_user)]
 ) -> SearchModel[MessageModel]:
-    messages = index.message_search(q, current_user.id, 25)
+    messages = await index.message_search(q, current_user.id, 25)
     messages.answers.sort(key=lambda x: x.score, reverse=True)  # Sort DESC
     return messages
 
 
+@api.get(
+    "/usage",
+    description="Usage of the current user, by day, model and prompt. Days are in UTC, inclusive, and default to the current month.",
+)
+async def usage_get(
+    current_user: Annotated[UserModel, Depends(get_current_user)],
+    end: Optional[date] = None,
+    start: Optional[date] = None,
+) -> ListUsageRollupsModel:
+    start, end = _usage_range(start, end)
+    rollups = await store.usage_rollup_list(current_user.id, start, end)
+    return ListUsageRollupsModel(end=end, rollups=rollups, start=start)
+
+
+@api.get(
+    "/admin/usage",
+    description="Usage of a user, or of all users if no user_id is given, by day, model and prompt. Requires the admin role.",
+)
+async def admin_usage_get(
+    current_admin: Annotated[UserModel, Depends(get_current_admin)],
+    end: Optional[date] = None,
+    start: Optional[date] = None,
+    user_id: Optional[UUID] = None,
+) -> ListUsageRollupsModel:
+    start, end = _usage_range(start, end)
+    rollups = await store.usage_rollup_list(
+        user_id or UsageBuffer.ALL_USERS_ID, start, end
+    )
+    return ListUsageRollupsModel(end=end, rollups=rollups, start=start)
+
+
+async def _message_page(
+    conversation_id: UUID,
+    limit: int,
+    cursor: Optional[Tuple[datetime, Optional[UUID]]] = None,
+) -> Tuple[List[MessageModel], Optional[str]]:
+    """
+    Latest messages of a conversation, before the cursor if set, and the cursor of the older ones if there are.
+    """
+    # Read one more message, to know if there are older ones
+    messages = await store.message_list(conversation_id, limit + 1, cursor) or []
+    messages_before = None
+    if len(messages) > limit:
+        messages = messages[1:]
+        messages_before = _message_cursor_encode(messages[0])
+    return messages, messages_before
+
+
+def _message_cursor_decode(raw: str) -> Tuple[datetime, Optional[UUID]]:
+    """
+    Cursor is the date and the ID of the oldest message returned, messages of the same date are sorted by ID. A date alone is accepted, for the cursors issued before the ID was added.
+    """
+    created_at_raw, _, id_raw = raw.partition("_")
+    created_at = datetime.fromisoformat(created_at_raw)
+    if created_at.tzinfo:
+        # Dates are stored as naive UTC
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return created_at, (UUID(id_raw) if id_raw else None)
+
+
+def _message_cursor_encode(message: MessageModel) -> str:
+    return f"{message.created_at.isoformat()}_{message.id}"
+
+
+def _usage_range(start: Optional[date], end: Optional[date]) -> Tuple[date, date]:
+    end = end or datetime.utcnow().date()
+    start = start or end.replace(day=1)
+    if start > end or (end - start).days >= USAGE_MAX_DAYS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Range must be positive, and up to {USAGE_MAX_DAYS} days",
+        )
+    return start, end
+
+
 async def _generate_completion_background(
     conversation: StoredConversationModel,
     messages: List[MessageModel],
@@ -492,13 +701,16 @@ async def _generate_completion_background(
 
     messages = []
 
-    def on_message(message: StreamMessageModel) -> None:
+    async def on_message(message: StreamMessageModel) -> None:
         _logger.debug(f"Completion result: {message}")
         # Add content to the redis stream cache_key
-        stream.push(message.json(), last_message.token)
+        await stream.push(message.json(), last_message.token)
+        if message.reset:
+            # Content streamed so far is replaced, actions are kept
+            messages[:] = [m for m in messages if m.action]
         messages.append(message)
 
-    def on_usage(total_tokens: int, model_name: str) -> None:
+    async def on_usage(total_tokens: int, model_name: str) -> None:
         usage = UsageModel(
             ai_model=model_name,
             conversation_id=conversation.id,
@@ -506,7 +718,7 @@ async def _generate_completion_background(
             tokens=total_tokens,
             user_id=conversation.user_id,
         )
-        store.usage_set(usage)
+        await usage_buffer.record(usage)
 
     await openai.chain(
         last_message, conversation, current_user, language, on_message, on_usage
@@ -522,11 +734,17 @@ async def _generate_completion_background(
         role=MessageRole.ASSISTANT,
         secret=last_message.secret,
     )
-    store.message_set(res_message)
-    index.message_index(res_message)
+    await store.message_set(res_message)
+    index.message_index(res_message, conversation.user_id)
 
     # Then, send the end of stream message
-    stream.end(last_message.token)
+    await stream.end(last_message.token)
+
+    # Finally, fold the messages out of the memory window in the summary
+    try:
+        await openai.summary_update(conversation, on_usage)
+    except Exception:
+        _logger.error("Error updating conversation summary", exc_info=True)
 
 
 async def _guess_title_background(
@@ -538,16 +756,18 @@ async def _guess_title_background(
 
     last_message = messages[-1]
 
-    def new_message(message: str) -> None:
+    async def new_message(message: str) -> None:
         if message == "null":
             _logger.error("No title found")
             return
         # Store the updated conversation
         _logger.debug(f"Title found: {message}")
-        conversation.title = message
-        store.conversation_set(conversation)
+        # Only the title, the conversation read at POST time may be outdated (e.g. summary)
+        await store.conversation_title_set(
+            conversation.id, conversation.user_id, message
+        )
 
-    def usage(total_tokens: int, model_name: str) -> None:
+    async def usage(total_tokens: int, model_name: str) -> None:
         usage = UsageModel(
             ai_model=model_name,
             conversation_id=conversation.id,
@@ -555,9 +775,16 @@ async def _guess_title_background(
             tokens=total_tokens,
             user_id=conversation.user_id,
         )
-        store.usage_set(usage)
-
-    await openai.completion(last_message, AI_TITLE_PROMPT, language, new_message, usage)
+        await usage_buffer.record(usage)
+
+    await openai.completion(
+        last_message,
+        AI_TITLE_PROMPT,
+        language,
+        conversation.user_id,
+        new_message,
+        usage,
+    )
 
 
 # Instrument FastAPI with OpenTelemetry
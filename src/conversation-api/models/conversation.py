@@ -15,12 +15,31 @@ class BaseConversationModel(BaseModel):
 
 class StoredConversationModel(BaseConversationModel):
     prompt: Optional[StoredPromptModel] = None
+    summary: Optional[
+        str
+    ] = None  # Rolling summary of the messages out of the memory window
+    summary_until: Optional[
+        datetime
+    ] = None  # Creation date of the last message in the summary
 
 
 class GetConversationModel(BaseConversationModel):
     messages: List[MessageModel]
+    messages_before: Optional[
+        str
+    ] = None  # Opaque cursor of the older messages, absent if there are none
     prompt: Optional[BasePromptModel] = None
 
 
+class StoredConversationPageModel(BaseModel):
+    continuation: Optional[
+        str
+    ] = None  # Opaque cursor of the next page, absent on the last page
+    conversations: List[StoredConversationModel]
+
+
 class ListConversationsModel(BaseModel):
+    continuation: Optional[
+        str
+    ] = None  # Opaque cursor of the next page, absent on the last page
     conversations: List[BaseConversationModel]
@@ -33,16 +33,19 @@ class IndexMessageModel(BaseModel):
     """
     Storing the message in a separate collection allows us to query for messages. It does not contain the message content, but only the metadata required to query for the message.
 
-    The absence of content and created_at is intentional. We don't want to store PII in the index. As this, we are not forced to apply a TTL to the index nor secure too much the DB.
+    The absence of content is intentional. We don't want to store PII in the index. As this, we are not forced to apply a TTL to the index nor secure too much the DB. The creation date is stored to rank search results by recency.
     """
 
     conversation_id: UUID
+    created_at: Optional[datetime] = None  # Optional for backward compatibility
     id: UUID
+    user_id: Optional[UUID] = None  # Optional for backward compatibility
 
 
 class StreamMessageModel(BaseModel):
     action: Optional[str] = None
     content: Optional[str] = None
+    reset: bool = False  # Content replaces the one streamed so far, actions are kept
 
     @root_validator(pre=True)
     def validate(cls, values):
@@ -1,5 +1,5 @@
-from datetime import datetime
-from typing import Optional
+from datetime import date, datetime
+from typing import List, Optional
 from pydantic import BaseModel, Field
 from uuid import UUID, uuid4
 
@@ -12,3 +12,18 @@ class UsageModel(BaseModel):
     prompt_name: Optional[str] = None
     tokens: int
     user_id: UUID  # Partition key
+
+
+class UsageRollupModel(BaseModel):
+    ai_model: str
+    day: date
+    prompt_name: Optional[str] = None
+    requests: int
+    tokens: int
+    user_id: UUID  # Partition key, nil UUID for all users
+
+
+class ListUsageRollupsModel(BaseModel):
+    end: date
+    rollups: List[UsageRollupModel]
+    start: date
@@ -2,135 +2,320 @@
 from utils import build_logger
 
 # Import misc
+from .codec import decode, encode
 from .istore import IStore
-from models.conversation import StoredConversationModel
+from datetime import date, datetime, timedelta, timezone
+from models.conversation import (
+    StoredConversationModel,
+    StoredConversationPageModel,
+)
 from models.message import MessageModel, IndexMessageModel, StoredMessageModel
 from models.readiness import ReadinessStatus
-from models.usage import UsageModel
+from models.usage import UsageModel, UsageRollupModel
 from models.user import UserModel
-from pydantic import ValidationError
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from uuid import UUID
+import asyncio
+import json
 
 
 _logger = build_logger(__name__)
 
 
 class CacheStore(IStore):
+    CONVERSATION_INDEX_PREFIX: str = "conversation-index"
     CONVERSATION_PREFIX: str = "conversation"
+    CONVERSATION_USER_PREFIX: str = "conversation-user"
+    MESSAGE_INDEX_PREFIX: str = "message-index"
     MESSAGE_PREFIX: str = "message"
     SECRET_TTL_SECS: int = 60 * 60 * 24  # 1 day
+    USAGE_INDEX_PREFIX: str = "usage-index"
     USAGE_PREFIX: str = "usage"
+    USAGE_ROLLUP_PREFIX: str = "usage-rollup"
+    USAGE_ROLLUP_TTL_SECS: int = (
+        60 * 60 * 24 * 366
+    )  # 1 year, the longest range of the usage API
     USER_PREFIX: str = "user"
 
     async def readiness(self) -> ReadinessStatus:
         return await self.cache.readiness()
 
-    def user_get(self, user_external_id: str) -> Optional[UserModel]:
-        key = self._user_key(user_external_id)
-        if not self.cache.exists(key):
+    async def user_get(self, user_external_id: str) -> Optional[UserModel]:
+        raw = await self.cache.get(self._user_key(user_external_id))
+        if not raw:
             return None
-        return UserModel.parse_raw(self.cache.get(self._user_key(user_external_id)))
+        return decode(raw, UserModel)
 
-    def user_set(self, user: UserModel) -> None:
-        self.cache.set(self._user_key(user.external_id), user.json())
+    async def user_set(self, user: UserModel) -> None:
+        await self.cache.set(self._user_key(user.external_id), encode(user))
 
-    def conversation_get(
+    async def conversation_get(
         self, conversation_id: UUID, user_id: UUID
     ) -> Optional[StoredConversationModel]:
-        key = self._conversation_key(user_id, conversation_id)
-        if not self.cache.exists(key):
+        raw = await self.cache.get(self._conversation_key(user_id, conversation_id))
+        if not raw:
             return None
-        StoredConversationModel.parse_raw(
-            self.cache.get(self._conversation_key(user_id, conversation_id))
-        )
+        return decode(raw, StoredConversationModel)
 
-    def conversation_exists(self, conversation_id: UUID, user_id: UUID) -> bool:
+    async def conversation_exists(self, conversation_id: UUID, user_id: UUID) -> bool:
         key = self._conversation_key(user_id, conversation_id)
-        return self.cache.exists(key) != 0
+        return await self.cache.exists(key)
+
+    async def conversation_set(self, conversation: StoredConversationModel) -> None:
+        await self.cache.mset(
+            indexes={
+                self._conversation_index_key(conversation.user_id): {
+                    conversation.id.hex: self._score(conversation.created_at)
+                }
+            },
+            mapping={
+                self._conversation_key(conversation.user_id, conversation.id): encode(
+                    conversation
+                ),
+                self._conversation_user_key(conversation.id): conversation.user_id.hex,
+            },
+        )
 
-    def conversation_set(self, conversation: StoredConversationModel) -> None:
-        key = self._conversation_key(conversation.user_id, conversation.id)
-        self.cache.set(key, conversation.json())
+    async def conversation_summary_set(
+        self,
+        conversation_id: UUID,
+        user_id: UUID,
+        summary: Optional[str],
+        summary_until: datetime,
+    ) -> None:
+        conversation = await self.conversation_get(conversation_id, user_id)
+        if not conversation:
+            return
+        conversation.summary = summary
+        conversation.summary_until = summary_until
+        await self.conversation_set(conversation)
 
-    def conversation_list(
-        self, user_id: UUID
-    ) -> Optional[List[StoredConversationModel]]:
-        key = f"{self._conversation_key(user_id)}:*"
-        if not self.cache.exists(key):
+    async def conversation_title_set(
+        self, conversation_id: UUID, user_id: UUID, title: str
+    ) -> None:
+        conversation = await self.conversation_get(conversation_id, user_id)
+        if not conversation:
+            return
+        conversation.title = title
+        await self.conversation_set(conversation)
+
+    async def conversation_user_id(self, conversation_id: UUID) -> Optional[UUID]:
+        raw = await self.cache.get(self._conversation_user_key(conversation_id))
+        if not raw:
             return None
+        return UUID(raw)
+
+    async def conversation_list(
+        self, user_id: UUID, limit: int, continuation: Optional[str] = None
+    ) -> StoredConversationPageModel:
+        # Continuation is the score and the ID of the last conversation of the previous page
+        max_score, max_member = None, None
+        if continuation:
+            score, _, max_member = continuation.partition(":")
+            max_score = float(score)
+        conversation_ids = await self._index_page(
+            self._conversation_index_key(user_id), limit, max_score, max_member or None
+        )
+        if not conversation_ids:
+            return StoredConversationPageModel(conversations=[])
+        raws = await self.cache.mget(
+            [self._conversation_key(user_id, UUID(id)) for id in conversation_ids]
+        )
         conversations = []
-        for raws in (self.cache.hget(key) or {}).values():
+        for raw in raws.values():
+            if raw is None:  # Expired, index is cleaned when it expires
+                continue
             try:
-                conversations.append(StoredConversationModel.parse_raw(raws))
-            except ValidationError as e:
+                conversations.append(decode(raw, StoredConversationModel))
+            except ValueError as e:
                 _logger.warn(f'Error parsing conversation, "{e}"')
-        return conversations or None
+        return StoredConversationPageModel(
+            continuation=(
+                f"{self._score(conversations[-1].created_at)}:{conversations[-1].id.hex}"
+                if len(conversation_ids) == limit and conversations
+                else None
+            ),
+            conversations=conversations,
+        )
 
-    def message_get(
+    async def message_get(
         self, message_id: UUID, conversation_id: UUID
     ) -> Optional[MessageModel]:
-        key = self._message_key(conversation_id, message_id)
-        if not self.cache.exists(key):
+        raw = await self.cache.get(self._message_key(conversation_id, message_id))
+        if not raw:
             return None
-        return MessageModel.parse_raw(self.cache.get(key))
+        return decode(raw, MessageModel)
 
-    def message_get_index(
+    async def message_get_index(
         self, message_indexs: List[IndexMessageModel]
     ) -> Optional[List[MessageModel]]:
         keys = [
             self._message_key(message_index.conversation_id, message_index.id)
             for message_index in message_indexs
         ]
-        raws = self.cache.mget(keys)
+        raws = await self.cache.mget(keys)
         messages = []
-        for raw in raws:
+        for raw in raws.values():
             if raw is None:
                 continue
             try:
-                messages.append(MessageModel.parse_raw(raw))
-            except ValidationError as e:
+                messages.append(decode(raw, MessageModel))
+            except ValueError as e:
                 _logger.warn(f'Error parsing message, "{e}"')
         return messages or None
 
-    def message_set(self, message: StoredMessageModel) -> None:
-        key = self._message_key(message.conversation_id, message.id)
+    async def message_set(self, message: StoredMessageModel) -> None:
         expiry = self.SECRET_TTL_SECS if message.secret else None
-        self.cache.set(key, message.json(), expiry)
+        await self.cache.mset(
+            expiry=expiry,
+            indexes={
+                self._message_index_key(message.conversation_id): {
+                    message.id.hex: self._score(message.created_at)
+                }
+            },
+            mapping={
+                self._message_key(message.conversation_id, message.id): encode(message)
+            },
+        )
 
-    def message_list(self, conversation_id: UUID) -> Optional[List[MessageModel]]:
-        key = f"{self._message_key(conversation_id)}:*"
-        raws = self.cache.mget(key)
+    async def message_list(
+        self,
+        conversation_id: UUID,
+        limit: Optional[int] = None,
+        before: Optional[Tuple[datetime, Optional[UUID]]] = None,
+    ) -> Optional[List[MessageModel]]:
+        # Read from the latest, so the limit applies to the most recent messages
+        message_ids = await self._index_page(
+            self._message_index_key(conversation_id),
+            limit,
+            self._score(before[0]) if before else None,
+            before[1].hex if before and before[1] else None,
+        )
+        if not message_ids:
+            return None
+        message_ids.reverse()  # Sort ASC
+        raws = await self.cache.mget(
+            [self._message_key(conversation_id, UUID(id)) for id in message_ids]
+        )
         messages = []
-        for raw in raws:
-            if raw is None:
+        for raw in raws.values():
+            if raw is None:  # Expired, index is cleaned when it expires
                 continue
             try:
-                messages.append(MessageModel.parse_raw(raw))
-            except ValidationError as e:
-                _logger.warn(f'Error parsing conversation, "{e}"')
+                messages.append(decode(raw, MessageModel))
+            except ValueError as e:
+                _logger.warn(f'Error parsing message, "{e}"')
         return messages or None
 
-    def usage_set(self, usage: UsageModel) -> None:
-        key = self._usage_key(usage.user_id)
-        self.cache.set(key, usage.json())
+    async def usage_set_batch(self, usages: List[UsageModel]) -> None:
+        indexes = {}
+        for usage in usages:
+            indexes.setdefault(self._usage_index_key(usage.user_id), {})[
+                usage.id.hex
+            ] = self._score(usage.created_at)
+        await self.cache.mset(
+            indexes=indexes,
+            mapping={
+                self._usage_key(usage.user_id, usage.id): encode(usage)
+                for usage in usages
+            },
+        )
+
+    async def usage_rollup_set(self, rollup: UsageRollupModel) -> None:
+        # Fields are named after the model, the prompt and the metric
+        dimensions = [rollup.ai_model, rollup.prompt_name]
+        await self.cache.hset_max(
+            self._usage_rollup_key(rollup.user_id, rollup.day),
+            {
+                json.dumps([*dimensions, "requests"]): rollup.requests,
+                json.dumps([*dimensions, "tokens"]): rollup.tokens,
+            },
+            self.USAGE_ROLLUP_TTL_SECS,
+        )
+
+    async def usage_rollup_list(
+        self, user_id: UUID, start: date, end: date
+    ) -> List[UsageRollupModel]:
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+        # One hash per day, read concurrently
+        hashes = await asyncio.gather(
+            *[self.cache.hget(self._usage_rollup_key(user_id, day)) for day in days]
+        )
+        rollups = []
+        for day, fields in zip(days, hashes):
+            metrics = {}
+            for field, value in (fields or {}).items():
+                ai_model, prompt_name, metric = json.loads(field)
+                metrics.setdefault((ai_model, prompt_name), {})[metric] = int(value)
+            for (ai_model, prompt_name), values in metrics.items():
+                rollups.append(
+                    UsageRollupModel(
+                        ai_model=ai_model,
+                        day=day,
+                        prompt_name=prompt_name,
+                        requests=values.get("requests", 0),
+                        tokens=values.get("tokens", 0),
+                        user_id=user_id,
+                    )
+                )
+        return rollups
 
-    def _usage_key(self, user_id: UUID) -> str:
-        return f"{self.USAGE_PREFIX}:{user_id.hex}"
+    def _usage_key(self, user_id: UUID, usage_id: UUID) -> str:
+        return f"{self.USAGE_PREFIX}:{user_id.hex}:{usage_id.hex}"
 
-    def _conversation_key(
-        self, user_id: UUID, conversation_id: Optional[UUID] = None
-    ) -> str:
-        if not conversation_id:
-            return f"{self.CONVERSATION_PREFIX}:{user_id.hex}"
+    def _usage_index_key(self, user_id: UUID) -> str:
+        return f"{self.USAGE_INDEX_PREFIX}:{user_id.hex}"
+
+    def _usage_rollup_key(self, user_id: UUID, day: date) -> str:
+        return f"{self.USAGE_ROLLUP_PREFIX}:{user_id.hex}:{day.isoformat()}"
+
+    def _conversation_key(self, user_id: UUID, conversation_id: UUID) -> str:
         return f"{self.CONVERSATION_PREFIX}:{user_id.hex}:{conversation_id.hex}"
 
-    def _message_key(
-        self, conversation_id: UUID, message_id: Optional[UUID] = None
-    ) -> str:
-        if not message_id:
-            return f"{self.MESSAGE_PREFIX}:{conversation_id.hex}"
+    def _conversation_index_key(self, user_id: UUID) -> str:
+        return f"{self.CONVERSATION_INDEX_PREFIX}:{user_id.hex}"
+
+    def _conversation_user_key(self, conversation_id: UUID) -> str:
+        return f"{self.CONVERSATION_USER_PREFIX}:{conversation_id.hex}"
+
+    def _message_key(self, conversation_id: UUID, message_id: UUID) -> str:
         return f"{self.MESSAGE_PREFIX}:{conversation_id.hex}:{message_id.hex}"
 
+    def _message_index_key(self, conversation_id: UUID) -> str:
+        return f"{self.MESSAGE_INDEX_PREFIX}:{conversation_id.hex}"
+
+    async def _index_page(
+        self,
+        key: str,
+        limit: Optional[int],
+        max_score: Optional[float],
+        max_member: Optional[str],
+    ) -> List[str]:
+        """
+        Members of a sorted set, from the highest, strictly before the score and the member. Members with the same score are sorted by member, as Redis does.
+        """
+        members = []
+        if max_score is not None and max_member is not None:
+            # Members with the same score as the cursor, not returned yet
+            ties = await self.cache.zrange(
+                key, desc=True, max_score=max_score, min_score=max_score
+            )
+            members = [member for member in ties if member < max_member][:limit]
+        if limit is None or len(members) < limit:
+            members += await self.cache.zrange(
+                key,
+                desc=True,
+                exclusive=True,
+                limit=(limit - len(members) if limit is not None else None),
+                max_score=max_score,
+            )
+        return members
+
+    def _score(self, created_at: datetime) -> float:
+        """
+        Dates are stored as naive UTC, sorted sets are scored by their timestamp.
+        """
+        return created_at.replace(tzinfo=timezone.utc).timestamp()
+
     def _user_key(self, user_external_id: str) -> str:
         return f"{self.USER_PREFIX}:{user_external_id}"
@@ -0,0 +1,120 @@
+# Import utils
+from utils import build_logger, get_config
+
+# Import misc
+from enum import Enum
+from pydantic import BaseModel, parse_obj_as, parse_raw_as
+from pydantic.json import pydantic_encoder
+from typing import Any, Optional, Type, TypeVar, Union
+import json
+import msgpack
+import orjson
+import zstandard
+
+
+_logger = build_logger(__name__)
+T = TypeVar("T")
+
+
+class CodecFormat(str, Enum):
+    JSON = "json"  # Plain JSON text, without header
+    MSGPACK = "msgpack"
+    ORJSON = "orjson"
+
+
+# Configuration
+CODEC_FORMAT = get_config(
+    ["persistence", "codec"], "format", CodecFormat, default=CodecFormat.ORJSON
+)
+CODEC_ZSTD_LEVEL = get_config(["persistence", "codec"], "zstd_level", int, default=3)
+CODEC_ZSTD_MIN_BYTES = get_config(
+    ["persistence", "codec"], "zstd_min_bytes", int, default=4096
+)
+
+# Header is a NUL byte, which never starts a JSON text, then the version, the format and the compression
+HEADER_MAGIC = b"\x00"
+HEADER_SIZE = 4
+HEADER_VERSION = 1
+_COMPRESSION_NONE = 0
+_COMPRESSION_ZSTD = 1
+_FORMAT_IDS = {
+    CodecFormat.MSGPACK: 1,
+    CodecFormat.ORJSON: 2,
+}
+
+
+def encode(
+    value: Any,
+    format: CodecFormat = CODEC_FORMAT,
+    zstd_min_bytes: Optional[int] = CODEC_ZSTD_MIN_BYTES,
+) -> Union[str, bytes]:
+    """
+    Encode a model, or a structure of models, for the cache.
+
+    Body is compressed with zstd if larger than the min size, set it to 0 to disable compression. JSON format is returned as text, without header, so it is readable by the previous versions.
+    """
+    if format == CodecFormat.JSON:
+        if isinstance(value, BaseModel):
+            return value.json()
+        return json.dumps(value, default=pydantic_encoder)
+
+    if format == CodecFormat.MSGPACK:
+        body = msgpack.packb(value, default=pydantic_encoder)
+    elif format == CodecFormat.ORJSON:
+        body = orjson.dumps(value, default=pydantic_encoder)
+    else:
+        raise ValueError(f"Unsupported codec format: {format}")
+
+    compression = _COMPRESSION_NONE
+    if zstd_min_bytes and len(body) >= zstd_min_bytes:
+        body = zstandard.compress(body, CODEC_ZSTD_LEVEL)
+        compression = _COMPRESSION_ZSTD
+
+    return (
+        HEADER_MAGIC + bytes([HEADER_VERSION, _FORMAT_IDS[format], compression]) + body
+    )
+
+
+def decode(raw: Union[str, bytes], model: Type[T]) -> T:
+    """
+    Decode a value from the cache, whatever the format it was written with.
+
+    Raises ValueError if the value is invalid, or not of the expected type.
+    """
+    # Written before the codec, or with the JSON format
+    if isinstance(raw, str) or not raw.startswith(HEADER_MAGIC):
+        return parse_raw_as(model, raw)
+
+    if len(raw) < HEADER_SIZE:
+        raise ValueError("Truncated codec header")
+    version, format_id, compression = raw[1], raw[2], raw[3]
+    if version != HEADER_VERSION:
+        raise ValueError(f"Unsupported codec version: {version}")
+
+    body = raw[HEADER_SIZE:]
+    if compression == _COMPRESSION_ZSTD:
+        try:
+            body = zstandard.decompress(body)
+        except zstandard.ZstdError as e:
+            raise ValueError("Invalid zstd body") from e
+    elif compression != _COMPRESSION_NONE:
+        raise ValueError(f"Unsupported codec compression: {compression}")
+
+    if format_id == _FORMAT_IDS[CodecFormat.MSGPACK]:
+        obj = msgpack.unpackb(body)
+    elif format_id == _FORMAT_IDS[CodecFormat.ORJSON]:
+        obj = orjson.loads(body)
+    else:
+        raise ValueError(f"Unsupported codec format: {format_id}")
+
+    # Models are parsed directly, faster than the generic parser
+    if isinstance(model, type) and issubclass(model, BaseModel):
+        return model.parse_obj(obj)
+    return parse_obj_as(model, obj)
+
+
+def is_encoded(raw: bytes) -> bool:
+    """
+    Values with a codec header are binary, and must not be decoded as text.
+    """
+    return raw.startswith(HEADER_MAGIC)
@@ -1,21 +1,35 @@
 # Import utils
-from utils import build_logger, get_config, AZ_CREDENTIAL
+from utils import build_logger, get_config, hash_token, AZ_CREDENTIAL_ASYNC
 
 # Import misc
+from .codec import decode, encode
 from .icache import ICache
 from .istore import IStore
-from azure.cosmos import CosmosClient
-from azure.cosmos.exceptions import CosmosHttpResponseError
-from datetime import datetime
-from models.conversation import StoredConversationModel
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.cosmos.aio import CosmosClient
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+from datetime import date, datetime
+from models.conversation import (
+    StoredConversationModel,
+    StoredConversationPageModel,
+)
 from models.message import MessageModel, IndexMessageModel, StoredMessageModel
 from models.readiness import ReadinessStatus
-from models.usage import UsageModel
+from models.usage import UsageModel, UsageRollupModel
 from models.user import UserModel
 from pydantic import ValidationError
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 from uuid import UUID, uuid4
+import aiohttp
 import asyncio
+import base64
+import binascii
 
 
 _logger = build_logger(__name__)
@@ -25,9 +39,33 @@ SECRET_TTL_SECS = 60 * 60 * 24  # 1 day
 CONVERSATION_PREFIX = "conversation"
 DB_URL = get_config(["persistence", "cosmos"], "url", str, required=True)
 DB_NAME = get_config(["persistence", "cosmos"], "database", str, required=True)
+DB_KEEPALIVE_SECS = get_config(
+    ["persistence", "cosmos"], "keepalive_secs", int, default=30
+)
+DB_MAX_CONNECTIONS = get_config(
+    ["persistence", "cosmos"], "max_connections", int, default=100
+)
+DB_TIMEOUT_SECS = get_config(["persistence", "cosmos"], "timeout_secs", int, default=10)
 
 # Cosmos DB Client
-client = CosmosClient(url=DB_URL, credential=AZ_CREDENTIAL)
+# Connections are pooled and kept alive between requests, the session is owned by the transport
+transport = AioHttpTransport(
+    session=aiohttp.ClientSession(
+        auto_decompress=False,  # Decompression is handled by the SDK
+        connector=aiohttp.TCPConnector(
+            keepalive_timeout=DB_KEEPALIVE_SECS,
+            limit=DB_MAX_CONNECTIONS,
+            ttl_dns_cache=300,  # 5 mins
+        ),
+        cookie_jar=aiohttp.DummyCookieJar(),
+    ),
+)
+client = CosmosClient(
+    connection_timeout=DB_TIMEOUT_SECS,
+    credential=AZ_CREDENTIAL_ASYNC,
+    transport=transport,
+    url=DB_URL,
+)
 database = client.get_database_client(DB_NAME)
 conversation_client = database.get_container_client("conversation")
 memory_client = database.get_container_client("memory")
@@ -37,6 +75,10 @@ user_client = database.get_container_client("user")
 
 
 class CosmosStore(IStore):
+    CONVERSATION_LIST_TTL_SECS: int = 60 * 60  # 1 hour
+    USAGE_ROLLUP_MAX_ATTEMPTS: int = 3
+    USAGE_ROLLUP_TTL_SECS: int = 60 * 60  # 1 hour
+    _bootstrap_task: asyncio.Task
     _loop: asyncio.AbstractEventLoop
 
     def __init__(self, cache: ICache):
@@ -44,219 +86,529 @@ class CosmosStore(IStore):
 
         self._loop = asyncio.get_running_loop()
 
+        # Client is async, it is opened in the background and awaited before use
+        self._bootstrap_task = self._loop.create_task(self._bootstrap())
+
     async def readiness(self) -> ReadinessStatus:
         try:
+            await self._ensure_bootstrap()
             # Cosmos DB is not ACID compliant, so we can't use transactions
-            conversation_client.upsert_item(
+            await conversation_client.upsert_item(
                 body={
                     "dummy": "dummy",
                     "id": str(uuid4()),
                 }
             )
-        except CosmosHttpResponseError:
+        except Exception:
             _logger.warn("Error connecting to Cosmos", exc_info=True)
             return ReadinessStatus.FAIL
         return ReadinessStatus.OK
 
-    def user_get(self, user_external_id: str) -> Optional[UserModel]:
+    async def user_get(self, user_external_id: str) -> Optional[UserModel]:
         cache_key = f"user:{user_external_id}"
 
         try:
-            if self.cache.exists(cache_key):
+            raw = await self.cache.get(cache_key)
+            if raw:
                 _logger.debug(f'Cache hit for user "{user_external_id}"')
-                return UserModel.parse_raw(self.cache.get(cache_key))
-        except ValidationError as e:
+                return decode(raw, UserModel)
+        except ValueError as e:
             _logger.warn(f'Error parsing user from cache, "{e}"')
 
+        await self._ensure_bootstrap()
         query = f"SELECT * FROM c WHERE c.external_id = '{user_external_id}'"
         items = user_client.query_items(query=query, partition_key="dummy")
-        try:
-            raw = next(items)
+        async for raw in items:
             user = UserModel(**raw)
             # Update cache
-            self.cache.set(cache_key, user.json())
+            await self.cache.set(cache_key, encode(user))
             return user
-        except StopIteration:
-            return None
+        return None
 
-    def user_set(self, user: UserModel) -> None:
+    async def user_set(self, user: UserModel) -> None:
         cache_key = f"user:{user.external_id}"
-        user_client.upsert_item(
+        await self._ensure_bootstrap()
+        await user_client.upsert_item(
             body={
                 **self._sanitize_before_insert(user.dict()),
                 "dummy": "dummy",
             }
         )
         # Update cache
-        self.cache.set(cache_key, user.json())
+        await self.cache.set(cache_key, encode(user))
 
-    def conversation_get(
+    async def conversation_get(
         self, conversation_id: UUID, user_id: UUID
     ) -> Optional[StoredConversationModel]:
         cache_key = f"conversation:{user_id}:{conversation_id}"
 
         try:
-            if self.cache.exists(cache_key):
+            raw = await self.cache.get(cache_key)
+            if raw:
                 _logger.debug(f'Cache hit for conversation "{conversation_id}"')
-                return StoredConversationModel.parse_raw(self.cache.get(cache_key))
-        except ValidationError as e:
+                return decode(raw, StoredConversationModel)
+        except ValueError as e:
             _logger.warn(f'Error parsing conversation from cache, "{e}"')
 
+        await self._ensure_bootstrap()
         try:
-            raw = conversation_client.read_item(
+            raw = await conversation_client.read_item(
                 item=str(conversation_id), partition_key=str(user_id)
             )
             conversation = StoredConversationModel(**raw)
             # Update cache
-            self.cache.set(cache_key, conversation.json())
+            await self.cache.set(cache_key, encode(conversation))
             return conversation
         except CosmosHttpResponseError:
             return None
 
-    def conversation_exists(self, conversation_id: UUID, user_id: UUID) -> bool:
-        return self.conversation_get(conversation_id, user_id) != None
+    async def conversation_exists(self, conversation_id: UUID, user_id: UUID) -> bool:
+        return await self.conversation_get(conversation_id, user_id) != None
 
-    def conversation_set(self, conversation: StoredConversationModel) -> None:
+    async def conversation_set(self, conversation: StoredConversationModel) -> None:
         cache_key = f"conversation:{conversation.user_id}:{conversation.id}"
-        conversation_client.upsert_item(
+        await self._ensure_bootstrap()
+        await conversation_client.upsert_item(
             body=self._sanitize_before_insert(conversation.dict())
         )
         # Update cache
-        self.cache.set(cache_key, conversation.json())
-        self.cache.delete(
-            f"conversation-list:{conversation.user_id}"
+        await self.cache.set(cache_key, encode(conversation))
+        await self.cache.set(
+            self._conversation_list_version_key(conversation.user_id),
+            uuid4().hex,
+            self.CONVERSATION_LIST_TTL_SECS * 2,  # Outlive the cached pages
+        )  # Invalidate list
+
+    async def conversation_summary_set(
+        self,
+        conversation_id: UUID,
+        user_id: UUID,
+        summary: Optional[str],
+        summary_until: datetime,
+    ) -> None:
+        cache_key = f"conversation:{user_id}:{conversation_id}"
+        await self._ensure_bootstrap()
+        # Patched, to not overwrite the fields updated meanwhile (e.g. title)
+        raw = await conversation_client.patch_item(
+            item=str(conversation_id),
+            partition_key=str(user_id),
+            patch_operations=[
+                {"op": "set", "path": "/summary", "value": summary},
+                {
+                    "op": "set",
+                    "path": "/summary_until",
+                    "value": summary_until.isoformat(),
+                },
+            ],
+        )
+        # Update cache
+        await self.cache.set(cache_key, encode(StoredConversationModel(**raw)))
+
+    async def conversation_title_set(
+        self, conversation_id: UUID, user_id: UUID, title: str
+    ) -> None:
+        cache_key = f"conversation:{user_id}:{conversation_id}"
+        await self._ensure_bootstrap()
+        # Patched, to not overwrite the fields updated meanwhile (e.g. summary)
+        raw = await conversation_client.patch_item(
+            item=str(conversation_id),
+            partition_key=str(user_id),
+            patch_operations=[{"op": "set", "path": "/title", "value": title}],
+        )
+        # Update cache
+        await self.cache.set(cache_key, encode(StoredConversationModel(**raw)))
+        await self.cache.set(
+            self._conversation_list_version_key(user_id),
+            uuid4().hex,
+            self.CONVERSATION_LIST_TTL_SECS * 2,  # Outlive the cached pages
         )  # Invalidate list
 
-    def conversation_list(
-        self, user_id: UUID
-    ) -> Optional[List[StoredConversationModel]]:
-        cache_key = f"conversation-list:{user_id}"
+    async def conversation_user_id(self, conversation_id: UUID) -> Optional[UUID]:
+        await self._ensure_bootstrap()
+        # Partition key is unknown, query all partitions
+        query = f"SELECT VALUE c.user_id FROM c WHERE c.id = '{conversation_id}'"
+        items = conversation_client.query_items(query=query)
+        async for raw in items:
+            return UUID(raw)
+        return None
+
+    async def conversation_list(
+        self, user_id: UUID, limit: int, continuation: Optional[str] = None
+    ) -> StoredConversationPageModel:
+        # Pages are cached by version, a new conversation invalidates them all
+        version = await self.cache.get(self._conversation_list_version_key(user_id))
+        cursor = hash_token(continuation).hex if continuation else "first"
+        cache_key = f"conversation-list:{user_id}:{version or 0}:{limit}:{cursor}"
 
         try:
-            if self.cache.exists(cache_key):
+            raw = await self.cache.get(cache_key)
+            if raw:
                 _logger.debug(f'Cache hit for conversation list "{user_id}"')
-                return [
-                    StoredConversationModel.parse_raw(raw)
-                    for _, raw in (self.cache.hget(cache_key) or {}).items()
-                ]
-        except ValidationError as e:
+                return decode(raw, StoredConversationPageModel)
+        except ValueError as e:
             _logger.warn(f'Error parsing conversation list from cache, "{e}"')
 
-        query = (
-            f"SELECT * FROM c WHERE c.user_id = '{user_id}' ORDER BY c.created_at DESC"
-        )
-        raws = conversation_client.query_items(
-            query=query, enable_cross_partition_query=True
-        )
+        await self._ensure_bootstrap()
+        query = "SELECT * FROM c ORDER BY c.created_at DESC"
+        # Scoped to the user partition, no fan-out across partitions
+        pages = conversation_client.query_items(
+            max_item_count=limit, partition_key=str(user_id), query=query
+        ).by_page(self._continuation_decode(continuation))
         conversations = []
-        for raw in raws:
-            if raw is None:
-                continue
-            try:
-                conversations.append(StoredConversationModel(**raw))
-            except ValidationError as e:
-                _logger.warn(f'Error parsing conversation, "{e}"')
+        try:
+            async for raw in await pages.__anext__():
+                if raw is None:
+                    continue
+                try:
+                    conversations.append(StoredConversationModel(**raw))
+                except ValidationError as e:
+                    _logger.warn(f'Error parsing conversation, "{e}"')
+        except StopAsyncIteration:
+            pass
+        except CosmosHttpResponseError as e:
+            if e.status_code == 400:
+                raise ValueError("Invalid continuation") from e
+            raise
+        page = StoredConversationPageModel(
+            continuation=self._continuation_encode(pages.continuation_token),
+            conversations=conversations,
+        )
         # Update cache
-        self.cache.hset(cache_key, {str(c.id): c.json() for c in conversations})
-        return conversations or None
+        await self.cache.set(cache_key, encode(page))
+        return page
 
-    def message_get(
+    async def message_get(
         self, message_id: UUID, conversation_id: UUID
     ) -> Optional[MessageModel]:
         cache_key = f"message:{conversation_id}:{message_id}"
 
         try:
-            if self.cache.exists(cache_key):
+            raw = await self.cache.get(cache_key)
+            if raw:
                 _logger.debug(f'Cache hit for message "{message_id}"')
-                return MessageModel.parse_raw(self.cache.get(cache_key))
-        except ValidationError as e:
+                return decode(raw, MessageModel)
+        except ValueError as e:
             _logger.warn(f'Error parsing message from cache, "{e}"')
 
+        await self._ensure_bootstrap()
         try:
-            raw = message_client.read_item(
+            raw = await message_client.read_item(
                 item=str(message_id), partition_key=str(conversation_id)
             )
             message = MessageModel(**raw)
             # Update cache
-            self.cache.set(cache_key, message.json())
+            await self.cache.set(cache_key, encode(message))
             return message
         except CosmosHttpResponseError:
             return None
 
-    def message_get_index(
+    async def message_get_index(
         self, message_indexs: List[IndexMessageModel]
     ) -> Optional[List[MessageModel]]:
         cache_keys = [f"message:{m.conversation_id}:{m.id}" for m in message_indexs]
+        messages: Dict[str, Optional[MessageModel]] = {k: None for k in cache_keys}
 
-        try:
-            if all(self.cache.exists(k) for k in cache_keys):
-                _logger.debug(f'Cache hit for message index "{message_indexs}"')
-                return [MessageModel.parse_raw(self.cache.get(k)) for k in cache_keys]
-        except ValidationError as e:
-            _logger.warn(f'Error parsing message index from cache, "{e}"')
-
-        messages = []
-        for message_index in message_indexs:
+        for cache_key, raw in (await self.cache.mget(cache_keys)).items():
+            if not raw:
+                continue
             try:
-                raw = message_client.read_item(
-                    item=str(message_index.id),
-                    partition_key=str(message_index.conversation_id),
-                )
-                messages.append(MessageModel(**raw))
-            except CosmosHttpResponseError:
-                pass
-        # Update cache
-        self.cache.mset({k: m.json() for k, m in zip(cache_keys, messages)})
-        return messages or None
+                messages[cache_key] = decode(raw, MessageModel)
+            except ValueError as e:
+                _logger.warn(f'Error parsing message from cache, "{e}"')
+        misses = [
+            (cache_key, message_index)
+            for cache_key, message_index in zip(cache_keys, message_indexs)
+            if not messages[cache_key]
+        ]
+        _logger.debug(
+            f"Cache hit for {len(cache_keys) - len(misses)}/{len(cache_keys)} messages"
+        )
 
-    def message_set(self, message: StoredMessageModel) -> None:
+        if misses:
+            await self._ensure_bootstrap()
+            # Point reads are the cheapest Cosmos operation, run them concurrently
+            raws = await asyncio.gather(
+                *[
+                    message_client.read_item(
+                        item=str(message_index.id),
+                        partition_key=str(message_index.conversation_id),
+                    )
+                    for _, message_index in misses
+                ],
+                return_exceptions=True,
+            )
+            fetched = {}
+            for (cache_key, _), raw in zip(misses, raws):
+                if isinstance(raw, CosmosHttpResponseError):
+                    continue
+                if isinstance(raw, BaseException):
+                    raise raw
+                fetched[cache_key] = MessageModel(**raw)
+            # Update cache
+            await self.cache.mset({k: encode(m) for k, m in fetched.items()})
+            messages.update(fetched)
+
+        # Order of the index is kept
+        return [m for m in messages.values() if m] or None
+
+    async def message_set(self, message: StoredMessageModel) -> None:
         cache_key = f"message:{message.conversation_id}:{message.id}"
         expiry = SECRET_TTL_SECS if message.secret else None
-        message_client.upsert_item(
+        await self._ensure_bootstrap()
+        await message_client.upsert_item(
             body={
                 **self._sanitize_before_insert(message.dict()),
                 "_ts": expiry,  # TTL in seconds
             }
         )
         # Update cache
-        self.cache.set(cache_key, message.json(), expiry)
-        self.cache.delete(f"message-list:{message.conversation_id}")  # Invalidate list
+        await self.cache.set(cache_key, encode(message), expiry)
+        # Append to the list, if cached, instead of invalidating it
+        await self.cache.hset_append(
+            key=f"message-list:{message.conversation_id}",
+            mapping={str(message.id): encode(message)},
+            version_key=f"message-list-version:{message.conversation_id}",
+        )
 
-    def message_list(self, conversation_id: UUID) -> Optional[List[MessageModel]]:
+    async def message_list(
+        self,
+        conversation_id: UUID,
+        limit: Optional[int] = None,
+        before: Optional[Tuple[datetime, Optional[UUID]]] = None,
+    ) -> Optional[List[MessageModel]]:
         cache_key = f"message-list:{conversation_id}"
+        version_key = f"message-list-version:{conversation_id}"
 
         try:
-            if self.cache.exists(cache_key):
+            raws = await self.cache.hget(cache_key)
+            if raws:
                 _logger.debug(f'Cache hit for message list "{conversation_id}"')
-                return [
-                    MessageModel.parse_raw(raw)
-                    for _, raw in (self.cache.hget(cache_key) or {}).items()
-                ]
-        except ValidationError as e:
+                messages = [decode(raw, MessageModel) for raw in raws.values()]
+                # Hash fields are not ordered
+                messages.sort(key=lambda m: (m.created_at, m.id))
+                return self._message_window(messages, limit, before) or None
+        except ValueError as e:
             _logger.warn(f'Error parsing message list from cache, "{e}"')
 
-        query = f"SELECT * FROM c WHERE c.conversation_id = '{conversation_id}' ORDER BY c.created_at ASC"
+        await self._ensure_bootstrap()
+
+        if limit is not None or before is not None:
+            # Window is not cached, only the latest messages are read
+            top = f"TOP {limit} " if limit is not None else ""
+            where = f"WHERE c.created_at < '{before[0].isoformat()}' " if before else ""
+            query = f"SELECT {top}* FROM c {where}ORDER BY c.created_at DESC"
+            latest = await self._message_query(conversation_id, query)
+            queries = []
+            if before and before[1]:
+                # Messages with the same date as the cursor, not returned yet
+                queries.append(
+                    f"SELECT * FROM c WHERE c.created_at = '{before[0].isoformat()}' AND c.id < '{before[1]}'"
+                )
+            if limit is not None and latest and len(latest) == limit:
+                # Page may end among messages with the same date, all of them are read to sort them by ID
+                queries.append(
+                    f"SELECT * FROM c WHERE c.created_at = '{latest[-1].created_at.isoformat()}'"
+                )
+            ties = await asyncio.gather(
+                *[self._message_query(conversation_id, query) for query in queries]
+            )
+            messages = list(
+                {m.id: m for m in latest + [m for tie in ties for m in tie]}.values()
+            )
+            messages.sort(key=lambda m: (m.created_at, m.id))
+            return self._message_window(messages, limit, before) or None
+
+        # Read before the query, messages written meanwhile would be missing from the result
+        version = await self.cache.get(version_key)
+        query = "SELECT * FROM c ORDER BY c.created_at ASC"
+        messages = await self._message_query(conversation_id, query)
+        messages.sort(key=lambda m: (m.created_at, m.id))
+        # Update cache, if no message was written meanwhile
+        await self.cache.hset_guarded(
+            key=cache_key,
+            mapping={str(m.id): encode(m) for m in messages},
+            version=version,
+            version_key=version_key,
+        )
+        return messages or None
+
+    async def usage_set_batch(self, usages: List[UsageModel]) -> None:
+        _logger.debug(f"Usage set for {len(usages)} events")
+        await self._ensure_bootstrap()
+        # Upserts are sent concurrently, bounded by the connection pool
+        await asyncio.gather(
+            *[
+                usage_client.upsert_item(
+                    body=self._sanitize_before_insert(usage.dict())
+                )
+                for usage in usages
+            ]
+        )
+
+    async def usage_rollup_set(self, rollup: UsageRollupModel) -> None:
+        await self._ensure_bootstrap()
+        # Same ID for the same user, day, model and prompt
+        rollup_id = str(
+            hash_token(
+                f"{rollup.user_id}:{rollup.day}:{rollup.ai_model}:{rollup.prompt_name}"
+            )
+        )
+        body = self._sanitize_before_insert({**rollup.dict(), "id": rollup_id})
+        # Optimistic concurrency, retried if another process wrote the rollup meanwhile
+        for _ in range(self.USAGE_ROLLUP_MAX_ATTEMPTS):
+            try:
+                stored = await usage_client.read_item(
+                    item=rollup_id, partition_key=str(rollup.user_id)
+                )
+            except CosmosResourceNotFoundError:
+                stored = None
+            try:
+                if not stored:
+                    await usage_client.create_item(body=body)
+                elif stored.get("requests", 0) < rollup.requests:
+                    await usage_client.replace_item(
+                        body=body,
+                        etag=stored["_etag"],
+                        item=rollup_id,
+                        match_condition=MatchConditions.IfNotModified,
+                    )
+                else:
+                    # Stored copy is as recent, nothing to do
+                    return
+                break
+            except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+                _logger.debug(f'Concurrent write of usage rollup "{rollup_id}"')
+        else:
+            raise CosmosHttpResponseError(
+                message=f'Cannot write usage rollup "{rollup_id}", too many concurrent writes'
+            )
+        # Rollup is written, an error must not fail the copy
+        try:
+            await self.cache.set(
+                self._usage_rollup_version_key(rollup.user_id),
+                uuid4().hex,
+                self.USAGE_ROLLUP_TTL_SECS * 2,  # Outlive the cached lists
+            )  # Invalidate list
+        except Exception:
+            _logger.warn(
+                f'Error invalidating usage rollup list "{rollup.user_id}"',
+                exc_info=True,
+            )
+
+    async def usage_rollup_list(
+        self, user_id: UUID, start: date, end: date
+    ) -> List[UsageRollupModel]:
+        # Lists are cached by version, a new increment invalidates them all
+        version = await self.cache.get(self._usage_rollup_version_key(user_id))
+        cache_key = f"usage-rollup-list:{user_id}:{version or 0}:{start}:{end}"
+
+        try:
+            raw = await self.cache.get(cache_key)
+            if raw:
+                _logger.debug(f'Cache hit for usage rollup list "{user_id}"')
+                return decode(raw, List[UsageRollupModel])
+        except ValueError as e:
+            _logger.warn(f'Error parsing usage rollup list from cache, "{e}"')
+
+        await self._ensure_bootstrap()
+        # Raw events have no day, they are not matched
+        query = f"SELECT * FROM c WHERE c.day >= '{start.isoformat()}' AND c.day <= '{end.isoformat()}' ORDER BY c.day ASC"
+        # Scoped to the user partition, no fan-out across partitions
+        raws = usage_client.query_items(partition_key=str(user_id), query=query)
+        rollups = []
+        async for raw in raws:
+            if raw is None:
+                continue
+            try:
+                rollups.append(UsageRollupModel(**raw))
+            except ValidationError as e:
+                _logger.warn(f'Error parsing usage rollup, "{e}"')
+        # Update cache
+        await self.cache.set(
+            cache_key,
+            encode(rollups),
+            self.USAGE_ROLLUP_TTL_SECS,
+        )
+        return rollups
+
+    async def _bootstrap(self) -> None:
+        # Opens the HTTP session and reads the account properties (regions, consistency)
+        await client.__aenter__()
+        _logger.info(f'Cosmos client for database "{DB_NAME}" is ready')
+
+    async def _ensure_bootstrap(self) -> None:
+        """
+        Wait for the client bootstrap. If it failed (e.g. Cosmos was not reachable at startup), it is retried.
+        """
+        try:
+            await asyncio.shield(self._bootstrap_task)
+        except Exception:
+            _logger.warn("Error bootstrapping Cosmos, retrying", exc_info=True)
+            if self._bootstrap_task.done():
+                self._bootstrap_task = self._loop.create_task(self._bootstrap())
+            await asyncio.shield(self._bootstrap_task)
+
+    def _continuation_decode(self, continuation: Optional[str]) -> Optional[str]:
+        if not continuation:
+            return None
+        try:
+            return base64.urlsafe_b64decode(continuation.encode("ascii")).decode(
+                "utf-8"
+            )
+        except (binascii.Error, UnicodeError) as e:
+            raise ValueError("Invalid continuation") from e
+
+    def _continuation_encode(self, continuation: Optional[str]) -> Optional[str]:
+        """
+        Cosmos continuation tokens are JSON, they are encoded to be used in URLs.
+        """
+        if not continuation:
+            return None
+        return base64.urlsafe_b64encode(continuation.encode("utf-8")).decode("ascii")
+
+    def _conversation_list_version_key(self, user_id: UUID) -> str:
+        return f"conversation-list-version:{user_id}"
+
+    def _usage_rollup_version_key(self, user_id: UUID) -> str:
+        return f"usage-rollup-version:{user_id}"
+
+    async def _message_query(
+        self, conversation_id: UUID, query: str
+    ) -> List[MessageModel]:
+        # Scoped to the conversation partition, no fan-out across partitions
         raws = message_client.query_items(
-            query=query, enable_cross_partition_query=True
+            partition_key=str(conversation_id), query=query
         )
         messages = []
-        for raw in raws:
+        async for raw in raws:
             if raw is None:
                 continue
             try:
                 messages.append(MessageModel(**raw))
             except ValidationError as e:
                 _logger.warn(f'Error parsing message, "{e}"')
-        # Update cache
-        self.cache.hset(cache_key, {str(m.id): m.json() for m in messages})
-        return messages or None
-
-    def usage_set(self, usage: UsageModel) -> None:
-        _logger.debug(f'Usage set "{usage.id}"')
-        self._loop.create_task(self._usage_set_background(usage))
-
-    async def _usage_set_background(self, usage: UsageModel) -> None:
-        usage_client.upsert_item(body=self._sanitize_before_insert(usage.dict()))
+        return messages
+
+    def _message_window(
+        self,
+        messages: List[MessageModel],
+        limit: Optional[int],
+        before: Optional[Tuple[datetime, Optional[UUID]]],
+    ) -> List[MessageModel]:
+        """
+        Apply the window to messages sorted from the oldest, then by ID.
+        """
+        if before:
+            before_at, before_id = before
+            messages = [
+                m
+                for m in messages
+                if m.created_at < before_at
+                or (before_id and m.created_at == before_at and m.id < before_id)
+            ]
+        if limit is not None:
+            messages = messages[-limit:] if limit else []
+        return messages
 
     def _sanitize_before_insert(self, item: Union[dict, list]) -> Union[dict, list]:
         for key, value in item.items() if isinstance(item, dict) else enumerate(item):
@@ -264,6 +616,8 @@ class CosmosStore(IStore):
                 item[key] = str(value)
             elif isinstance(value, datetime):
                 item[key] = value.isoformat()
+            elif isinstance(value, date):
+                item[key] = value.isoformat()
             elif isinstance(value, dict) or isinstance(value, list):
                 item[key] = self._sanitize_before_insert(value)
         return item
@@ -5,6 +5,10 @@ from models.readiness import ReadinessStatus
 from typing import Dict, List, Optional, Union
 
 
+# Text, or binary if encoded by the codec
+CacheValue = Union[str, bytes]
+
+
 class CacheImplementation(str, Enum):
     REDIS = "redis"
 
@@ -15,35 +19,110 @@ class ICache(ABC):
         pass
 
     @abstractmethod
-    def exists(self, key: str) -> bool:
+    async def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[CacheValue]:
+        pass
+
+    @abstractmethod
+    async def set(
+        self, key: str, value: CacheValue, expiry: Optional[int] = None
+    ) -> None:
+        pass
+
+    @abstractmethod
+    async def get_bytes(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    async def set_bytes(
+        self, key: str, value: bytes, expiry: Optional[int] = None
+    ) -> None:
+        pass
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    async def hget(
+        self, key: str, fresh: bool = False
+    ) -> Optional[Dict[str, CacheValue]]:
+        """
+        Get all the fields of the hash. If fresh, the hash is read from the shared cache, never from a copy in memory.
+        """
         pass
 
     @abstractmethod
-    def get(self, key: str) -> Optional[str]:
+    async def hset(
+        self, key: str, mapping: Dict[str, CacheValue], expiry: Optional[int] = None
+    ) -> None:
         pass
 
     @abstractmethod
-    def set(self, key: str, value: str, expiry: Optional[int] = None) -> None:
+    async def hset_append(
+        self,
+        key: str,
+        mapping: Dict[str, CacheValue],
+        version_key: str,
+        expiry: Optional[int] = None,
+    ) -> bool:
         pass
 
     @abstractmethod
-    def delete(self, key: str) -> None:
+    async def hset_guarded(
+        self,
+        key: str,
+        mapping: Dict[str, CacheValue],
+        version_key: str,
+        version: Optional[str],
+        expiry: Optional[int] = None,
+    ) -> bool:
         pass
 
     @abstractmethod
-    def hget(self, key: str) -> Optional[Dict[str, Optional[str]]]:
+    async def hincrby(
+        self, increments: Dict[str, Dict[str, int]], expiry: Optional[int] = None
+    ) -> None:
+        """
+        Increment the fields of the hashes, in a single transaction.
+        """
         pass
 
     @abstractmethod
-    def hset(
-        self, key: str, mapping: Dict[str, str], expiry: Optional[int] = None
+    async def hset_max(
+        self, key: str, mapping: Dict[str, int], expiry: Optional[int] = None
     ) -> None:
+        """
+        Set the fields of the hash, only where the value is larger than the current one.
+        """
         pass
 
     @abstractmethod
-    def mget(self, keys: Union[str, List[str]]) -> Dict[str, Optional[str]]:
+    async def mget(
+        self, keys: Union[str, List[str]]
+    ) -> Dict[str, Optional[CacheValue]]:
+        pass
+
+    @abstractmethod
+    async def mset(
+        self,
+        mapping: Dict[str, CacheValue],
+        expiry: Optional[int] = None,
+        indexes: Optional[Dict[str, Dict[str, float]]] = None,
+    ) -> None:
         pass
 
     @abstractmethod
-    def mset(self, mapping: Dict[str, str], expiry: Optional[int] = None) -> None:
+    async def zrange(
+        self,
+        key: str,
+        desc: bool = False,
+        exclusive: bool = False,
+        limit: Optional[int] = None,
+        max_score: Optional[float] = None,
+        min_score: Optional[float] = None,
+    ) -> List[str]:
         pass
@@ -25,11 +25,11 @@ class ISearch(ABC):
         pass
 
     @abstractmethod
-    def message_search(
+    async def message_search(
         self, query: str, user_id: UUID, limit: int
     ) -> SearchModel[MessageModel]:
         pass
 
     @abstractmethod
-    def message_index(self, message: StoredMessageModel) -> None:
+    def message_index(self, message: StoredMessageModel, user_id: UUID) -> None:
         pass
@@ -0,0 +1,31 @@
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import List, Optional
+
+
+class SemanticCacheImplementation(str, Enum):
+    NUMPY = "numpy"
+    QDRANT = "qdrant"
+
+
+class ISemanticCache(ABC):
+    """
+    Answers of previous queries, found by vector similarity.
+
+    Entries are isolated by scope, a query only matches the ones of the same scope.
+    """
+
+    @abstractmethod
+    async def lookup(
+        self, vector: List[float], scope: str, threshold: float
+    ) -> Optional[str]:
+        """
+        Get the answer of the most similar query not expired, if its score is at least the threshold.
+        """
+        pass
+
+    @abstractmethod
+    async def update(
+        self, vector: List[float], scope: str, answer: str, ttl_secs: int
+    ) -> None:
+        pass
@@ -1,12 +1,17 @@
 from .icache import ICache
 from abc import ABC, abstractmethod
+from datetime import date, datetime
 from enum import Enum
-from models.conversation import GetConversationModel, StoredConversationModel
+from models.conversation import (
+    GetConversationModel,
+    StoredConversationModel,
+    StoredConversationPageModel,
+)
 from models.message import MessageModel, IndexMessageModel, StoredMessageModel
 from models.readiness import ReadinessStatus
-from models.usage import UsageModel
+from models.usage import UsageModel, UsageRollupModel
 from models.user import UserModel
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from uuid import UUID
 
 
@@ -26,53 +31,113 @@ class IStore(ABC):
         pass
 
     @abstractmethod
-    def user_get(self, user_external_id: str) -> Optional[UserModel]:
+    async def user_get(self, user_external_id: str) -> Optional[UserModel]:
         pass
 
     @abstractmethod
-    def user_set(self, user: UserModel) -> None:
+    async def user_set(self, user: UserModel) -> None:
         pass
 
     @abstractmethod
-    def conversation_get(
+    async def conversation_get(
         self, conversation_id: UUID, user_id: UUID
     ) -> Optional[GetConversationModel]:
         pass
 
     @abstractmethod
-    def message_get_index(
+    async def message_get_index(
         self, messages: List[IndexMessageModel]
     ) -> Optional[List[MessageModel]]:
         pass
 
     @abstractmethod
-    def conversation_exists(self, conversation_id: UUID, user_id: UUID) -> bool:
+    async def conversation_exists(self, conversation_id: UUID, user_id: UUID) -> bool:
         pass
 
     @abstractmethod
-    def conversation_set(self, conversation: StoredConversationModel) -> None:
+    async def conversation_set(self, conversation: StoredConversationModel) -> None:
         pass
 
     @abstractmethod
-    def conversation_list(
-        self, user_id: UUID
-    ) -> Optional[List[StoredConversationModel]]:
+    async def conversation_summary_set(
+        self,
+        conversation_id: UUID,
+        user_id: UUID,
+        summary: Optional[str],
+        summary_until: datetime,
+    ) -> None:
+        """
+        Update the summary of a conversation. Summary is not part of the conversation list, which is not invalidated.
+        """
         pass
 
     @abstractmethod
-    def message_get(
+    async def conversation_title_set(
+        self, conversation_id: UUID, user_id: UUID, title: str
+    ) -> None:
+        """
+        Update the title of a conversation, without overwriting the other fields.
+        """
+        pass
+
+    @abstractmethod
+    async def conversation_user_id(self, conversation_id: UUID) -> Optional[UUID]:
+        pass
+
+    @abstractmethod
+    async def conversation_list(
+        self, user_id: UUID, limit: int, continuation: Optional[str] = None
+    ) -> StoredConversationPageModel:
+        """
+        List the conversations of a user, from the most recent.
+
+        Continuation is the opaque cursor returned with the previous page. Raises ValueError if it is invalid.
+        """
+        pass
+
+    @abstractmethod
+    async def message_get(
         self, message_id: UUID, conversation_id: UUID
     ) -> Optional[MessageModel]:
         pass
 
     @abstractmethod
-    def message_set(self, message: StoredMessageModel) -> None:
+    async def message_set(self, message: StoredMessageModel) -> None:
+        pass
+
+    @abstractmethod
+    async def message_list(
+        self,
+        conversation_id: UUID,
+        limit: Optional[int] = None,
+        before: Optional[Tuple[datetime, Optional[UUID]]] = None,
+    ) -> Optional[List[MessageModel]]:
+        """
+        List the messages of a conversation, from the oldest. Messages created at the same date are sorted by ID.
+
+        If limit is set, only the latest messages are returned. If before is set, as a date and an ID, only the messages strictly before it. Without ID, only the messages created strictly before the date.
+        """
+        pass
+
+    @abstractmethod
+    async def usage_set_batch(self, usages: List[UsageModel]) -> None:
+        """
+        Persist usage events. Writes are idempotent, a batch can be retried.
+        """
         pass
 
     @abstractmethod
-    def message_list(self, conversation_id: UUID) -> Optional[List[MessageModel]]:
+    async def usage_rollup_set(self, rollup: UsageRollupModel) -> None:
+        """
+        Set the rollup of the same user, day, model and prompt, if its counts are larger than the stored ones. Write is idempotent, a stale copy never overwrites a newer one.
+        """
         pass
 
     @abstractmethod
-    def usage_set(self, usage: UsageModel) -> None:
+    async def usage_rollup_list(
+        self, user_id: UUID, start: date, end: date
+    ) -> List[UsageRollupModel]:
+        """
+        List the rollups of a user, from start to end days, inclusive.
+        """
         pass
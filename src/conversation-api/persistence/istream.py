@@ -17,11 +17,11 @@ class IStream(ABC):
         pass
 
     @abstractmethod
-    def push(self, content: str, token: UUID) -> None:
+    async def push(self, content: str, token: UUID) -> None:
         pass
 
-    def end(self, token: UUID) -> None:
-        self.push(self.STOPWORD, token)
+    async def end(self, token: UUID) -> None:
+        await self.push(self.STOPWORD, token)
 
     @abstractmethod
     async def get(
@@ -0,0 +1,61 @@
+# Import utils
+from utils import build_logger
+
+# Import misc
+from .isemantic import ISemanticCache
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import time
+
+
+_logger = build_logger(__name__)
+
+
+class NumpySemanticCache(ISemanticCache):
+    """
+    In-process semantic cache, for tests and single instance deployments.
+
+    Entries are lost on restart. Each scope is bounded, the oldest entries are dropped first.
+    """
+
+    MAX_SIZE_PER_SCOPE: int = 10000
+    _scopes: Dict[str, Tuple[np.ndarray, List[str], np.ndarray]]
+
+    def __init__(self):
+        self._scopes = {}
+
+    async def lookup(
+        self, vector: List[float], scope: str, threshold: float
+    ) -> Optional[str]:
+        entry = self._scopes.get(scope)
+        if not entry:
+            return None
+        vectors, answers, expires_at = entry
+        # Dot product, as vectors are normalized
+        scores = vectors @ np.asarray(vector, dtype=np.float32)
+        scores[expires_at <= time.time()] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None
+        _logger.debug(f"Semantic cache hit with score {scores[best]}")
+        return answers[best]
+
+    async def update(
+        self, vector: List[float], scope: str, answer: str, ttl_secs: int
+    ) -> None:
+        row = np.asarray([vector], dtype=np.float32)
+        expiry = np.asarray([time.time() + ttl_secs])
+        entry = self._scopes.get(scope)
+        if not entry:
+            self._scopes[scope] = (row, [answer], expiry)
+            return
+        vectors, answers, expires_at = entry
+        # Expired and oldest entries are dropped
+        keep = np.flatnonzero(expires_at > time.time())[
+            -(self.MAX_SIZE_PER_SCOPE - 1) :
+        ]
+        self._scopes[scope] = (
+            np.vstack([vectors[keep], row]),
+            [answers[i] for i in keep] + [answer],
+            np.concatenate([expires_at[keep], expiry]),
+        )
@@ -1,9 +1,11 @@
 # Import utils
-from utils import build_logger, get_config
+from utils import build_logger, get_config, MicroBatcher
 
 # Import misc
+from .codec import decode, encode
 from .icache import ICache
 from .isearch import ISearch
+from .isemantic import ISemanticCache
 from .istore import IStore
 from ai.openai import OpenAI
 from datetime import datetime
@@ -11,50 +13,82 @@ from models.message import MessageModel, IndexMessageModel, StoredMessageModel
 from models.readiness import ReadinessStatus
 from models.search import SearchModel, SearchStatsModel, SearchAnswerModel
 from pydantic import ValidationError
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient
+from typing import Dict, List, Optional, Tuple
 from uuid import UUID, uuid4
 import asyncio
+import json
 import qdrant_client.http.models as qmodels
-import textwrap
 import time
 
 
 _logger = build_logger(__name__)
 QD_COLLECTION = "messages"
+QD_SEMANTIC_COLLECTION = "semantic-cache"
 QD_DIMENSION = 1536
+QD_GRPC_PORT = get_config(["persistence", "qdrant"], "grpc_port", int, default=6334)
 QD_HOST = get_config(["persistence", "qdrant"], "host", str, required=True)
-QD_PORT = 6333
+QD_KEEPALIVE_SECS = get_config(
+    ["persistence", "qdrant"], "keepalive_secs", int, default=30
+)
+QD_PORT = get_config(["persistence", "qdrant"], "port", int, default=6333)
+QD_TIMEOUT_SECS = get_config(["persistence", "qdrant"], "timeout_secs", int, default=10)
 QD_METRIC = qmodels.Distance.DOT
-client = QdrantClient(host=QD_HOST, port=6333)
+QD_RECENCY_HALF_LIFE_DAYS = get_config(
+    ["persistence", "qdrant"], "recency_half_life_days", float, default=30.0
+)
+QD_RECENCY_WEIGHT = get_config(
+    ["persistence", "qdrant"], "recency_weight", float, default=0.3
+)
+# A single client is shared, so its gRPC channel (HTTP/2 connection) is reused by all requests
+client = AsyncQdrantClient(
+    grpc_options={
+        # Ping idle connections, so they are not silently dropped by load balancers
+        "grpc.keepalive_permit_without_calls": 1,
+        "grpc.keepalive_time_ms": QD_KEEPALIVE_SECS * 1000,
+        "grpc.keepalive_timeout_ms": QD_TIMEOUT_SECS * 1000,
+    },
+    grpc_port=QD_GRPC_PORT,
+    host=QD_HOST,
+    port=QD_PORT,
+    prefer_grpc=True,
+    timeout=QD_TIMEOUT_SECS,
+)
+
+BACKFILL_CURSOR_KEY = "qdrant-backfill:user_id"
+BACKFILL_CURSOR_TTL_SECS = 60 * 60 * 24 * 7  # 7 days
 
 
 class QdrantSearch(ISearch):
+    _bootstrap_task: asyncio.Task
+    _index_batcher: MicroBatcher[Tuple[StoredMessageModel, UUID], None]
     _loop: asyncio.AbstractEventLoop
-    CACHE_TTL_SECS: int = 5 * 60  # 5 minutes
+    CACHE_TTL_SECS: int = 60 * 60  # 1 hour
+    INDEX_BATCH_MAX_SIZE: int = 64
+    INDEX_BATCH_MAX_WAIT_SECS: float = 0.05  # 50 ms
+    SEARCH_OVERFETCH: int = 4
+    SEARCH_VERSION_PREFIX: str = "message-search-version"
     openai: OpenAI
 
     def __init__(self, store: IStore, cache: ICache, openai: OpenAI):
         super().__init__(store, cache)
 
+        self._index_batcher = MicroBatcher(
+            flush=self._index_batch,
+            max_size=self.INDEX_BATCH_MAX_SIZE,
+            max_wait_secs=self.INDEX_BATCH_MAX_WAIT_SECS,
+        )
         self._loop = asyncio.get_running_loop()
         self.openai = openai
 
-        # Ensure collection exists
-        try:
-            client.get_collection(QD_COLLECTION)
-        except Exception:
-            client.create_collection(
-                collection_name=QD_COLLECTION,
-                vectors_config=qmodels.VectorParams(
-                    distance=QD_METRIC,
-                    size=QD_DIMENSION,
-                ),
-            )
+        # Client is async, collection is bootstrapped in the background and awaited before use
+        self._bootstrap_task = self._loop.create_task(self._bootstrap())
 
     async def readiness(self) -> ReadinessStatus:
         try:
+            await self._ensure_bootstrap()
             tmp_id = str(uuid4())
-            client.upsert(
+            await client.upsert(
                 collection_name=QD_COLLECTION,
                 points=[
                     qmodels.PointStruct(
@@ -64,91 +98,377 @@ class QdrantSearch(ISearch):
                     )
                 ],
             )
-            client.retrieve(collection_name=QD_COLLECTION, ids=[tmp_id])
-            client.delete(collection_name=QD_COLLECTION, points_selector=[tmp_id])
+            await client.retrieve(collection_name=QD_COLLECTION, ids=[tmp_id])
+            await client.delete(collection_name=QD_COLLECTION, points_selector=[tmp_id])
         except Exception:
             _logger.warn("Error connecting to Qdrant", exc_info=True)
             return ReadinessStatus.FAIL
         return ReadinessStatus.OK
 
-    def message_search(
+    async def message_search(
         self, q: str, user_id: UUID, limit: int
     ) -> SearchModel[MessageModel]:
         _logger.debug(f"Searching for: {q}")
         start = time.monotonic()
-        cache_key = f"message-search:{user_id}:{q}:{limit}"
+        version = await self.cache.get(self._search_version_key(user_id)) or "0"
+        cache_key = f"message-search:{user_id}:{version}:{q}:{limit}"
 
         try:
-            if self.cache.exists(cache_key):
+            raw = await self.cache.get(cache_key)
+            if raw:
                 _logger.debug(f'Cache hit for search message "{q}"')
-                return SearchModel[MessageModel].parse_raw(self.cache.get(cache_key))
-        except ValidationError as e:
+                return decode(raw, SearchModel[MessageModel])
+        except ValueError as e:
             _logger.warn(f'Error parsing message search from cache, "{e}"')
 
-        conversations = self.store.conversation_list(user_id) or []
-        vector = self.openai.vector_from_text(
-            textwrap.dedent(
-                f"""
-            Today, we are the {datetime.utcnow()}. {q.capitalize()}
-        """
-            )
+        # Query is embedded as is, so its vector can be cached
+        vector, _ = await asyncio.gather(
+            self.openai.vector_from_text(q), self._ensure_bootstrap()
         )
-        total = client.count(collection_name=QD_COLLECTION, exact=False).count
-        raws = client.search(
-            collection_name=QD_COLLECTION,
-            limit=limit,
-            query_filter=qmodels.Filter(
-                should=[
-                    qmodels.FieldCondition(
-                        key="conversation_id", match=qmodels.MatchValue(value=str(c.id))
-                    )
-                    for c in conversations
-                ]
+        # Count and search are independent, run them concurrently
+        count, raws = await asyncio.gather(
+            client.count(collection_name=QD_COLLECTION, exact=False),
+            # Over-fetch, so recency can reorder the candidates
+            client.search(
+                collection_name=QD_COLLECTION,
+                limit=limit * self.SEARCH_OVERFETCH,
+                query_filter=qmodels.Filter(
+                    must=[
+                        qmodels.FieldCondition(
+                            key="user_id", match=qmodels.MatchValue(value=str(user_id))
+                        )
+                    ]
+                ),
+                query_vector=vector,
+                search_params=qmodels.SearchParams(hnsw_ef=128, exact=False),
             ),
-            query_vector=vector,
-            search_params=qmodels.SearchParams(hnsw_ef=128, exact=False),
         )
+        total = count.count
 
         _logger.debug(f"Got {len(raws)} results from Qdrant")
 
-        index_messages = []
+        now = datetime.utcnow()
+        candidates: List[Tuple[IndexMessageModel, float]] = []
         for raw in raws:
             try:
-                index_messages.append(IndexMessageModel(**raw.payload))
+                index_message = IndexMessageModel(**raw.payload)
             except ValidationError as e:
                 _logger.warn(f'Error parsing index message, "{e}"')
+                continue
+            score = raw.score * self._recency_factor(index_message.created_at, now)
+            candidates.append((index_message, score))
+        candidates.sort(key=lambda x: x[1], reverse=True)  # Sort DESC
+        candidates = candidates[:limit]
 
-        messages = self.store.message_get_index(index_messages) or []
+        messages = await self.store.message_get_index([c[0] for c in candidates]) or []
         _logger.debug(f"Messages: {messages}")
 
+        scores = {index_message.id: score for index_message, score in candidates}
         search = SearchModel[MessageModel](
             answers=[
-                SearchAnswerModel[MessageModel](data=m, score=s)
-                for m, s in zip(messages, [raw.score for raw in raws])
+                SearchAnswerModel[MessageModel](data=m, score=scores[m.id])
+                for m in messages
+                if m.id in scores
             ],
             query=q,
             stats=SearchStatsModel(total=total, time=time.monotonic() - start),
         )
         # Update cache
-        self.cache.set(cache_key, search.json(), self.CACHE_TTL_SECS)
+        await self.cache.set(cache_key, encode(search), self.CACHE_TTL_SECS)
         return search
 
-    def message_index(self, message: StoredMessageModel) -> None:
+    def message_index(self, message: StoredMessageModel, user_id: UUID) -> None:
         _logger.debug(f'Indexing message "{message.id}"')
-        self._loop.create_task(self._index_background(message))
+        self._loop.create_task(self._index_background(message, user_id))
 
-    async def _index_background(self, message: StoredMessageModel) -> None:
+    async def _index_background(
+        self, message: StoredMessageModel, user_id: UUID
+    ) -> None:
         _logger.debug(f"Starting indexing worker for message: {message.id}")
+        try:
+            await self._index_batcher.submit((message, user_id))
+        except Exception:
+            _logger.error(f'Error indexing message "{message.id}"', exc_info=True)
+
+    async def _index_batch(
+        self, items: List[Tuple[StoredMessageModel, UUID]]
+    ) -> List[None]:
+        _logger.debug(f"Indexing batch of {len(items)} messages")
+
+        # Vectors are computed concurrently, the embeddings batcher groups them in a single request
+        vectors, _ = await asyncio.gather(
+            asyncio.gather(
+                *[self.openai.vector_from_text(message.content) for message, _ in items]
+            ),
+            self._ensure_bootstrap(),
+        )
+        points = [
+            qmodels.PointStruct(
+                id=message.id.hex,
+                # Serialized as JSON, so filters match the UUIDs as strings
+                payload=json.loads(
+                    IndexMessageModel(
+                        conversation_id=message.conversation_id,
+                        created_at=message.created_at,
+                        id=message.id,
+                        user_id=user_id,
+                    ).json()
+                ),
+                vector=vector,
+            )
+            for (message, user_id), vector in zip(items, vectors)
+        ]
 
-        vector = self.openai.vector_from_text(message.content)
-        index = IndexMessageModel(
-            conversation_id=message.conversation_id,
-            id=message.id,
+        await client.upsert(collection_name=QD_COLLECTION, points=points)
+
+        # Invalidate cached searches of the users
+        for user_id in set(user_id for _, user_id in items):
+            await self.cache.set(
+                self._search_version_key(user_id),
+                uuid4().hex,
+                self.CACHE_TTL_SECS * 2,  # Outlive the cached searches
+            )
+
+        return [None] * len(items)
+
+    async def _bootstrap(self) -> None:
+        # Ensure collection exists
+        try:
+            await client.get_collection(QD_COLLECTION)
+        except Exception:
+            await client.create_collection(
+                collection_name=QD_COLLECTION,
+                vectors_config=qmodels.VectorParams(
+                    distance=QD_METRIC,
+                    size=QD_DIMENSION,
+                ),
+            )
+
+        # Ensure payload indexes exist, search is filtered by them
+        await asyncio.gather(
+            *[
+                client.create_payload_index(
+                    collection_name=QD_COLLECTION,
+                    field_name=field_name,
+                    field_schema=qmodels.PayloadSchemaType.KEYWORD,
+                )
+                for field_name in ("conversation_id", "user_id")
+            ]
         )
 
-        client.upsert(
-            collection_name=QD_COLLECTION,
+        _logger.info(f'Collection "{QD_COLLECTION}" is ready')
+
+    async def _ensure_bootstrap(self) -> None:
+        """
+        Wait for the collection bootstrap. If it failed (e.g. Qdrant was not reachable at startup), it is retried.
+        """
+        try:
+            await asyncio.shield(self._bootstrap_task)
+        except Exception:
+            _logger.warn("Error bootstrapping Qdrant, retrying", exc_info=True)
+            if self._bootstrap_task.done():
+                self._bootstrap_task = self._loop.create_task(self._bootstrap())
+            await asyncio.shield(self._bootstrap_task)
+
+    def _recency_factor(self, created_at: Optional[datetime], now: datetime) -> float:
+        """
+        Time decay applied to the similarity score, from 1 for a new message, to 1 - weight for an old one.
+
+        Messages indexed without a date are considered old.
+        """
+        decay = 0.0
+        if created_at:
+            age_days = max((now - created_at).total_seconds(), 0) / (60 * 60 * 24)
+            decay = 0.5 ** (age_days / QD_RECENCY_HALF_LIFE_DAYS)
+        return 1 - QD_RECENCY_WEIGHT + QD_RECENCY_WEIGHT * decay
+
+    def _search_version_key(self, user_id: UUID) -> str:
+        return f"{self.SEARCH_VERSION_PREFIX}:{user_id.hex}"
+
+
+class QdrantSemanticCache(ISemanticCache):
+    """
+    Semantic cache in a dedicated collection, shared by all the instances.
+
+    Expired points are filtered at lookup, and purged in the background.
+    """
+
+    PURGE_INTERVAL_SECS: int = 60 * 60  # 1 hour
+    _bootstrap_task: asyncio.Task
+    _loop: asyncio.AbstractEventLoop
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        # Client is async, collection is bootstrapped in the background and awaited before use
+        self._bootstrap_task = self._loop.create_task(self._bootstrap())
+        self._loop.create_task(self._purge_background())
+
+    async def lookup(
+        self, vector: List[float], scope: str, threshold: float
+    ) -> Optional[str]:
+        await self._ensure_bootstrap()
+        raws = await client.search(
+            collection_name=QD_SEMANTIC_COLLECTION,
+            limit=1,
+            query_filter=qmodels.Filter(
+                must=[
+                    qmodels.FieldCondition(
+                        key="scope", match=qmodels.MatchValue(value=scope)
+                    ),
+                    qmodels.FieldCondition(
+                        key="expires_at", range=qmodels.Range(gt=time.time())
+                    ),
+                ]
+            ),
+            query_vector=vector,
+            score_threshold=threshold,
+        )
+        if not raws or not raws[0].payload:
+            return None
+        _logger.debug(f"Semantic cache hit with score {raws[0].score}")
+        return raws[0].payload.get("answer")
+
+    async def update(
+        self, vector: List[float], scope: str, answer: str, ttl_secs: int
+    ) -> None:
+        await self._ensure_bootstrap()
+        await client.upsert(
+            collection_name=QD_SEMANTIC_COLLECTION,
             points=[
-                qmodels.PointStruct(id=message.id.hex, payload=index, vector=vector)
+                qmodels.PointStruct(
+                    id=str(uuid4()),
+                    payload={
+                        "answer": answer,
+                        "expires_at": time.time() + ttl_secs,
+                        "scope": scope,
+                    },
+                    vector=vector,
+                )
             ],
         )
+
+    async def _bootstrap(self) -> None:
+        # Ensure collection exists
+        try:
+            await client.get_collection(QD_SEMANTIC_COLLECTION)
+        except Exception:
+            await client.create_collection(
+                collection_name=QD_SEMANTIC_COLLECTION,
+                vectors_config=qmodels.VectorParams(
+                    distance=QD_METRIC,
+                    size=QD_DIMENSION,
+                ),
+            )
+
+        # Ensure payload indexes exist, lookup is filtered by them
+        await asyncio.gather(
+            client.create_payload_index(
+                collection_name=QD_SEMANTIC_COLLECTION,
+                field_name="expires_at",
+                field_schema=qmodels.PayloadSchemaType.FLOAT,
+            ),
+            client.create_payload_index(
+                collection_name=QD_SEMANTIC_COLLECTION,
+                field_name="scope",
+                field_schema=qmodels.PayloadSchemaType.KEYWORD,
+            ),
+        )
+
+        _logger.info(f'Collection "{QD_SEMANTIC_COLLECTION}" is ready')
+
+    async def _ensure_bootstrap(self) -> None:
+        """
+        Wait for the collection bootstrap. If it failed (e.g. Qdrant was not reachable at startup), it is retried.
+        """
+        try:
+            await asyncio.shield(self._bootstrap_task)
+        except Exception:
+            _logger.warn("Error bootstrapping Qdrant, retrying", exc_info=True)
+            if self._bootstrap_task.done():
+                self._bootstrap_task = self._loop.create_task(self._bootstrap())
+            await asyncio.shield(self._bootstrap_task)
+
+    async def _purge_background(self) -> None:
+        while True:
+            await asyncio.sleep(self.PURGE_INTERVAL_SECS)
+            try:
+                await self._ensure_bootstrap()
+                await client.delete(
+                    collection_name=QD_SEMANTIC_COLLECTION,
+                    points_selector=qmodels.FilterSelector(
+                        filter=qmodels.Filter(
+                            must=[
+                                qmodels.FieldCondition(
+                                    key="expires_at",
+                                    range=qmodels.Range(lte=time.time()),
+                                )
+                            ]
+                        )
+                    ),
+                )
+            except Exception:
+                _logger.warn("Error purging the semantic cache", exc_info=True)
+
+
+async def backfill_user_id(store: IStore, cache: ICache, batch_size: int = 256) -> int:
+    """
+    Add the user ID to the payload of indexed messages which do not have it, by batches.
+
+    Messages indexed before the user ID was added cannot be found by search until backfilled. Backfill can be stopped and resumed, the scroll cursor is persisted in the cache after each batch.
+    """
+    offset = await cache.get(BACKFILL_CURSOR_KEY)
+    if offset:
+        _logger.info(f'Resuming backfill from point "{offset}"')
+    user_ids: Dict[str, Optional[UUID]] = {}
+    total = 0
+
+    while True:
+        points, next_offset = await client.scroll(
+            collection_name=QD_COLLECTION,
+            limit=batch_size,
+            offset=offset,
+            scroll_filter=qmodels.Filter(
+                must=[
+                    qmodels.IsEmptyCondition(
+                        is_empty=qmodels.PayloadField(key="user_id")
+                    )
+                ]
+            ),
+            with_payload=["conversation_id"],
+            with_vectors=False,
+        )
+
+        # Group by conversation, payload is updated once per conversation
+        point_ids: Dict[str, List[str]] = {}
+        for point in points:
+            conversation_id = (point.payload or {}).get("conversation_id")
+            if not conversation_id:
+                _logger.warn(f'Point "{point.id}" has no conversation ID, skipping')
+                continue
+            point_ids.setdefault(conversation_id, []).append(point.id)
+
+        for conversation_id, ids in point_ids.items():
+            if conversation_id not in user_ids:
+                user_ids[conversation_id] = await store.conversation_user_id(
+                    UUID(conversation_id)
+                )
+            user_id = user_ids[conversation_id]
+            if not user_id:
+                _logger.warn(f'Conversation "{conversation_id}" not found, skipping')
+                continue
+            await client.set_payload(
+                collection_name=QD_COLLECTION,
+                payload={"user_id": str(user_id)},
+                points=ids,
+            )
+            total += len(ids)
+
+        _logger.info(f"Backfilled {total} points")
+
+        if not next_offset:
+            await cache.delete(BACKFILL_CURSOR_KEY)
+            break
+        offset = next_offset
+        await cache.set(BACKFILL_CURSOR_KEY, str(offset), BACKFILL_CURSOR_TTL_SECS)
+
+    return total
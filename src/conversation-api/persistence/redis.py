@@ -1,11 +1,13 @@
 # Import utils
-from utils import build_logger, get_config
+from utils import build_logger, build_meter, get_config, LRUCache
 
 # Import misc
-from .icache import ICache
+from .codec import is_encoded
+from .icache import CacheValue, ICache
 from .istream import IStream
 from models.readiness import ReadinessStatus
-from redis import Redis
+from redis.asyncio import ConnectionPool, Redis
+from redis.asyncio.client import Pipeline
 from typing import (
     Any,
     AsyncGenerator,
@@ -15,135 +17,648 @@ from typing import (
     List,
     Literal,
     Optional,
+    Tuple,
     Union,
 )
 from uuid import UUID, uuid4
 import asyncio
+import json
 
 
 _logger = build_logger(__name__)
+_meter = build_meter(__name__)
 
 # Configuration
+DB_DB = get_config(["persistence", "redis"], "db", int, default=0)
 DB_HOST = get_config(["persistence", "redis"], "host", str, required=True)
-DB_PORT = 6379
+# Set to 0 to disable the L1 cache
+DB_L1_MAX_SIZE = get_config(["persistence", "redis"], "l1_max_size", int, default=5000)
+DB_L1_TTL_SECS = get_config(["persistence", "redis"], "l1_ttl_secs", int, default=60)
+DB_MAX_CONNECTIONS = get_config(
+    ["persistence", "redis"], "max_connections", int, default=100
+)
+DB_PORT = get_config(["persistence", "redis"], "port", int, default=6379)
+# Must be greater than the stream blocking time, otherwise XREAD would time out
+DB_TIMEOUT_SECS = get_config(["persistence", "redis"], "timeout_secs", int, default=30)
 
 # Redis client
-client = Redis(db=0, host=DB_HOST, port=DB_PORT)
+pool = ConnectionPool(
+    db=DB_DB,
+    host=DB_HOST,
+    max_connections=DB_MAX_CONNECTIONS,
+    port=DB_PORT,
+    socket_connect_timeout=DB_TIMEOUT_SECS,
+    socket_timeout=DB_TIMEOUT_SECS,
+)
+client = Redis(connection_pool=pool)
+
+# Scripts are atomic, and executed in a single round trip
+# Args: TTL, invalidation channel, invalidation payload, fields
+_hset_append_script = client.register_script(
+    """
+    redis.call("INCR", KEYS[2])
+    redis.call("EXPIRE", KEYS[2], ARGV[1] * 2)  -- Outlive the hash
+    local res = 0
+    if redis.call("EXISTS", KEYS[1]) == 1 then
+        for i = 4, #ARGV, 2 do
+            redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+        redis.call("EXPIRE", KEYS[1], ARGV[1])
+        res = 1
+    end
+    if ARGV[3] ~= "" then
+        redis.call("PUBLISH", ARGV[2], ARGV[3])
+    end
+    return res
+    """
+)
+# Args: expected version, TTL, invalidation channel, invalidation payload, fields
+_hset_guarded_script = client.register_script(
+    """
+    if (redis.call("GET", KEYS[2]) or "") ~= ARGV[1] then
+        return 0
+    end
+    redis.call("DEL", KEYS[1])
+    for i = 5, #ARGV, 2 do
+        redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    redis.call("EXPIRE", KEYS[1], ARGV[2])
+    if ARGV[4] ~= "" then
+        redis.call("PUBLISH", ARGV[3], ARGV[4])
+    end
+    return 1
+    """
+)
+
+# Args: TTL, invalidation channel, invalidation payload, fields
+_hset_max_script = client.register_script(
+    """
+    for i = 4, #ARGV, 2 do
+        local current = tonumber(redis.call("HGET", KEYS[1], ARGV[i]) or "0")
+        if tonumber(ARGV[i + 1]) > current then
+            redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+    end
+    redis.call("EXPIRE", KEYS[1], ARGV[1])
+    if ARGV[3] ~= "" then
+        redis.call("PUBLISH", ARGV[2], ARGV[3])
+    end
+    return 1
+    """
+)
 
 
 async def _readiness() -> ReadinessStatus:
     try:
         tmp_id = str(uuid4())
-        client.set(tmp_id, "dummy")
-        client.get(tmp_id)
-        client.delete(tmp_id)
+        await client.set(tmp_id, "dummy")
+        await client.get(tmp_id)
+        await client.delete(tmp_id)
     except Exception:
         _logger.warn("Error connecting to Redis", exc_info=True)
         return ReadinessStatus.FAIL
     return ReadinessStatus.OK
 
 
+class RedisStreamDispatcher:
+    """
+    Read all the streams subscribed in the process with a single XREAD loop, and fan out the entries to the subscribers queues.
+
+    Each subscriber has its own cursor, so a late subscriber still receives the stream from its start. A subscription wakes up the blocked XREAD by writing to a stream dedicated to the process.
+    """
+
+    BLOCK_MS: int = 5_000  # 5 seconds
+    CONTROL_PREFIX: str = "stream-dispatcher"
+    CONTROL_TTL_SECS: int = 60 * 60  # 1 hour
+    RETRY_SECS: int = 1
+    _control_cursor: bytes
+    _control_key: str
+    _loop: asyncio.AbstractEventLoop
+    _subscribers: Dict[str, Dict[asyncio.Queue, Tuple[int, int]]]
+    _task: Optional[asyncio.Task]
+
+    def __init__(self):
+        self._control_cursor = b"0-0"
+        self._control_key = f"{self.CONTROL_PREFIX}:{uuid4().hex}"
+        self._loop = asyncio.get_running_loop()
+        self._subscribers = {}
+        self._task = None
+
+    async def subscribe(self, key: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(key, {})[queue] = (0, 0)
+        _logger.debug(
+            f'Subscribed to stream "{key}" ({self.subscriptions()} subscriptions)'
+        )
+
+        if self._task and not self._task.done():
+            # Wake up the running XREAD, so it reads the new key
+            async with client.pipeline(transaction=False) as pipe:
+                pipe.xadd(self._control_key, {"key": key}, maxlen=16, approximate=True)
+                pipe.expire(self._control_key, self.CONTROL_TTL_SECS)
+                await pipe.execute()
+        else:
+            self._task = self._loop.create_task(self._run())
+
+        return queue
+
+    def unsubscribe(self, key: str, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(key, {})
+        queues.pop(queue, None)
+        if not queues:
+            self._subscribers.pop(key, None)
+        _logger.debug(
+            f'Unsubscribed from stream "{key}" ({self.subscriptions()} subscriptions)'
+        )
+
+    def subscriptions(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    async def _run(self) -> None:
+        """
+        Dispatch until there are no more subscribers. Errors are logged and the read is retried, so the streams of the process never stop being served.
+        """
+        _logger.info("Starting stream dispatcher")
+
+        while self._subscribers:
+            try:
+                await self._dispatch()
+            except Exception:
+                _logger.error("Error dispatching streams, retrying", exc_info=True)
+                await asyncio.sleep(self.RETRY_SECS)
+
+        _logger.info("No more subscribers, stopping stream dispatcher")
+
+    async def _dispatch(self) -> None:
+        # Read each stream from the oldest cursor of its subscribers
+        streams = {
+            key: self._format_id(min(queues.values()))
+            for key, queues in self._subscribers.items()
+        }
+        streams[self._control_key] = self._control_cursor
+
+        res = await client.xread(block=self.BLOCK_MS, streams=streams)
+
+        for raw_key, entries in res or []:
+            key = raw_key.decode("utf-8")
+
+            if key == self._control_key:
+                self._control_cursor = entries[-1][0]
+                continue
+
+            queues = self._subscribers.get(key, {})
+            for raw_id, fields in entries:
+                entry_id = self._parse_id(raw_id)
+                try:
+                    message = fields[b"message"].decode("utf-8")
+                except (KeyError, UnicodeDecodeError):
+                    _logger.warn(f'Skipping invalid entry {raw_id} of stream "{key}"')
+                    message = None
+                for queue, cursor in queues.items():
+                    if entry_id <= cursor:
+                        continue
+                    # Cursor moves past invalid entries too, so they are not read again
+                    queues[queue] = entry_id
+                    if message is None:
+                        continue
+                    try:
+                        queue.put_nowait(message)
+                    except Exception:
+                        _logger.warn(
+                            f'Error sending entry to a subscriber of stream "{key}"',
+                            exc_info=True,
+                        )
+
+    def _format_id(self, entry_id: Tuple[int, int]) -> str:
+        return f"{entry_id[0]}-{entry_id[1]}"
+
+    def _parse_id(self, raw_id: bytes) -> Tuple[int, int]:
+        ms, seq = raw_id.decode("utf-8").split("-")
+        return (int(ms), int(seq))
+
+
 class RedisStream(IStream):
     STREAM_PREFIX: str = "stream"
+    TIMEOUT_SECS: int = 10  # 10 seconds
+    _dispatcher: RedisStreamDispatcher
+
+    def __init__(self):
+        self._dispatcher = RedisStreamDispatcher()
 
     async def readiness(self) -> ReadinessStatus:
         return await _readiness()
 
-    def push(self, content: str, token: UUID) -> None:
-        client.xadd(self._key(token), {"message": content})
+    async def push(self, content: str, token: UUID) -> None:
+        await client.xadd(self._key(token), {"message": content})
 
     async def get(
         self, token: UUID, loop_func: Callable[[], Awaitable[bool]]
     ) -> AsyncGenerator[str, None]:
-        stream_id = 0
-        is_end = False
+        message_key = self._key(token)
+        queue = await self._dispatcher.subscribe(message_key)
 
-        while True:
-            # If the stream is ended, stop sending events
-            if is_end:
-                break
-
-            if await loop_func():
-                # If the loop function returns True, stop sending events
-                break
-
-            message_key = self._key(token)
-            messages_raw = client.xread(
-                block=10_000,  # Wait 10 seconds
-                streams={message_key: stream_id},
-            )
-
-            if not messages_raw:
-                break
-
-            for message_content in messages_raw[0][1]:
-                stream_id = message_content[0]
-                message = message_content[1][b"message"].decode("utf-8")
+        try:
+            while True:
+                if await loop_func():
+                    # If the loop function returns True, stop sending events
+                    break
+
+                try:
+                    message = await asyncio.wait_for(
+                        queue.get(), timeout=self.TIMEOUT_SECS
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+                # If the stream is ended, stop sending events
                 if message == self.STOPWORD:
-                    is_end = True
                     break
                 yield message
-
-            # 8 messages per second, enough for give a good user experience, but not too much for not using the thread too much
-            await asyncio.sleep(0.125)
+        finally:
+            self._dispatcher.unsubscribe(message_key, queue)
 
         # Send the end of stream message
         yield self.STOPWORD
 
     async def clean(self, token: UUID) -> None:
-        client.delete(self._key(token))
+        await client.delete(self._key(token))
 
     def _key(self, token: UUID) -> str:
         return f"{self.STREAM_PREFIX}:{token.hex}"
 
 
 class RedisCache(ICache):
+    """
+    Redis cache, with a process-local L1 cache in front of it.
+
+    Writes update the local L1 cache, and publish the written keys, so the other processes drop them from their L1 cache. L1 cache is bypassed while the invalidation channel is not subscribed, as invalidations could be missed.
+    """
+
     CACHE_TTL_SECS = 60 * 60  # 1 hour
+    INVALIDATION_CHANNEL: str = "cache-invalidation"
+    INVALIDATION_TIMEOUT_SECS: int = 5  # Must be lower than the socket timeout
+    RETRY_SECS: int = 1
+    _instance_id: str
+    _l1: LRUCache[str, Union[CacheValue, Dict[str, CacheValue]]]
+    _l1_epoch: int
+    _l1_ready: bool
+    _loop: asyncio.AbstractEventLoop
+    _task: Optional[asyncio.Task]
+
+    def __init__(self):
+        self._instance_id = uuid4().hex
+        self._l1 = LRUCache(max_size=DB_L1_MAX_SIZE, ttl_secs=DB_L1_TTL_SECS)
+        self._l1_epoch = 0
+        self._l1_ready = False
+        self._loop = asyncio.get_running_loop()
+        self._task = None
+
+        # Metrics
+        self._l1_hits = _meter.create_counter(
+            description="Number of cache reads served from the process memory.",
+            name="cache.l1.hit",
+        )
+        self._l1_misses = _meter.create_counter(
+            description="Number of cache reads sent to Redis.",
+            name="cache.l1.miss",
+        )
+
+        if DB_L1_MAX_SIZE:
+            self._task = self._loop.create_task(self._invalidation_listen())
 
     async def readiness(self) -> ReadinessStatus:
         return await _readiness()
 
-    def exists(self, key: str) -> bool:
-        return client.exists(key) != 0
-
-    def get(self, key: str) -> Optional[str]:
-        raw = client.get(key)
+    async def exists(self, key: str) -> bool:
+        if self._l1_get(key) is not None:
+            return True
+        return await client.exists(key) != 0
+
+    async def get(self, key: str) -> Optional[CacheValue]:
+        value = self._l1_get(key)
+        if value is not None:
+            return value
+        epoch = self._l1_epoch
+        raw = await client.get(key)
         if raw is None:
             return None
-        return raw.decode("utf-8")
+        value = self._decode(raw)
+        self._l1_set(key, value, epoch)
+        return value
 
-    def set(self, key: str, value: str, expiry: Optional[int] = None) -> None:
-        client.set(key, value, ex=(expiry or self.CACHE_TTL_SECS))
-
-    def delete(self, key: str) -> None:
-        client.delete(key)
+    async def set(
+        self, key: str, value: CacheValue, expiry: Optional[int] = None
+    ) -> None:
+        await self._set(key, value, expiry)
+
+    async def get_bytes(self, key: str) -> Optional[bytes]:
+        value = self._l1_get(key)
+        if value is not None:
+            return value
+        epoch = self._l1_epoch
+        raw = await client.get(key)
+        if raw is None:
+            return None
+        self._l1_set(key, raw, epoch)
+        return raw
 
-    def hget(self, key: str) -> Optional[Dict[str, str]]:
-        raw = client.hgetall(key)
+    async def set_bytes(
+        self, key: str, value: bytes, expiry: Optional[int] = None
+    ) -> None:
+        await self._set(key, value, expiry)
+
+    async def delete(self, key: str) -> None:
+        self._l1_invalidate([key])
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.delete(key)
+            self._invalidation_publish(pipe, [key])
+            await pipe.execute()
+
+    async def hget(
+        self, key: str, fresh: bool = False
+    ) -> Optional[Dict[str, CacheValue]]:
+        value = None if fresh else self._l1_get(key)
+        if value is not None:
+            return value
+        epoch = self._l1_epoch
+        raw = await client.hgetall(key)
         if not raw:
             return None
-        return {k.decode("utf-8"): v.decode("utf-8") for k, v in raw.items()}
+        value = {k.decode("utf-8"): self._decode(v) for k, v in raw.items()}
+        self._l1_set(key, value, epoch)
+        return value
 
-    def hset(
-        self, key: str, mapping: Dict[str, str], expiry: Optional[int] = None
+    async def hset(
+        self, key: str, mapping: Dict[str, CacheValue], expiry: Optional[int] = None
     ) -> None:
         if not mapping:
             return
-        client.hset(key, mapping=mapping)
+        # Fields are merged with the existing ones in Redis, local copy is outdated
+        self._l1_invalidate([key])
         # TTL is not supported by hset, so we need to set it manually (https://github.com/redis/redis/issues/167#issuecomment-427708753)
-        client.expire(key, (expiry or self.CACHE_TTL_SECS))
-
-    def mget(self, keys: Union[str, List[str]]) -> Dict[str, Optional[str]]:
-        raws = client.mget(keys)
-        if not raws:
-            return {}
-        return {
-            keys[i]: (raw.decode("utf-8") if raw else None)
-            for i, raw in enumerate(raws)
-        }
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, (expiry or self.CACHE_TTL_SECS))
+            self._invalidation_publish(pipe, [key])
+            await pipe.execute()
+
+    async def hset_append(
+        self,
+        key: str,
+        mapping: Dict[str, CacheValue],
+        version_key: str,
+        expiry: Optional[int] = None,
+    ) -> bool:
+        """
+        Add the fields to the hash, only if it is already cached, and bump its version.
+
+        Version is bumped even if the hash is not cached, so a concurrent "hset_guarded" with the previous version is rejected. Returns True if the fields were added.
+        """
+        if not mapping:
+            return False
+        keys = [key, version_key]
+        self._l1_invalidate(keys)
+        res = await _hset_append_script(
+            args=[
+                (expiry or self.CACHE_TTL_SECS),
+                self.INVALIDATION_CHANNEL,
+                self._invalidation_payload(keys),
+                *self._flatten(mapping),
+            ],
+            client=client,
+            keys=keys,
+        )
+        return res == 1
+
+    async def hset_guarded(
+        self,
+        key: str,
+        mapping: Dict[str, CacheValue],
+        version_key: str,
+        version: Optional[str],
+        expiry: Optional[int] = None,
+    ) -> bool:
+        """
+        Replace the hash, only if its version did not change since it was read.
+
+        Used to cache a value read from the source of truth, without overwriting the writes which happened meanwhile. Returns True if the hash was replaced.
+        """
+        if not mapping:
+            return False
+        self._l1_invalidate([key])
+        res = await _hset_guarded_script(
+            args=[
+                version or "",
+                (expiry or self.CACHE_TTL_SECS),
+                self.INVALIDATION_CHANNEL,
+                self._invalidation_payload([key]),
+                *self._flatten(mapping),
+            ],
+            client=client,
+            keys=[key, version_key],
+        )
+        return res == 1
+
+    async def hincrby(
+        self, increments: Dict[str, Dict[str, int]], expiry: Optional[int] = None
+    ) -> None:
+        if not increments:
+            return
+        keys = list(increments.keys())
+        # Fields are incremented in Redis, local copy is outdated
+        self._l1_invalidate(keys)
+        async with client.pipeline(transaction=True) as pipe:
+            for key, fields in increments.items():
+                for field, value in fields.items():
+                    pipe.hincrby(key, field, value)
+                pipe.expire(key, (expiry or self.CACHE_TTL_SECS))
+            self._invalidation_publish(pipe, keys)
+            await pipe.execute()
+
+    async def hset_max(
+        self, key: str, mapping: Dict[str, int], expiry: Optional[int] = None
+    ) -> None:
+        if not mapping:
+            return
+        self._l1_invalidate([key])
+        await _hset_max_script(
+            args=[
+                (expiry or self.CACHE_TTL_SECS),
+                self.INVALIDATION_CHANNEL,
+                self._invalidation_payload([key]),
+                *self._flatten(mapping),
+            ],
+            client=client,
+            keys=[key],
+        )
+
+    async def mget(
+        self, keys: Union[str, List[str]]
+    ) -> Dict[str, Optional[CacheValue]]:
+        if isinstance(keys, str):
+            keys = [keys]
+        res: Dict[str, Optional[CacheValue]] = {}
+        misses: List[str] = []
+        for key in keys:
+            value = self._l1_get(key)
+            res[key] = value
+            if value is None:
+                misses.append(key)
+        if not misses:
+            return res
+
+        epoch = self._l1_epoch
+        raws = await client.mget(misses)
+        for key, raw in zip(misses, raws or []):
+            if raw is None:
+                continue
+            value = self._decode(raw)
+            self._l1_set(key, value, epoch)
+            res[key] = value
+        return res
+
+    async def mset(
+        self,
+        mapping: Dict[str, CacheValue],
+        expiry: Optional[int] = None,
+        indexes: Optional[Dict[str, Dict[str, float]]] = None,
+    ) -> None:
+        """
+        Set the keys, and add the members to the sorted set indexes, in a single transaction.
 
-    def mset(self, mapping: Dict[str, str], expiry: Optional[int] = None) -> None:
-        client.mset(mapping)
-        # TTL is not supported by hset, so we need to set it manually (https://github.com/redis/redis/issues/167#issuecomment-427708753)
-        for key in mapping.keys():
-            client.expire(key, (expiry or self.CACHE_TTL_SECS))
+        Indexes TTL is only extended, so an index outlives all the keys it references.
+        """
+        if not mapping:
+            return
+        ttl = expiry or self.CACHE_TTL_SECS
+        epoch = self._l1_invalidate(list(mapping.keys()))
+        # TTL is not supported by mset, so we need to set it manually (https://github.com/redis/redis/issues/167#issuecomment-427708753)
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.mset(mapping)
+            for key in mapping.keys():
+                pipe.expire(key, ttl)
+            for index_key, members in (indexes or {}).items():
+                pipe.zadd(index_key, members)
+                pipe.expire(index_key, ttl, nx=True)  # New index
+                pipe.expire(index_key, ttl, gt=True)  # Existing index
+            self._invalidation_publish(pipe, list(mapping.keys()))
+            await pipe.execute()
+        for key, value in mapping.items():
+            self._l1_set(key, value, epoch, expiry)
+
+    async def zrange(
+        self,
+        key: str,
+        desc: bool = False,
+        exclusive: bool = False,
+        limit: Optional[int] = None,
+        max_score: Optional[float] = None,
+        min_score: Optional[float] = None,
+    ) -> List[str]:
+        prefix = "(" if exclusive else ""
+        min_arg = "-inf" if min_score is None else f"{prefix}{min_score}"
+        max_arg = "+inf" if max_score is None else f"{prefix}{max_score}"
+        raws = await client.zrange(
+            byscore=True,
+            desc=desc,
+            # Bounds are reversed when sorted DESC
+            end=(min_arg if desc else max_arg),
+            name=key,
+            num=limit,
+            offset=(0 if limit is not None else None),
+            start=(max_arg if desc else min_arg),
+        )
+        return [raw.decode("utf-8") for raw in raws]
+
+    async def _set(
+        self, key: str, value: Union[str, bytes], expiry: Optional[int] = None
+    ) -> None:
+        epoch = self._l1_invalidate([key])
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.set(key, value, ex=(expiry or self.CACHE_TTL_SECS))
+            self._invalidation_publish(pipe, [key])
+            await pipe.execute()
+        self._l1_set(key, value, epoch, expiry)
+
+    def _decode(self, raw: bytes) -> CacheValue:
+        return raw if is_encoded(raw) else raw.decode("utf-8")
+
+    def _l1_get(self, key: str) -> Optional[Union[CacheValue, Dict[str, CacheValue]]]:
+        if not self._l1_ready:
+            return None
+        value = self._l1.get(key)
+        if value is None:
+            self._l1_misses.add(1)
+        else:
+            self._l1_hits.add(1)
+        return value
+
+    def _l1_set(
+        self,
+        key: str,
+        value: Union[CacheValue, Dict[str, CacheValue]],
+        epoch: int,
+        expiry: Optional[int] = None,
+    ) -> None:
+        if not self._l1_ready:
+            return
+        if epoch != self._l1_epoch:
+            # Keys were invalidated while the value was read or written, it may be outdated
+            return
+        # Never outlive the Redis entry
+        self._l1.set(key, value, min(expiry or DB_L1_TTL_SECS, DB_L1_TTL_SECS))
+
+    def _l1_invalidate(self, keys: List[str]) -> int:
+        self._l1_epoch += 1
+        for key in keys:
+            self._l1.delete(key)
+        return self._l1_epoch
+
+    def _invalidation_publish(self, pipe: Pipeline, keys: List[str]) -> None:
+        if not DB_L1_MAX_SIZE:
+            return
+        pipe.publish(self.INVALIDATION_CHANNEL, self._invalidation_payload(keys))
+
+    def _invalidation_payload(self, keys: List[str]) -> str:
+        """
+        Empty payload is not published, when the L1 cache is disabled.
+        """
+        if not DB_L1_MAX_SIZE:
+            return ""
+        return json.dumps({"keys": keys, "sender": self._instance_id})
+
+    def _flatten(self, mapping: Dict[str, CacheValue]) -> List[CacheValue]:
+        return [item for pair in mapping.items() for item in pair]
+
+    async def _invalidation_listen(self) -> None:
+        _logger.info("Starting cache invalidation listener")
+
+        while True:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.INVALIDATION_CHANNEL)
+                self._l1_ready = True
+                _logger.debug("L1 cache enabled")
+
+                while True:
+                    message = await pubsub.get_message(
+                        timeout=self.INVALIDATION_TIMEOUT_SECS
+                    )
+                    if not message:
+                        continue
+                    data = json.loads(message["data"])
+                    if data["sender"] == self._instance_id:
+                        continue
+                    self._l1_invalidate(data["keys"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                _logger.warn("Error listening cache invalidations", exc_info=True)
+            finally:
+                # Invalidations may have been missed, local copies cannot be trusted anymore
+                self._l1_ready = False
+                self._l1.clear()
+                _logger.debug("L1 cache disabled")
+                await pubsub.close()
+
+            await asyncio.sleep(self.RETRY_SECS)
@@ -0,0 +1,253 @@
+# Import utils
+from utils import build_logger, build_meter, get_config
+
+# Import misc
+from .icache import ICache
+from .istore import IStore
+from datetime import date, datetime, timedelta
+from models.usage import UsageModel, UsageRollupModel
+from typing import Dict, List, Optional
+from uuid import UUID
+import asyncio
+import json
+
+
+_logger = build_logger(__name__)
+_meter = build_meter(__name__)
+
+# Configuration
+USAGE_BATCH_SIZE = get_config(["persistence", "usage"], "batch_size", int, default=100)
+USAGE_FLUSH_INTERVAL_SECS = get_config(
+    ["persistence", "usage"], "flush_interval_secs", int, default=5
+)
+USAGE_MAX_BUFFER_SIZE = get_config(
+    ["persistence", "usage"], "max_buffer_size", int, default=10000
+)
+
+
+class UsageBuffer:
+    """
+    Usage accounting, out of the request path.
+
+    Requests and tokens are counted by user, day, model and prompt with Redis HINCRBY, when the usage is recorded. Counters for all users are kept under the nil UUID. Each increment also counts the user in an index of the day, so the counters to persist are known, even after a restart.
+
+    Counters are copied to the store rollups at each flush. Copies are absolute values and the store keeps the largest ones, so a copy can be retried, or done concurrently by another process. Counters already copied are tracked in the cache, so they are not copied again by the other processes, nor after a restart.
+
+    Raw events are buffered in memory, then persisted by batch, when the buffer reaches the batch size or after an interval. Buffer is bounded, the oldest events are dropped if the store is unavailable for long.
+    """
+
+    ALL_USERS_ID: UUID = UUID(int=0)
+    COUNTER_DAYS: int = 7
+    COUNTER_INDEX_PREFIX: str = "usage-counter-index"
+    COUNTER_PREFIX: str = "usage-counter"
+    COUNTER_SYNCED_PREFIX: str = "usage-counter-synced"
+    _events: List[UsageModel]
+    _flush_task: Optional[asyncio.Task]
+    _increments: Dict[str, Dict[str, int]]
+    _loop: asyncio.AbstractEventLoop
+    _task: asyncio.Task
+    cache: ICache
+    store: IStore
+
+    def __init__(self, store: IStore, cache: ICache):
+        self._events = []
+        self._flush_task = None
+        self._increments = {}
+        self._loop = asyncio.get_running_loop()
+        self.cache = cache
+        self.store = store
+
+        # Metrics
+        self._dropped = _meter.create_counter(
+            description="Number of usage events dropped, as the buffer was full.",
+            name="usage.event.dropped",
+        )
+        self._flushes = _meter.create_counter(
+            description="Number of usage batches persisted, by result.",
+            name="usage.flush",
+        )
+
+        self._task = self._loop.create_task(self._flush_loop())
+
+    async def record(self, usage: UsageModel) -> None:
+        """
+        Record a usage event. Counters are incremented before returning, the event is persisted in the background.
+        """
+        day = usage.created_at.date()
+        dimensions = [usage.ai_model, usage.prompt_name]
+        index = {}
+        increments = {self._counter_index_key(day): index}
+        for user_id in (usage.user_id, self.ALL_USERS_ID):
+            increments[self._counter_key(user_id, day)] = {
+                json.dumps([*dimensions, "requests"]): 1,
+                json.dumps([*dimensions, "tokens"]): usage.tokens,
+            }
+            index[user_id.hex] = 1
+        try:
+            await self.cache.hincrby(increments, self._counter_ttl_secs())
+        except Exception:
+            _logger.error("Error incrementing usage counters", exc_info=True)
+            # Retried at the next flush
+            self._increments_merge(increments)
+
+        self._events.append(usage)
+        self._trim()
+        if len(self._events) >= USAGE_BATCH_SIZE:
+            self._flush()
+
+    async def close(self) -> None:
+        """
+        Persist the buffered usage, to not lose it on shutdown.
+        """
+        self._task.cancel()
+        # First call waits for the flush in progress, second one persists the rest
+        await self._flush()
+        await self._flush()
+        if self._events or self._increments:
+            _logger.error(
+                f"{len(self._events)} usage events and {len(self._increments)} counters lost on shutdown"
+            )
+
+    def _flush(self) -> asyncio.Task:
+        """
+        Persist the buffered usage, sharing the flush in progress if any.
+        """
+        if not self._flush_task or self._flush_task.done():
+            self._flush_task = self._loop.create_task(self._flush_background())
+        return self._flush_task
+
+    async def _flush_background(self) -> None:
+        if self._increments:
+            increments, self._increments = self._increments, {}
+            try:
+                await self.cache.hincrby(increments, self._counter_ttl_secs())
+            except asyncio.CancelledError:
+                self._increments_merge(increments)
+                raise
+            except Exception:
+                _logger.error("Error incrementing usage counters", exc_info=True)
+                self._increments_merge(increments)
+
+        try:
+            await self._rollups_sync()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Counters are kept in the cache, the copy is retried at the next flush
+            _logger.error("Error persisting usage rollups", exc_info=True)
+
+        while self._events:
+            batch = self._events[:USAGE_BATCH_SIZE]
+            del self._events[:USAGE_BATCH_SIZE]
+            try:
+                await self.store.usage_set_batch(batch)
+                self._flushes.add(1, {"result": "ok"})
+            except asyncio.CancelledError:
+                self._events[:0] = batch
+                raise
+            except Exception:
+                self._flushes.add(1, {"result": "error"})
+                _logger.error(
+                    f"Error persisting {len(batch)} usage events", exc_info=True
+                )
+                # Requeued in front, store writes are idempotent
+                self._events[:0] = batch
+                self._trim()
+                break
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL_SECS)
+            # Shielded, cancelling the loop on close must not cancel the flush close waits for
+            await asyncio.shield(self._flush())
+
+    async def _rollups_sync(self) -> None:
+        """
+        Copy to the store the counters changed since the last copy.
+
+        Counters of the last days are checked, so the copy catches up after an outage. Counters are read fresh, a copy in memory may be outdated and would be marked as copied.
+        """
+        today = datetime.utcnow().date()
+        days = [today - timedelta(days=i) for i in range(self.COUNTER_DAYS)]
+        indexes, synced = await asyncio.gather(
+            asyncio.gather(
+                *[
+                    self.cache.hget(self._counter_index_key(day), fresh=True)
+                    for day in days
+                ]
+            ),
+            asyncio.gather(
+                *[
+                    self.cache.hget(self._counter_synced_key(day), fresh=True)
+                    for day in days
+                ]
+            ),
+        )
+        for day, index, day_synced in zip(days, indexes, synced):
+            for user_hex, raw in (index or {}).items():
+                # Number of requests of the user this day, it only grows
+                requests = int(raw)
+                if int((day_synced or {}).get(user_hex, 0)) >= requests:
+                    continue
+                user_id = UUID(user_hex)
+                fields = await self.cache.hget(
+                    self._counter_key(user_id, day), fresh=True
+                )
+                await asyncio.gather(
+                    *[
+                        self.store.usage_rollup_set(rollup)
+                        for rollup in self._counter_parse(user_id, day, fields or {})
+                    ]
+                )
+                # Largest count wins, if another process copied more recent counters
+                await self.cache.hset_max(
+                    self._counter_synced_key(day),
+                    {user_hex: requests},
+                    self._counter_ttl_secs(),
+                )
+
+    def _counter_parse(
+        self, user_id: UUID, day: date, fields: Dict[str, str]
+    ) -> List[UsageRollupModel]:
+        # Fields are named after the model, the prompt and the metric
+        metrics = {}
+        for field, value in fields.items():
+            ai_model, prompt_name, metric = json.loads(field)
+            metrics.setdefault((ai_model, prompt_name), {})[metric] = int(value)
+        return [
+            UsageRollupModel(
+                ai_model=ai_model,
+                day=day,
+                prompt_name=prompt_name,
+                requests=values.get("requests", 0),
+                tokens=values.get("tokens", 0),
+                user_id=user_id,
+            )
+            for (ai_model, prompt_name), values in metrics.items()
+        ]
+
+    def _increments_merge(self, increments: Dict[str, Dict[str, int]]) -> None:
+        for key, fields in increments.items():
+            pending = self._increments.setdefault(key, {})
+            for field, value in fields.items():
+                pending[field] = pending.get(field, 0) + value
+
+    def _trim(self) -> None:
+        overflow = len(self._events) - USAGE_MAX_BUFFER_SIZE
+        if overflow > 0:
+            _logger.warning(f"Usage buffer is full, dropping {overflow} events")
+            self._dropped.add(overflow)
+            del self._events[:overflow]
+
+    def _counter_ttl_secs(self) -> int:
+        # Counters outlive the days they are copied for
+        return (self.COUNTER_DAYS + 1) * 24 * 60 * 60
+
+    def _counter_key(self, user_id: UUID, day: date) -> str:
+        return f"{self.COUNTER_PREFIX}:{user_id.hex}:{day.isoformat()}"
+
+    def _counter_index_key(self, day: date) -> str:
+        return f"{self.COUNTER_INDEX_PREFIX}:{day.isoformat()}"
+
+    def _counter_synced_key(self, day: date) -> str:
+        return f"{self.COUNTER_SYNCED_PREFIX}:{day.isoformat()}"
@@ -5,14 +5,16 @@ load_dotenv(find_dotenv())
 
 # Import modules
 from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
 from azure.monitor.opentelemetry.exporter import (
     AzureMonitorLogExporter,
     AzureMonitorMetricExporter,
     AzureMonitorTraceExporter,
 )
+from collections import OrderedDict
 from enum import Enum
 from fastapi import HTTPException, status
-from opentelemetry import trace
+from opentelemetry import metrics, trace
 from opentelemetry._logs import get_logger_provider, set_logger_provider
 from opentelemetry.instrumentation.redis import RedisInstrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
@@ -20,18 +22,35 @@ from opentelemetry.instrumentation.system_metrics import SystemMetricsInstrument
 from opentelemetry.instrumentation.urllib3 import URLLib3Instrumentor
 from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
 from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from pathlib import Path
-from tenacity import retry, stop_after_attempt, wait_random_exponential
-from typing import Dict, Optional, Type, TypeVar, Union, Hashable
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 from uuid import UUID
+import asyncio
 import html
 import jwt
 import logging
 import mmh3
 import os
 import re
+import time
 import tomllib
 import json
 
@@ -42,12 +61,15 @@ import json
 
 VERSION = os.environ.get("VERSION")
 AZ_CREDENTIAL = DefaultAzureCredential()
+AZ_CREDENTIAL_ASYNC = AsyncDefaultAzureCredential()  # For async SDK clients
 
 ###
 # Init config
 ###
 
 T = TypeVar("T", bool, int, float, UUID, str, Enum, None)
+K = TypeVar("K")
+V = TypeVar("V")
 
 
 class ConfigNotFound(Exception):
@@ -166,6 +188,9 @@ get_logger_provider().add_log_record_processor(BatchLogRecordProcessor(log_expor
 metric_exporter = AzureMonitorMetricExporter(
     connection_string=APPINSIGHTS_CONNECTION_STR, credential=AZ_CREDENTIAL
 )
+metrics.set_meter_provider(
+    MeterProvider(metric_readers=[PeriodicExportingMetricReader(metric_exporter)])
+)
 # Traces
 # TODO: Enable sampling
 RedisInstrumentor().instrument()  # Redis
@@ -197,6 +222,17 @@ logging.basicConfig(level=LOGGING_SYS_LEVEL)
 LOGGING_APP_LEVEL = get_config(["monitoring", "logging"], "app_level", str, "INFO")
 _logger = build_logger(__name__)
 
+###
+# Init metrics
+###
+
+
+def build_meter(name: str) -> metrics.Meter:
+    return metrics.get_meter(name, VERSION)
+
+
+_meter = build_meter(__name__)
+
 ###
 # Init OIDC
 ###
@@ -205,6 +241,10 @@ OIDC_ALGORITHMS = get_config("oidc", "algorithms", list, required=True)
 OIDC_API_AUDIENCE = get_config("oidc", "api_audience", str, required=True)
 OIDC_ISSUERS = get_config("oidc", "issuers", list, required=True)
 OIDC_JWKS = get_config("oidc", "jwks", str, required=True)
+OIDC_JWKS_MIN_REFETCH_SECS = get_config(
+    "oidc", "jwks_min_refetch_secs", int, default=10
+)
+OIDC_JWKS_TTL_SECS = get_config("oidc", "jwks_ttl_secs", int, default=3600)
 
 
 def sanitize(raw: Optional[str]) -> Optional[str]:
@@ -253,58 +293,309 @@ def hash_token(str: Union[str, Hashable]) -> UUID:
     return UUID(bytes=mmh3.hash_bytes(str))
 
 
+def run_in_loop(loop: asyncio.AbstractEventLoop, coro: Coroutine) -> Any:
+    """
+    Run a coroutine in the event loop from a worker thread, and wait for its result.
+
+    Used by the synchronous LangChain integrations (cache, history, tools), which are executed outside of the event loop thread. Calling it from the event loop thread would deadlock.
+    """
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is loop:
+        coro.close()
+        raise RuntimeError("Cannot wait for a coroutine from its own event loop")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+class LRUCache(Generic[K, V]):
+    """
+    In-memory cache, bounded in size, with an optional TTL.
+
+    Least recently used items are evicted first. Not thread-safe, must be used from the event loop only.
+    """
+
+    _items: OrderedDict[K, Tuple[V, Optional[float]]]
+    max_size: int
+    ttl_secs: Optional[float]
+
+    def __init__(self, max_size: int, ttl_secs: Optional[float] = None):
+        self._items = OrderedDict()
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: K) -> Optional[V]:
+        item = self._items.get(key)
+        if not item:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, ttl_secs: Optional[float] = None) -> None:
+        ttl_secs = ttl_secs or self.ttl_secs
+        expires_at = time.monotonic() + ttl_secs if ttl_secs else None
+        self._items[key] = (value, expires_at)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def delete(self, key: K) -> None:
+        self._items.pop(key, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+
+class MicroBatcher(Generic[K, V]):
+    """
+    Group the items submitted concurrently, and process them with a single call.
+
+    A batch is processed when it reaches its max size, or after a max wait time from its first item. Each caller awaits the result of its own item.
+    """
+
+    _flush: Callable[[List[K]], Awaitable[List[V]]]
+    _loop: asyncio.AbstractEventLoop
+    _max_size: int
+    _max_wait_secs: float
+    _pending: List[Tuple[K, asyncio.Future]]
+    _timer: Optional[asyncio.TimerHandle]
+
+    def __init__(
+        self,
+        flush: Callable[[List[K]], Awaitable[List[V]]],
+        max_size: int,
+        max_wait_secs: float,
+    ):
+        self._flush = flush
+        self._loop = asyncio.get_running_loop()
+        self._max_size = max_size
+        self._max_wait_secs = max_wait_secs
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, item: K) -> V:
+        future = self._loop.create_future()
+        self._pending.append((item, future))
+
+        if len(self._pending) >= self._max_size:
+            self._process()
+        elif not self._timer:
+            self._timer = self._loop.call_later(self._max_wait_secs, self._process)
+
+        return await future
+
+    def _process(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self._loop.create_task(self._process_background(batch))
+
+    async def _process_background(self, batch: List[Tuple[K, asyncio.Future]]) -> None:
+        _logger.debug(f"Processing batch of {len(batch)} items")
+        try:
+            results = await self._flush([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(
+                    f"Batch returned {len(results)} results for {len(batch)} items"
+                )
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class JwksManager:
+    """
+    Signing keys of the identity provider, kept in memory and refreshed in the background.
+
+    Keys are fetched at startup, then refreshed ahead of their TTL. On a refresh error, the previous keys are served and the refresh is retried. Reads never wait on the network, except for an unknown key ID (e.g. after a rotation), which triggers a single refetch shared by the concurrent callers.
+    """
+
+    REFRESH_AHEAD_RATIO: float = 0.8
+    RETRY_MAX_SECS: int = 60
+    _client: jwt.PyJWKClient
+    _fetch_task: Optional[asyncio.Task]
+    _fetched_at: Optional[float]
+    _keys: Dict[str, jwt.PyJWK]
+    _loop: asyncio.AbstractEventLoop
+    _refresh_task: asyncio.Task
+
+    def __init__(self):
+        # Cache is handled here, the client only fetches
+        self._client = jwt.PyJWKClient(OIDC_JWKS, cache_jwk_set=False)
+        self._fetch_task = None
+        self._fetched_at = None
+        self._keys = {}
+        self._loop = asyncio.get_running_loop()
+
+        # Metrics
+        _meter.create_observable_gauge(
+            callbacks=[self._age_observe],
+            description="Time since the signing keys were last fetched.",
+            name="oidc.jwks.age",
+            unit="s",
+        )
+        self._fetches = _meter.create_counter(
+            description="Number of signing keys fetches, by result.",
+            name="oidc.jwks.fetch",
+        )
+        self._unknown_kids = _meter.create_counter(
+            description="Number of tokens signed with an unknown key ID.",
+            name="oidc.jwks.unknown_kid",
+        )
+
+        self._refresh_task = self._loop.create_task(self._refresh_loop())
+
+    async def signing_key(self, kid: Optional[str]) -> jwt.PyJWK:
+        """
+        Get the signing key for a key ID.
+
+        Raises PyJWKClientError if the key is unknown, even after a refetch.
+        """
+        key = self._keys.get(kid) if kid else None
+        if key:
+            return key
+
+        self._unknown_kids.add(1)
+        # Refetch at most once per interval, tokens with a random key ID must not flood the identity provider
+        pending = self._fetch_task and not self._fetch_task.done()
+        if (
+            pending
+            or not self._fetched_at
+            or time.monotonic() - self._fetched_at >= OIDC_JWKS_MIN_REFETCH_SECS
+        ):
+            _logger.info(f"Unknown signing key {kid}, refetching keys")
+            await asyncio.shield(self._fetch())
+            key = self._keys.get(kid) if kid else None
+
+        if not key:
+            raise jwt.PyJWKClientError(
+                f'Unable to find a signing key that matches "{kid}"'
+            )
+        return key
+
+    def _fetch(self) -> asyncio.Task:
+        """
+        Fetch the keys, sharing the fetch in progress if any.
+        """
+        if not self._fetch_task or self._fetch_task.done():
+            self._fetch_task = self._loop.create_task(self._fetch_background())
+        return self._fetch_task
+
+    async def _fetch_background(self) -> None:
+        try:
+            # Client is synchronous, run it in a thread to not block the event loop
+            jwk_set = await asyncio.to_thread(self._client.get_jwk_set, True)
+        except Exception:
+            self._fetches.add(1, {"result": "error"})
+            raise
+        self._fetches.add(1, {"result": "ok"})
+        # Replaced at once, readers never see a partial set and need no lock
+        self._keys = {
+            key.key_id: key
+            for key in jwk_set.keys
+            if key.key_id and key.public_key_use in ("sig", None)
+        }
+        self._fetched_at = time.monotonic()
+        _logger.debug(f"Loaded {len(self._keys)} signing keys")
+
+    async def _refresh_loop(self) -> None:
+        failures = 0
+        while True:
+            try:
+                await self._fetch()
+                failures = 0
+                delay = OIDC_JWKS_TTL_SECS * self.REFRESH_AHEAD_RATIO
+            except Exception:
+                failures += 1
+                delay = min(2**failures, self.RETRY_MAX_SECS)
+                _logger.warning(
+                    f"Cannot refresh signing keys, retrying in {delay} secs",
+                    exc_info=True,
+                )
+            await asyncio.sleep(delay)
+
+    def _age_observe(
+        self, options: metrics.CallbackOptions
+    ) -> List[metrics.Observation]:
+        if not self._fetched_at:
+            return []
+        return [metrics.Observation(time.monotonic() - self._fetched_at)]
+
+
 class VerifyToken:
-    jwks_client = jwt.PyJWKClient(OIDC_JWKS, cache_keys=True)
+    jwks: JwksManager
+    token: str
 
-    def __init__(self, token):
+    def __init__(self, token: str, jwks: JwksManager):
+        self.jwks = jwks
         self.token = token
 
-    def verify(self) -> Dict[str, str]:
+    async def verify(self) -> Dict[str, str]:
+        # Issuer is read from the unverified token, then checked against the allowed ones, instead of trying each of them
+        try:
+            issuer = jwt.decode(self.token, options={"verify_signature": False}).get(
+                "iss"
+            )
+        except Exception as e:
+            _logger.info("JWT token is invalid")
+            _logger.debug(e)
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="JWT token is invalid",
+            )
+
+        if issuer not in OIDC_ISSUERS:
+            _logger.info(f"JWT issuer is not allowed: {issuer}")
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="JWT token is invalid",
+            )
+
         try:
-            self._load_jwks()
+            signing_key = await self.jwks.signing_key(
+                jwt.get_unverified_header(self.token).get("kid")
+            )
+        except jwt.PyJWKClientError as e:
+            _logger.info("JWT token is signed with an unknown key")
+            _logger.debug(e)
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="JWT token is invalid",
+            )
         except Exception:
             _logger.error("Cannot load signing key from JWT", exc_info=True)
             raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        succeed = False
-        last_error = None
-        payload = None
-        for issuer in OIDC_ISSUERS:
-            try:
-                payload = jwt.decode(
-                    self.token,
-                    algorithms=OIDC_ALGORITHMS,
-                    audience=OIDC_API_AUDIENCE,
-                    issuer=issuer,
-                    key=self.signing_key.key,
-                    options={"require": ["exp", "iss", "sub"]},
-                )
-                succeed = True
-                _logger.debug(f"Successfully validate JWT with issuer: {issuer}")
-                break
-            except Exception as e:
-                _logger.debug(f"Fails validate JWT with issuer: {issuer}")
-                last_error = e
-
-        if not succeed:
+        try:
+            payload = jwt.decode(
+                self.token,
+                algorithms=OIDC_ALGORITHMS,
+                audience=OIDC_API_AUDIENCE,
+                issuer=issuer,
+                key=signing_key.key,
+                options={"require": ["exp", "iss", "sub"]},
+            )
+        except Exception as e:
             _logger.info("JWT token is invalid")
-            _logger.debug(last_error)
+            _logger.debug(e)
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="JWT token is invalid",
             )
 
-        if not payload:
-            _logger.error("Incoherent payload, shouldn't be None")
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
+        _logger.debug(f"Successfully validate JWT with issuer: {issuer}")
         return payload
-
-    @retry(
-        reraise=True,
-        stop=stop_after_attempt(3),
-        wait=wait_random_exponential(multiplier=0.5, max=30),
-    )
-    def _load_jwks(self) -> None:
-        logging.debug("Loading signing key from JWT")
-        self.signing_key = VerifyToken.jwks_client.get_signing_key_from_jwt(self.token)
@@ -21,8 +21,12 @@ function App() {
   };
   // State
   const [conversations, setConversations] = useState([]);
+  const [conversationsContinuation, setConversationsContinuation] =
+    useState(null);
   const [isVisible, setIsVisible] = useState(true);
   const [headerOpen, setHeaderOpen] = useState(false);
+  const [loadingMoreConversations, setLoadingMoreConversations] =
+    useState(false);
   // Persistance
   let darkTheme, setDarkTheme;
   // In a browser, we persist the theme in local storage
@@ -56,51 +60,90 @@ function App() {
     };
   }, []);
 
+  const fetchConversationsPage = async (continuation, signal) => {
+    const idToken = await getIdToken(account, instance);
+
+    const res = await client.get("/conversation", {
+      signal: signal,
+      timeout: 10_000,
+      params: {
+        continuation: continuation || undefined,
+      },
+      headers: {
+        Authorization: `Bearer ${idToken}`,
+      },
+    });
+    return res.data;
+  };
+
   const fetchConversations = async (idToSelect = null) => {
     if (!account) return;
 
     const controller = new AbortController();
-    const idToken = await getIdToken(account, instance);
 
-    await client
-      .get("/conversation", {
-        signal: controller.signal,
-        timeout: 10_000,
-        headers: {
-          Authorization: `Bearer ${idToken}`,
-        },
-      })
-      .then((res) => {
-        if (!res.data) return;
-
-        const localConversations = res.data.conversations;
-        setConversations(localConversations);
-
-        if (idToSelect) {
-          let found = null;
-          // Search for the conversation ID
-          for (const conversation of localConversations) {
-            if (conversation.id == idToSelect) {
-              found = conversation.id;
-              break;
-            }
-          }
-          // If ID not found, select the first one
-          if (!found) {
-            found = localConversations[0].id;
+    try {
+      let page = await fetchConversationsPage(null, controller.signal);
+      if (!page) return;
+
+      let localConversations = page.conversations;
+      let continuation = page.continuation;
+      // Load the next pages until the conversation to select is found
+      while (
+        idToSelect &&
+        continuation &&
+        !localConversations.some((conversation) => conversation.id == idToSelect)
+      ) {
+        page = await fetchConversationsPage(continuation, controller.signal);
+        if (!page) break;
+        localConversations = [...localConversations, ...page.conversations];
+        continuation = page.continuation;
+      }
+      setConversations(localConversations);
+      setConversationsContinuation(continuation);
+
+      if (idToSelect && localConversations.length > 0) {
+        let found = null;
+        // Search for the conversation ID
+        for (const conversation of localConversations) {
+          if (conversation.id == idToSelect) {
+            found = conversation.id;
+            break;
           }
-          navigate(`/conversation/${found}`);
         }
-      })
-      .catch((err) => {
-        console.error(err);
-      });
+        // If ID not found, select the first one
+        if (!found) {
+          found = localConversations[0].id;
+        }
+        navigate(`/conversation/${found}`);
+      }
+    } catch (err) {
+      console.error(err);
+    }
 
     return () => {
       if (controller) controller.abort();
     }
   };
 
+  const loadMoreConversations = async () => {
+    if (!account || !conversationsContinuation) return;
+
+    setLoadingMoreConversations(true);
+
+    await fetchConversationsPage(conversationsContinuation)
+      .then((page) => {
+        if (!page) return;
+        setConversations([...conversations, ...page.conversations]);
+        setConversationsContinuation(page.continuation);
+      })
+      .catch((err) => {
+        console.error(err);
+      })
+      .finally(() => {
+        setLoadingMoreConversations(false);
+      });
+  };
+
   useEffect(() => {
     fetchConversations();
   }, [account]);
@@ -114,8 +157,14 @@ function App() {
     const refreshConversations = async (id) => {
       fetchConversations(id);
     };
-    return [conversations, refreshConversations];
-  }, [conversations]);
+    return [
+      conversations,
+      refreshConversations,
+      conversationsContinuation,
+      loadMoreConversations,
+      loadingMoreConversations,
+    ];
+  }, [conversations, conversationsContinuation, loadingMoreConversations]);
 
   const headerOpenContextProps = useMemo(
     () => [headerOpen, setHeaderOpen],
@@ -25,6 +25,7 @@ function Conversation() {
   const [conversation, setConversation] = useState({ messages: [] });
   const [input, setInput] = useState(null);
   const [loading, setLoading] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const [optionsPrompt, setOptionsPrompt] = useState([]);
   const [prompts, setPrompts] = useState({});
   const [secret, setSecret] = useState(false);
@@ -136,6 +137,40 @@ function Conversation() {
     }
   }, [account, conversationId]);
 
+  // Load the older messages, only the latest ones are returned with the conversation
+  const loadOlderMessages = async () => {
+    if (!conversation.messages_before) return;
+
+    setLoadingOlder(true);
+
+    const idToken = await getIdToken(account, instance);
+
+    await client
+      .get(`/conversation/${conversation.id}`, {
+        timeout: 10_000,
+        params: {
+          before: conversation.messages_before,
+        },
+        headers: {
+          Authorization: `Bearer ${idToken}`,
+        },
+      })
+      .then((res) => {
+        if (!res.data) return;
+        setConversation({
+          ...conversation,
+          messages: [...res.data.messages, ...conversation.messages],
+          messages_before: res.data.messages_before,
+        });
+      })
+      .catch((err) => {
+        console.error(err);
+      })
+      .finally(() => {
+        setLoadingOlder(false);
+      });
+  };
+
   const sendMessage = () => {
     // Create a locache state cache, as state props wont't be updated until the next render
     let localMessages = [...conversation.messages];
@@ -218,6 +253,8 @@ function Conversation() {
             }
 
             const json = JSON.parse(e.data);
+            // Content streamed so far is replaced, actions are kept
+            if (json.reset) content = "";
             if (json.content) content += json.content;
             if (json.action) actions.push(json.action);
             updateLastMessage({
@@ -391,6 +428,15 @@ function Conversation() {
       )}
       {conversation.messages.length > 0 && (
         <div className="conversation__messages">
+          {conversation.messages_before && (
+            <Button
+              className="conversation__messages__older"
+              emoji={ArrowUpFilled}
+              loading={loadingOlder}
+              onClick={() => loadOlderMessages()}
+              text="Older messages"
+            />
+          )}
           {conversation.messages.map((message) => (
             <Message
               actions={message?.actions}
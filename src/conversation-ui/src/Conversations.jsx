@@ -1,7 +1,9 @@
 import "./conversations.scss";
 import { ConversationContext, HeaderOpenContext } from "./App";
+import { ArrowDownFilled } from "@fluentui/react-icons";
 import { useContext } from "react";
 import { useNavigate, useParams } from "react-router-dom";
+import Button from "./Button";
 import moment from "moment";
 
 function Conversations() {
@@ -11,7 +13,13 @@ function Conversations() {
   const navigate = useNavigate();
   // React context
   const [, setHeaderOpen] = useContext(HeaderOpenContext);
-  const [conversations] = useContext(ConversationContext);
+  const [
+    conversations,
+    ,
+    conversationsContinuation,
+    loadMoreConversations,
+    loadingMoreConversations,
+  ] = useContext(ConversationContext);
 
   const groupedConversations = conversations.reduce(
     (acc, conversation) => {
@@ -65,6 +73,15 @@ function Conversations() {
       {displayConversations("A month ago", groupedConversations.monthAgo)}
       {displayConversations("A year ago", groupedConversations.yearAgo)}
       {displayConversations("Older", groupedConversations.older)}
+      {conversationsContinuation && (
+        <Button
+          className="conversations__more"
+          emoji={ArrowDownFilled}
+          loading={loadingMoreConversations}
+          onClick={() => loadMoreConversations()}
+          text="Older conversations"
+        />
+      )}
     </div>
   );
 }